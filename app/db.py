@@ -1,18 +1,133 @@
 import os
-from sqlalchemy import create_engine, text
+import time
+import threading
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
-def get_engine():
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+_POOL_STATS = {
+    "checkouts": 0,
+    "checkins": 0,
+    "conexoes_abertas": 0,
+    "esperas": 0,
+    "espera_total_s": 0.0,
+    "espera_max_s": 0.0,
+    "timeouts": 0,
+}
+_STATS_LOCK = threading.Lock()
+# checkouts mais lentos que isso contam como "espera" (pool cheio ou conexão nova)
+_WAIT_THRESHOLD_S = 0.005
+
+class _MeteredQueuePool(QueuePool):
+    """QueuePool que mede o tempo de obtenção de conexão (espera no pool)."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with _STATS_LOCK:
+                _POOL_STATS["timeouts"] += 1
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            with _STATS_LOCK:
+                if dt >= _WAIT_THRESHOLD_S:
+                    _POOL_STATS["esperas"] += 1
+                    _POOL_STATS["espera_total_s"] += dt
+                _POOL_STATS["espera_max_s"] = max(_POOL_STATS["espera_max_s"], dt)
+
+def _inc(key: str):
+    with _STATS_LOCK:
+        _POOL_STATS[key] += 1
+
+def _build_engine():
     url = os.getenv("DATABASE_URL")
     if not url:
         raise RuntimeError("DATABASE_URL não definido no ambiente.")
-    engine = create_engine(url, future=True)
+    engine = create_engine(
+        url,
+        future=True,
+        poolclass=_MeteredQueuePool,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    )
+    event.listen(engine, "connect", lambda *a: _inc("conexoes_abertas"))
+    event.listen(engine, "checkout", lambda *a: _inc("checkouts"))
+    event.listen(engine, "checkin", lambda *a: _inc("checkins"))
     return engine
 
+def get_engine():
+    """Engine único por processo (pool configurável via DB_POOL_*)."""
+    global _ENGINE
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = _build_engine()
+    return _ENGINE
+
+def dispose_engine():
+    """Descarta o engine do processo (ex.: após fork); o próximo get_engine recria."""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is not None:
+            _ENGINE.dispose(close=False)
+        _ENGINE = None
+
+def get_pool_metrics() -> dict:
+    with _STATS_LOCK:
+        stats = dict(_POOL_STATS)
+    stats["espera_total_s"] = round(stats["espera_total_s"], 4)
+    stats["espera_max_s"] = round(stats["espera_max_s"], 4)
+    if _ENGINE is None:
+        return {"engine": False, **stats}
+    pool = _ENGINE.pool
+    return {
+        "engine": True,
+        "pool_size": pool.size(),
+        "em_uso": pool.checkedout(),
+        "livres": pool.checkedin(),
+        "overflow": pool.overflow(),
+        **stats,
+    }
+
 def get_session():
     engine = get_engine()
     return sessionmaker(bind=engine, future=True)()
 
+SIDRA_COLUNAS_DDL = """
+        tabela INTEGER NOT NULL,
+        variavel INTEGER NOT NULL,
+        ano INTEGER NOT NULL,
+        cod_municipio INTEGER NOT NULL,
+        nome_municipio VARCHAR(160) NOT NULL,
+        uf CHAR(2),
+        produto_codigo INTEGER,
+        produto_nome VARCHAR(200),
+        unidade VARCHAR(64),
+        valor_str VARCHAR(64),
+        valor_num DOUBLE PRECISION,
+        coleta_em TIMESTAMP DEFAULT NOW(),
+        origem VARCHAR(40) DEFAULT 'SIDRA',
+        UNIQUE (tabela, variavel, ano, cod_municipio, produto_codigo)
+"""
+
+def _sidra_table_ddl(nome: str, particionada: bool) -> str:
+    # tabela particionada não aceita PK sem a chave de partição: a chave natural (UNIQUE) é a identidade
+    if particionada:
+        return f"""
+    CREATE TABLE IF NOT EXISTS public.{nome} (
+        id BIGSERIAL,{SIDRA_COLUNAS_DDL}    ) PARTITION BY RANGE (ano);"""
+    return f"""
+    CREATE TABLE IF NOT EXISTS public.{nome} (
+        id BIGSERIAL PRIMARY KEY,{SIDRA_COLUNAS_DDL}    );"""
+
 def ensure_schema(engine) -> None:
     ddl = """
     CREATE TABLE IF NOT EXISTS public.municipios_filiais (
@@ -28,32 +143,438 @@ def ensure_schema(engine) -> None:
     CREATE INDEX IF NOT EXISTS idx_munic_nome_norm ON public.municipios_filiais (nome_normalizado);
     CREATE INDEX IF NOT EXISTS idx_munic_cod_ibge ON public.municipios_filiais (codigo_ibge);
 
+    -- referência local de localidades do IBGE (todas as UFs), versionada pela data da busca
+    CREATE TABLE IF NOT EXISTS public.municipios_ibge (
+        codigo_ibge INTEGER PRIMARY KEY,
+        nome VARCHAR(160) NOT NULL,
+        nome_normalizado VARCHAR(200) NOT NULL,
+        uf CHAR(2) NOT NULL,
+        uf_id INTEGER,
+        regiao VARCHAR(20),
+        versao DATE NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_munic_ibge_uf_nome ON public.municipios_ibge (uf, nome_normalizado);
+
+    CREATE TABLE IF NOT EXISTS public.municipios_ibge_versoes (
+        versao DATE PRIMARY KEY,
+        buscado_em TIMESTAMP DEFAULT NOW(),
+        total INTEGER NOT NULL,
+        ufs INTEGER NOT NULL,
+        removidos INTEGER NOT NULL DEFAULT 0
+    );
+
+    -- resolução nome -> código IBGE já conhecida (exato/fuzzy/manual); uf '' = planilha sem UF.
+    -- 'sem_match': nome que não casou (codigo_ibge nulo) contra a versão versao_ibge de municipios_ibge
+    CREATE TABLE IF NOT EXISTS public.municipios_alias (
+        uf VARCHAR(2) NOT NULL DEFAULT '',
+        nome_normalizado VARCHAR(200) NOT NULL,
+        codigo_ibge INTEGER,
+        uf_ibge CHAR(2),
+        score REAL,
+        fonte VARCHAR(10) NOT NULL CONSTRAINT municipios_alias_fonte_check
+            CHECK (fonte IN ('exato', 'fuzzy', 'manual', 'sem_match')),
+        versao_ibge DATE,
+        atualizado_em TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (uf, nome_normalizado)
+    );
+
+    -- instalações anteriores aos registros 'sem_match'
+    ALTER TABLE public.municipios_alias ALTER COLUMN codigo_ibge DROP NOT NULL;
+    ALTER TABLE public.municipios_alias ADD COLUMN IF NOT EXISTS versao_ibge DATE;
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conname = 'municipios_alias_fonte_check'
+              AND pg_get_constraintdef(oid) LIKE '%sem_match%'
+        ) THEN
+            ALTER TABLE public.municipios_alias DROP CONSTRAINT IF EXISTS municipios_alias_fonte_check;
+            ALTER TABLE public.municipios_alias ADD CONSTRAINT municipios_alias_fonte_check
+                CHECK (fonte IN ('exato', 'fuzzy', 'manual', 'sem_match'));
+        END IF;
+    END $$;
+
     CREATE TABLE IF NOT EXISTS public.produtos_sidra (
         codigo INTEGER PRIMARY KEY,
         nome VARCHAR(200) NOT NULL,
         grupo VARCHAR(40) NOT NULL
     );
 
-    CREATE TABLE IF NOT EXISTS public.dados_sidra_brutos (
+    -- dimensões usadas pelas views de BI (mantidas pelo app)
+    -- tabela SIDRA -> grupo (semeada de logic.TABLES)
+    CREATE TABLE IF NOT EXISTS public.dim_grupo_sidra (
+        tabela INTEGER PRIMARY KEY,
+        grupo VARCHAR(40) NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_dim_grupo_sidra_grupo ON public.dim_grupo_sidra (grupo);
+
+    -- município -> filial exclusiva (primeira em ordem alfabética), sem dupla contagem
+    CREATE TABLE IF NOT EXISTS public.dim_municipio_filial_exclusiva (
+        codigo_ibge INTEGER PRIMARY KEY,
+        filial VARCHAR(120) NOT NULL,
+        nome_municipio VARCHAR(160) NOT NULL,
+        atualizado_em TIMESTAMP DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_dim_mun_filial_excl_filial ON public.dim_municipio_filial_exclusiva (filial);
+
+    {dados_sidra}
+
+    CREATE INDEX IF NOT EXISTS idx_sidra_munic ON public.dados_sidra_brutos (cod_municipio);
+    CREATE INDEX IF NOT EXISTS idx_sidra_prod ON public.dados_sidra_brutos (produto_codigo);
+    CREATE INDEX IF NOT EXISTS idx_sidra_coleta_em ON public.dados_sidra_brutos (coleta_em);
+    -- paginação keyset de /dados: ORDER BY ano, id
+    CREATE INDEX IF NOT EXISTS idx_sidra_ano_id ON public.dados_sidra_brutos (ano, id);
+
+    -- marca d'água da coleta incremental: períodos já gravados por tabela/variável/classificação
+    CREATE TABLE IF NOT EXISTS public.sidra_periodos_coletados (
+        tabela INTEGER NOT NULL,
+        variavel INTEGER NOT NULL,
+        classificacao INTEGER NOT NULL,
+        periodo VARCHAR(16) NOT NULL,
+        modificacao VARCHAR(32),
+        coletado_em TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (tabela, variavel, classificacao, periodo)
+    );
+
+    -- cobertura da marca: municípios e categorias já buscados no período; se o conjunto
+    -- atual for outro (filial nova, nomes casados), a coleta busca o que falta
+    ALTER TABLE public.sidra_periodos_coletados ADD COLUMN IF NOT EXISTS municipios INTEGER[];
+    ALTER TABLE public.sidra_periodos_coletados ADD COLUMN IF NOT EXISTS categorias INTEGER[];
+    ALTER TABLE public.sidra_periodos_coletados ADD COLUMN IF NOT EXISTS cobertura VARCHAR(32);
+
+    -- jobs em segundo plano (bootstrap/coleta); um ativo por recurso
+    CREATE TABLE IF NOT EXISTS public.jobs (
         id BIGSERIAL PRIMARY KEY,
+        tipo VARCHAR(40) NOT NULL,
+        recurso VARCHAR(40) NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'pendente',
+        params JSONB,
+        progresso JSONB,
+        resultado JSONB,
+        erro TEXT,
+        cancelar BOOLEAN NOT NULL DEFAULT FALSE,
+        criado_em TIMESTAMP DEFAULT NOW(),
+        iniciado_em TIMESTAMP,
+        heartbeat_em TIMESTAMP,
+        finalizado_em TIMESTAMP
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_jobs_recurso_ativo
+        ON public.jobs (recurso) WHERE status IN ('pendente', 'executando');
+
+    -- sub-requisições /values que falharam mesmo após divisão (reprocessáveis)
+    CREATE TABLE IF NOT EXISTS public.sidra_dead_letter (
+        id BIGSERIAL PRIMARY KEY,
+        grupo VARCHAR(40) NOT NULL,
+        tabela INTEGER NOT NULL,
+        variavel INTEGER NOT NULL,
+        classificacao INTEGER,
+        periodos TEXT NOT NULL,
+        municipios TEXT NOT NULL,
+        categorias TEXT NOT NULL,
+        url TEXT NOT NULL UNIQUE,
+        erro TEXT,
+        tentativas INTEGER NOT NULL DEFAULT 1,
+        criado_em TIMESTAMP DEFAULT NOW(),
+        reprocessado_em TIMESTAMP
+    );
+
+    -- execuções da coleta e seus checkpoints (uma linha por requisição planejada)
+    CREATE TABLE IF NOT EXISTS public.coleta_execucoes (
+        id BIGSERIAL PRIMARY KEY,
+        modo VARCHAR(16) NOT NULL,
+        ano_ini INTEGER,
+        ano_fim INTEGER,
+        grupos TEXT NOT NULL,
+        status VARCHAR(16) NOT NULL DEFAULT 'executando',
+        iniciado_em TIMESTAMP DEFAULT NOW(),
+        finalizado_em TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS public.coleta_checkpoints (
+        id BIGSERIAL PRIMARY KEY,
+        execucao_id BIGINT NOT NULL REFERENCES public.coleta_execucoes(id) ON DELETE CASCADE,
+        grupo VARCHAR(40) NOT NULL,
+        tabela INTEGER NOT NULL,
+        variavel INTEGER NOT NULL,
+        classificacao INTEGER NOT NULL,
+        bloco INTEGER NOT NULL,
+        periodos TEXT NOT NULL,
+        municipios TEXT NOT NULL,
+        categorias TEXT NOT NULL,
+        url TEXT NOT NULL,
+        marca JSONB,
+        status VARCHAR(16) NOT NULL DEFAULT 'pendente',
+        linhas INTEGER,
+        falhas INTEGER,
+        concluido_em TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_coleta_checkpoints_exec
+        ON public.coleta_checkpoints (execucao_id, grupo, status);
+
+    -- alterações efetivas em dados_sidra_brutos (base para atualizações incrementais)
+    CREATE TABLE IF NOT EXISTS public.sidra_changelog (
+        id BIGSERIAL PRIMARY KEY,
+        execucao_id BIGINT REFERENCES public.coleta_execucoes(id) ON DELETE SET NULL,
         tabela INTEGER NOT NULL,
         variavel INTEGER NOT NULL,
         ano INTEGER NOT NULL,
         cod_municipio INTEGER NOT NULL,
-        nome_municipio VARCHAR(160) NOT NULL,
-        uf CHAR(2),
         produto_codigo INTEGER,
-        produto_nome VARCHAR(200),
-        unidade VARCHAR(64),
+        valor_str_ant VARCHAR(64),
+        valor_num_ant DOUBLE PRECISION,
         valor_str VARCHAR(64),
         valor_num DOUBLE PRECISION,
-        coleta_em TIMESTAMP DEFAULT NOW(),
-        origem VARCHAR(40) DEFAULT 'SIDRA',
-        UNIQUE (tabela, variavel, ano, cod_municipio, produto_codigo)
+        nova BOOLEAN NOT NULL,
+        alterado_em TIMESTAMP DEFAULT NOW()
     );
 
-    CREATE INDEX IF NOT EXISTS idx_sidra_munic ON public.dados_sidra_brutos (cod_municipio);
-    CREATE INDEX IF NOT EXISTS idx_sidra_prod ON public.dados_sidra_brutos (produto_codigo);
-    """
+    CREATE INDEX IF NOT EXISTS idx_sidra_changelog_exec ON public.sidra_changelog (execucao_id);
+
+    -- agregado anual por filial (todos os anos), mantido de forma incremental pelo changelog
+    CREATE TABLE IF NOT EXISTS public.fato_agregado_anual (
+        filial VARCHAR(120) NOT NULL,
+        uf CHAR(2) NOT NULL DEFAULT '',
+        grupo VARCHAR(40) NOT NULL,
+        produto_nome VARCHAR(200) NOT NULL DEFAULT '',
+        unidade VARCHAR(64) NOT NULL DEFAULT '',
+        ano INTEGER NOT NULL,
+        valor DOUBLE PRECISION,
+        municipios INTEGER NOT NULL,
+        atualizado_em TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (filial, uf, grupo, produto_nome, unidade, ano)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_fato_agregado_ano ON public.fato_agregado_anual (ano);
+
+    CREATE TABLE IF NOT EXISTS public.fato_agregado_estado (
+        id SMALLINT PRIMARY KEY CHECK (id = 1),
+        changelog_id BIGINT NOT NULL,
+        filiais_hash TEXT,
+        atualizado_em TIMESTAMP DEFAULT NOW()
+    );
+    """.replace("{dados_sidra}", _sidra_table_ddl("dados_sidra_brutos", particionar_por() is not None).strip())
     with engine.begin() as conn:
         conn.execute(text(ddl))
+
+# ---------------- particionamento de dados_sidra_brutos ----------------
+# RANGE (ano), uma partição por ano; opcionalmente cada ano em LIST (tabela).
+# Partições novas são criadas sob demanda pelo gravador (ensure_particoes_sidra).
+
+_PARTICOES: set = set()
+_PARTICOES_LOCK = threading.Lock()
+_PARTICIONADA: bool | None = None
+
+def particionar_por() -> str | None:
+    """SIDRA_PARTICIONAR=ano | ano,tabela (instalações novas); vazio = tabela única."""
+    v = os.getenv("SIDRA_PARTICIONAR", "").replace(" ", "").lower()
+    if not v:
+        return None
+    if v not in ("ano", "ano,tabela"):
+        raise ValueError(f"SIDRA_PARTICIONAR inválido: {v} (use 'ano' ou 'ano,tabela')")
+    return v
+
+def _is_particionada(conn, nome: str = "dados_sidra_brutos") -> bool:
+    return bool(conn.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt "
+            "JOIN pg_class c ON c.oid = pt.partrelid "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = 'public' AND c.relname = :t)"
+        ),
+        {"t": nome},
+    ).scalar_one())
+
+def _sub_por_tabela(conn, nome: str) -> bool:
+    """Sub-particionada por tabela se algum ano já é particionado; sem anos, vale SIDRA_PARTICIONAR."""
+    row = conn.execute(
+        text(
+            "SELECT bool_or(c.relkind = 'p'), COUNT(*) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:t AS regclass)"
+        ),
+        {"t": f"public.{nome}"},
+    ).one()
+    if row[1]:
+        return bool(row[0])
+    return particionar_por() == "ano,tabela"
+
+def _criar_particoes(conn, nome: str, pares, sub_tabela: bool) -> int:
+    """Cria (se faltar) a partição de cada ano e, com sub_tabela, a de cada (ano, tabela)."""
+    n = 0
+    for ano in sorted({a for a, _ in pares}):
+        part = f"{nome}_{ano}"
+        sub = " PARTITION BY LIST (tabela)" if sub_tabela else ""
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS public.{part} PARTITION OF public.{nome} "
+            f"FOR VALUES FROM ({int(ano)}) TO ({int(ano) + 1}){sub}"
+        ))
+        n += 1
+        if sub_tabela:
+            for tabela in sorted({t for a, t in pares if a == ano}):
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS public.{part}_{int(tabela)} PARTITION OF public.{part} "
+                    f"FOR VALUES IN ({int(tabela)})"
+                ))
+                n += 1
+    return n
+
+def ensure_particoes_sidra(engine, pares) -> None:
+    """
+    Garante as partições dos (ano, tabela) de um lote antes do COPY. No-op se a
+    tabela não é particionada. O que já foi visto fica em memória (sem ir ao catálogo).
+    """
+    global _PARTICIONADA
+    pares = {(int(a), int(t)) for a, t in pares}
+    with _PARTICOES_LOCK:
+        faltam = pares - _PARTICOES
+        if not faltam or _PARTICIONADA is False:
+            return
+        with engine.begin() as conn:
+            if _PARTICIONADA is None:
+                _PARTICIONADA = _is_particionada(conn)
+                if not _PARTICIONADA:
+                    return
+            # vários processos podem gravar o mesmo ano novo ao mesmo tempo
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('particoes_dados_sidra'))"))
+            _criar_particoes(conn, "dados_sidra_brutos", faltam, _sub_por_tabela(conn, "dados_sidra_brutos"))
+        _PARTICOES.update(faltam)
+
+def _reset_particoes_cache() -> None:
+    global _PARTICIONADA
+    with _PARTICOES_LOCK:
+        _PARTICIONADA = None
+        _PARTICOES.clear()
+
+def migrar_dados_sidra_particionada(engine, sub_tabela: bool = False) -> dict:
+    """
+    Converte dados_sidra_brutos (tabela única) em particionada por ano (e tabela),
+    numa transação: cria a nova, copia os dados, recria índices e as views/MVs
+    que dependiam da antiga (definições lidas do catálogo) e troca os nomes.
+    """
+    with engine.begin() as conn:
+        if _is_particionada(conn):
+            return {"ok": True, "ja_particionada": True}
+        conn.execute(text("LOCK TABLE public.dados_sidra_brutos IN ACCESS EXCLUSIVE MODE"))
+        nova = "dados_sidra_brutos_part"
+        conn.execute(text(f"DROP TABLE IF EXISTS public.{nova}"))
+        conn.execute(text(_sidra_table_ddl(nova, True)))
+        pares = conn.execute(text("SELECT DISTINCT ano, tabela FROM public.dados_sidra_brutos")).all()
+        n_part = _criar_particoes(conn, nova, pares, sub_tabela)
+        cols = (
+            "id, tabela, variavel, ano, cod_municipio, nome_municipio, uf, produto_codigo, "
+            "produto_nome, unidade, valor_str, valor_num, coleta_em, origem"
+        )
+        linhas = conn.execute(
+            text(f"INSERT INTO public.{nova} ({cols}) SELECT {cols} FROM public.dados_sidra_brutos")
+        ).rowcount
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('public.{nova}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM public.{nova}), 0) + 1, false)"
+        ))
+
+        # índices avulsos (ensure_schema + db_views.sql), sem PK/UNIQUE, que a nova já tem
+        indices = [r[0] for r in conn.execute(text(
+            """
+            SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i
+            WHERE i.indrelid = CAST('public.dados_sidra_brutos' AS regclass)
+              AND NOT i.indisprimary AND NOT i.indisunique
+            """
+        ))]
+        # views/MVs que dependem (direta ou indiretamente) da tabela, na ordem de criação
+        views = conn.execute(text(
+            """
+            WITH RECURSIVE deps(oid) AS (
+                SELECT DISTINCT r.ev_class
+                FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+                WHERE d.refobjid = CAST('public.dados_sidra_brutos' AS regclass)
+                  AND r.ev_class <> d.refobjid
+                UNION
+                SELECT r.ev_class
+                FROM deps JOIN pg_depend d ON d.refobjid = deps.oid
+                JOIN pg_rewrite r ON r.oid = d.objid
+                WHERE r.ev_class <> deps.oid
+            )
+            SELECT c.oid, n.nspname, c.relname, c.relkind, pg_get_viewdef(c.oid) AS def,
+                   obj_description(c.oid, 'pg_class') AS comentario,
+                   ARRAY(SELECT pg_get_indexdef(x.indexrelid) FROM pg_index x WHERE x.indrelid = c.oid) AS indices
+            FROM deps JOIN pg_class c ON c.oid = deps.oid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            ORDER BY c.oid
+            """
+        )).mappings().all()
+
+        chave = conn.execute(text(
+            "SELECT conname FROM pg_constraint "
+            "WHERE conrelid = CAST('public.dados_sidra_brutos' AS regclass) AND contype = 'u'"
+        )).scalar()
+
+        conn.execute(text("DROP TABLE public.dados_sidra_brutos CASCADE"))
+        # nomes finais: tabela, sequência, chave única e partições (dados_sidra_brutos_<ano>[_<tabela>])
+        filhos = conn.execute(text(
+            """
+            WITH RECURSIVE arv AS (
+                SELECT inhrelid AS oid FROM pg_inherits WHERE inhparent = CAST(:t AS regclass)
+                UNION ALL
+                SELECT i.inhrelid FROM arv JOIN pg_inherits i ON i.inhparent = arv.oid
+            )
+            SELECT c.relname FROM arv JOIN pg_class c ON c.oid = arv.oid
+            """
+        ), {"t": f"public.{nova}"}).scalars().all()
+        conn.execute(text(f"ALTER TABLE public.{nova} RENAME TO dados_sidra_brutos"))
+        conn.execute(text(f"ALTER SEQUENCE public.{nova}_id_seq RENAME TO dados_sidra_brutos_id_seq"))
+        for filho in filhos:
+            conn.execute(text(
+                f"ALTER TABLE public.{filho} RENAME TO {filho.replace(nova, 'dados_sidra_brutos', 1)}"
+            ))
+        nova_chave = conn.execute(text(
+            "SELECT conname FROM pg_constraint "
+            "WHERE conrelid = CAST('public.dados_sidra_brutos' AS regclass) AND contype = 'u'"
+        )).scalar()
+        if chave and nova_chave and chave != nova_chave:
+            conn.execute(text(f'ALTER TABLE public.dados_sidra_brutos RENAME CONSTRAINT "{nova_chave}" TO "{chave}"'))
+        for idx in indices:
+            conn.execute(text(idx))
+        for v in views:
+            nome = f'"{v["nspname"]}"."{v["relname"]}"'
+            tipo = "MATERIALIZED VIEW" if v["relkind"] == "m" else "VIEW"
+            conn.execute(text(f"CREATE {tipo} {nome} AS {v['def']}"))
+            for idx in v["indices"] or []:
+                conn.execute(text(idx))
+            if v["comentario"]:
+                conn.execute(text(f"COMMENT ON {tipo} {nome} IS :c"), {"c": v["comentario"]})
+    _reset_particoes_cache()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE public.dados_sidra_brutos"))
+    return {
+        "ok": True,
+        "linhas": linhas,
+        "particoes": n_part,
+        "sub_tabela": sub_tabela,
+        "indices": len(indices),
+        "views_recriadas": [v["relname"] for v in views],
+    }
+
+def list_particoes_sidra(engine) -> list[dict]:
+    with engine.begin() as conn:
+        rows = conn.execute(text(
+            """
+            WITH RECURSIVE arv AS (
+                SELECT i.inhrelid AS oid, 1 AS nivel
+                FROM pg_inherits i WHERE i.inhparent = CAST('public.dados_sidra_brutos' AS regclass)
+                UNION ALL
+                SELECT i.inhrelid, arv.nivel + 1
+                FROM arv JOIN pg_inherits i ON i.inhparent = arv.oid
+            )
+            SELECT c.relname AS particao, arv.nivel, pg_get_expr(c.relpartbound, c.oid) AS limites,
+                   c.reltuples::bigint AS linhas_estimadas,
+                   pg_total_relation_size(c.oid) AS bytes
+            FROM arv JOIN pg_class c ON c.oid = arv.oid
+            ORDER BY c.relname
+            """
+        )).mappings().all()
+    return [dict(r) for r in rows]
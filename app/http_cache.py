@@ -0,0 +1,148 @@
+"""
+Cache em disco das respostas JSON das APIs do IBGE (metadados, localidades...).
+
+- chave = URL + params (sha256); valor = JSON comprimido com zlib
+- TTL por endpoint (TTL_RULES; override via IBGE_CACHE_TTL_<REGRA> em segundos)
+- tamanho limitado (IBGE_CACHE_MAX_MB) com despejo LRU pelo mtime do arquivo,
+  que é atualizado a cada acerto
+Controles por ambiente:
+  - IBGE_CACHE=0       -> desliga o cache (sempre vai à rede)
+  - IBGE_CACHE_DIR     -> diretório (padrão: $DATA_DIR/.cache_ibge)
+"""
+import os
+import re
+import json
+import zlib
+import time
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# nome -> (padrão da URL, TTL padrão em segundos). Primeira regra que casar vale; TTL 0 = não cacheia.
+TTL_RULES = {
+    "METADADOS": (re.compile(r"/agregados/\d+/metadados"), 30 * 86400),
+    "LOCALIDADES": (re.compile(r"/api/v1/localidades/"), 30 * 86400),
+    "PERIODOS": (re.compile(r"/agregados/\d+/periodos/?$"), 3600),
+    "VALORES": (re.compile(r"/periodos/[^/]+/variaveis/"), 0),
+}
+
+_LOCK = threading.Lock()
+_SIZE: Optional[int] = None
+
+def enabled() -> bool:
+    return os.getenv("IBGE_CACHE", "1") != "0"
+
+def cache_dir() -> Path:
+    d = os.getenv("IBGE_CACHE_DIR") or os.path.join(os.getenv("DATA_DIR", "/data"), ".cache_ibge")
+    return Path(d)
+
+def max_bytes() -> int:
+    return int(float(os.getenv("IBGE_CACHE_MAX_MB", "200")) * 1024 * 1024)
+
+def ttl_for_rule(name: str) -> int:
+    return int(os.getenv(f"IBGE_CACHE_TTL_{name}", TTL_RULES[name][1]))
+
+def ttl_for(url: str) -> int:
+    for name, (rx, _) in TTL_RULES.items():
+        if rx.search(url):
+            return ttl_for_rule(name)
+    return int(os.getenv("IBGE_CACHE_TTL_PADRAO", "0"))
+
+def _key(url: str, params: Optional[Dict[str, Any]]) -> str:
+    raw = url + "?" + json.dumps(params or {}, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _path(key: str) -> Path:
+    return cache_dir() / f"{key}.json.z"
+
+def get(url: str, params: Optional[Dict[str, Any]] = None):
+    """Retorna (True, valor) em caso de acerto válido; (False, None) caso contrário."""
+    ttl = ttl_for(url)
+    if ttl <= 0 or not enabled():
+        return False, None
+    p = _path(_key(url, params))
+    try:
+        payload = json.loads(zlib.decompress(p.read_bytes()))
+    except (OSError, ValueError, zlib.error):
+        return False, None
+    if time.time() - payload.get("salvo_em", 0) > ttl:
+        return False, None
+    try:
+        os.utime(p)  # marca acesso para o LRU
+    except OSError:
+        pass
+    return True, payload.get("dados")
+
+def put(url: str, params: Optional[Dict[str, Any]], value: Any) -> None:
+    global _SIZE
+    if ttl_for(url) <= 0 or not enabled():
+        return
+    d = cache_dir()
+    d.mkdir(parents=True, exist_ok=True)
+    blob = zlib.compress(
+        json.dumps({"url": url, "salvo_em": time.time(), "dados": value}).encode("utf-8"), 6
+    )
+    p = _path(_key(url, params))
+    tmp = p.with_suffix(f".tmp{threading.get_ident()}")
+    tmp.write_bytes(blob)
+    with _LOCK:
+        old = p.stat().st_size if p.exists() else 0
+        os.replace(tmp, p)
+        if _SIZE is None:
+            _SIZE = sum(f.stat().st_size for f in d.glob("*.json.z"))
+        else:
+            _SIZE += len(blob) - old
+        if _SIZE > max_bytes():
+            _evict(d)
+
+def _evict(d: Path) -> None:
+    """Remove os menos usados até ficar em 90% do limite (chamar com _LOCK)."""
+    global _SIZE
+    files = sorted(d.glob("*.json.z"), key=lambda f: f.stat().st_mtime)
+    target = int(max_bytes() * 0.9)
+    for f in files:
+        if _SIZE <= target:
+            break
+        try:
+            size = f.stat().st_size
+            f.unlink()
+            _SIZE -= size
+        except OSError:
+            continue
+
+def purge(pattern: Optional[str] = None) -> int:
+    """Apaga entradas do cache (todas, ou só as cuja URL contém `pattern`)."""
+    global _SIZE
+    d = cache_dir()
+    if not d.exists():
+        return 0
+    n = 0
+    with _LOCK:
+        for f in d.glob("*.json.z"):
+            if pattern:
+                try:
+                    url = json.loads(zlib.decompress(f.read_bytes())).get("url", "")
+                except (OSError, ValueError, zlib.error):
+                    url = ""
+                if pattern not in url:
+                    continue
+            try:
+                f.unlink()
+                n += 1
+            except OSError:
+                pass
+        _SIZE = None
+    return n
+
+def stats() -> dict:
+    d = cache_dir()
+    files = list(d.glob("*.json.z")) if d.exists() else []
+    return {
+        "habilitado": enabled(),
+        "diretorio": str(d),
+        "entradas": len(files),
+        "bytes": sum(f.stat().st_size for f in files),
+        "limite_bytes": max_bytes(),
+        "ttl_s": {name: ttl_for_rule(name) for name in TTL_RULES},
+    }
@@ -0,0 +1,236 @@
+"""
+Jobs de bootstrap/coleta/reprocessamento do dead-letter.
+
+Estado persistido em public.jobs (status, params, progresso, resultado). Só
+um job ativo por recurso (índice único parcial), então um segundo pedido
+concorrente é recusado — inclusive os síncronos (executar()), que passam pela
+mesma linha em vez de chamar a coleta direto. O job roda numa thread do processo
+da API (enqueue) ou na thread chamadora (executar) com o próprio ColetaProgresso;
+uma thread de monitoramento grava o progresso e o heartbeat a cada JOB_PROGRESS_S
+segundos e repassa o pedido de cancelamento gravado no banco só para esse job.
+"""
+import os
+import json
+import threading
+import importlib
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from db import get_engine
+from utils import breakers_status
+
+class JobDuplicado(Exception):
+    """Já existe um job ativo para o mesmo recurso."""
+
+def _logic():
+    return importlib.import_module("logic")
+
+def _run_bootstrap(p: dict, progresso):
+    return _logic().bootstrap_all(
+        p["data_dir"], p.get("groups"), p.get("modo", "ultimo"), _anos(p),
+        retomar=p.get("retomar", False), progresso=progresso,
+    )
+
+def _run_coleta(p: dict, progresso):
+    return _logic().run_coleta(
+        p.get("groups"), p.get("modo", "ultimo"), _anos(p), retomar=p.get("retomar", False), progresso=progresso
+    )
+
+def _run_dead_letter(p: dict, progresso):
+    return _logic().replay_dead_letters(grupo=p.get("grupo"), progresso=progresso)
+
+def _anos(p: dict):
+    return tuple(p["anos"]) if p.get("anos") else None
+
+# tipo -> (recurso travado, função)
+HANDLERS = {
+    "bootstrap": ("sidra", _run_bootstrap),
+    "coleta": ("sidra", _run_coleta),
+    "dead_letter": ("sidra", _run_dead_letter),
+}
+
+# progresso das execuções vivas neste processo (job_id -> ColetaProgresso)
+_ATIVOS: dict = {}
+_ATIVOS_LOCK = threading.Lock()
+
+def _interval() -> float:
+    return float(os.getenv("JOB_PROGRESS_S", "2"))
+
+def _dumps(v) -> str:
+    return json.dumps(v, default=str)
+
+def _expire_stale(engine) -> None:
+    """Jobs ativos sem heartbeat recente (processo reiniciado) deixam de travar o recurso."""
+    limite = max(30.0, _interval() * 15)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                UPDATE public.jobs
+                SET status = 'falhou', erro = 'Sem sinal de vida (processo reiniciado?)',
+                    finalizado_em = NOW()
+                WHERE status IN ('pendente', 'executando')
+                  AND COALESCE(heartbeat_em, criado_em) < NOW() - make_interval(secs => :s)
+                """
+            ),
+            {"s": limite},
+        )
+
+def _criar(tipo: str, params: dict, engine) -> int:
+    """Valida e insere o job; a linha ativa é a trava do recurso (JobDuplicado se já houver outra)."""
+    if tipo not in HANDLERS:
+        raise ValueError(f"Tipo de job desconhecido: {tipo}")
+    _logic()._check_modo(params.get("modo", "ultimo"), _anos(params))
+    recurso, _ = HANDLERS[tipo]
+    _expire_stale(engine)
+    try:
+        with engine.begin() as conn:
+            job_id = conn.execute(
+                text(
+                    "INSERT INTO public.jobs (tipo, recurso, status, params, heartbeat_em) "
+                    "VALUES (:t, :r, 'pendente', CAST(:p AS jsonb), NOW()) RETURNING id"
+                ),
+                {"t": tipo, "r": recurso, "p": _dumps(params)},
+            ).scalar_one()
+    except IntegrityError:
+        raise JobDuplicado(f"Já existe um job ativo para '{recurso}'.")
+    return int(job_id)
+
+def enqueue(tipo: str, params: dict, engine=None) -> int:
+    """Cria o job e o executa numa thread em segundo plano."""
+    engine = engine or get_engine()
+    job_id = _criar(tipo, params, engine)
+    threading.Thread(
+        target=_run, args=(int(job_id), tipo, params), daemon=True, name=f"job-{job_id}"
+    ).start()
+    return job_id
+
+def executar(tipo: str, params: dict, engine=None):
+    """
+    Cria o job e o executa na thread chamadora (endpoints síncronos, scripts): mesma
+    trava e mesmo registro em /jobs. Devolve o resultado ou relança a exceção do job.
+    """
+    engine = engine or get_engine()
+    job_id = _criar(tipo, params, engine)
+    out, erro = _run(job_id, tipo, params)
+    if erro is not None:
+        raise erro
+    return out
+
+def _update(engine, job_id: int, **cols) -> None:
+    sets = ", ".join(
+        f"{k} = CAST(:{k} AS jsonb)" if k in ("progresso", "resultado") else f"{k} = :{k}"
+        for k in cols
+    )
+    vals = {k: (_dumps(v) if k in ("progresso", "resultado") else v) for k, v in cols.items()}
+    with engine.begin() as conn:
+        conn.execute(text(f"UPDATE public.jobs SET {sets} WHERE id = :id"), {"id": job_id, **vals})
+
+def _monitor(engine, job_id: int, progresso, stop: threading.Event) -> None:
+    while not stop.wait(_interval()):
+        try:
+            with engine.begin() as conn:
+                cancelar = conn.execute(
+                    text(
+                        "UPDATE public.jobs SET progresso = CAST(:p AS jsonb), heartbeat_em = NOW() "
+                        "WHERE id = :id RETURNING cancelar"
+                    ),
+                    {"id": job_id, "p": _dumps(progresso.snapshot())},
+                ).scalar_one()
+            if cancelar:
+                progresso.cancelar()
+        except Exception as e:
+            print(f"[job {job_id}] falha ao gravar progresso: {e}")
+
+def _run(job_id: int, tipo: str, params: dict):
+    """Executa o job com um ColetaProgresso próprio; devolve (resultado, exceção)."""
+    engine = get_engine()
+    logic = _logic()
+    _, fn = HANDLERS[tipo]
+    progresso = logic.ColetaProgresso(job_id=job_id, tipo=tipo)
+    with _ATIVOS_LOCK:
+        _ATIVOS[job_id] = progresso
+    _update(engine, job_id, status="executando")
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE public.jobs SET iniciado_em = NOW() WHERE id = :id"), {"id": job_id})
+    stop = threading.Event()
+    mon = threading.Thread(
+        target=_monitor, args=(engine, job_id, progresso, stop), daemon=True, name=f"job-{job_id}-mon"
+    )
+    mon.start()
+    final, out, erro = {}, None, None
+    try:
+        out = fn(params, progresso)
+        final = {"status": "concluido", "resultado": {"upserts": out}}
+    except logic.ColetaCancelada as e:
+        erro = e
+        final = {"status": "cancelado"}
+    except Exception as e:
+        erro = e
+        final = {"status": "falhou", "erro": str(e)}
+    finally:
+        stop.set()
+        mon.join()
+        with _ATIVOS_LOCK:
+            _ATIVOS.pop(job_id, None)
+        _update(engine, job_id, progresso=progresso.snapshot(), **final)
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE public.jobs SET finalizado_em = NOW() WHERE id = :id"), {"id": job_id})
+    return out, erro
+
+def progresso_coleta(engine=None) -> dict:
+    """Progresso da execução em andamento; sem nenhuma, o último gravado de um job."""
+    with _ATIVOS_LOCK:
+        vivos = sorted(_ATIVOS.items())
+    if vivos:
+        snap = {**vivos[-1][1].snapshot(), "em_andamento": True}
+    else:
+        engine = engine or get_engine()
+        with engine.begin() as conn:
+            row = conn.execute(
+                text(
+                    "SELECT id, tipo, status, progresso FROM public.jobs "
+                    "WHERE recurso = 'sidra' ORDER BY id DESC LIMIT 1"
+                )
+            ).mappings().first()
+        snap = {**(row["progresso"] or {}), "job_id": row["id"], "tipo": row["tipo"], "status": row["status"]} if row else {}
+        snap["em_andamento"] = False
+    return {**snap, "circuito": breakers_status()}
+
+def get_job(job_id: int, engine=None) -> dict | None:
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        row = conn.execute(
+            text(
+                "SELECT id, tipo, status, params, progresso, resultado, erro, cancelar, "
+                "criado_em, iniciado_em, heartbeat_em, finalizado_em FROM public.jobs WHERE id = :id"
+            ),
+            {"id": job_id},
+        ).mappings().first()
+    return dict(row) if row else None
+
+def list_jobs(limit: int = 20, engine=None) -> list[dict]:
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT id, tipo, status, criado_em, iniciado_em, finalizado_em, erro "
+                "FROM public.jobs ORDER BY id DESC LIMIT :n"
+            ),
+            {"n": int(limit)},
+        ).mappings().all()
+    return [dict(r) for r in rows]
+
+def cancel_job(job_id: int, engine=None) -> bool:
+    """Marca o pedido de cancelamento; o monitor do job o repassa à coleta."""
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        res = conn.execute(
+            text(
+                "UPDATE public.jobs SET cancelar = TRUE "
+                "WHERE id = :id AND status IN ('pendente', 'executando')"
+            ),
+            {"id": job_id},
+        )
+    return res.rowcount > 0
@@ -1,18 +1,41 @@
+import io
 import os
+import re
+import ast
+import csv
+import json
+import hashlib
+import zipfile
+import tempfile
+import time
+import datetime
+import threading
+import multiprocessing
 from pathlib import Path
-from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import defaultdict, deque, namedtuple, Counter
 
 import pandas as pd
+import requests
 from sqlalchemy import text
-from rapidfuzz import fuzz, process as rf_process
 
-from db import get_engine, ensure_schema
-from utils import normalize_name, http_get_json, try_float
-from sidra_client import get_agregado_metadados, find_variavel_id, build_values_url
+from db import get_engine, ensure_schema, ensure_particoes_sidra
+from matcher import MunicipioMatcher
+from pipeline import Pipeline
+from utils import normalize_name, http_get_json
+from sidra_client import (
+    get_agregado_metadados, get_agregado_periodos, find_variavel_id, build_values_url,
+    plan_values_requests, parse_values_frame,
+)
 
 LOCALIDADES_BASE = "https://servicodados.ibge.gov.br/api/v1/localidades"
 UFS_SUL = {"RS": 43, "SC": 42, "PR": 41}
 
+def ufs_ativas() -> list[str]:
+    """UFs atendidas (planilha de filiais e casamento sem UF); env UFS_ATIVAS, padrão Sul."""
+    raw = os.getenv("UFS_ATIVAS") or ",".join(UFS_SUL)
+    return [u.strip().upper() for u in raw.split(",") if u.strip()]
+
 TARGETS = {
     "vegetal": [
         "milho", "soja", "trigo", "feijao", "arroz",
@@ -37,6 +60,52 @@ TABLES = {
 def ensure_all(engine=None):
     engine = engine or get_engine()
     ensure_schema(engine)
+    sync_dim_grupo(engine)
+    # instalação existente: a dimensão exclusiva nasce vazia até o próximo casamento
+    refresh_dim_filial_exclusiva(engine)
+
+def sync_dim_grupo(engine=None) -> None:
+    """dim_grupo_sidra = TABLES (tabela SIDRA -> grupo)."""
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO public.dim_grupo_sidra (tabela, grupo) VALUES (:t, :g) "
+                "ON CONFLICT (tabela) DO UPDATE SET grupo = EXCLUDED.grupo "
+                "WHERE public.dim_grupo_sidra.grupo <> EXCLUDED.grupo"
+            ),
+            [{"t": int(v["table_id"]), "g": g} for g, v in TABLES.items()],
+        )
+
+def refresh_dim_filial_exclusiva(engine=None) -> int:
+    """
+    Recalcula dim_municipio_filial_exclusiva (cada código IBGE -> primeira filial em
+    ordem alfabética) gravando só o que mudou. Chamada sempre que os códigos de
+    municipios_filiais mudam (casamento/correções). Retorna linhas alteradas.
+    """
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        n = conn.execute(
+            text(
+                """
+                INSERT INTO public.dim_municipio_filial_exclusiva AS d (codigo_ibge, filial, nome_municipio)
+                SELECT DISTINCT ON (codigo_ibge) codigo_ibge, filial, nome_municipio
+                FROM public.municipios_filiais
+                WHERE codigo_ibge IS NOT NULL
+                ORDER BY codigo_ibge, filial
+                ON CONFLICT (codigo_ibge) DO UPDATE SET
+                    filial = EXCLUDED.filial, nome_municipio = EXCLUDED.nome_municipio, atualizado_em = NOW()
+                WHERE (d.filial, d.nome_municipio) IS DISTINCT FROM (EXCLUDED.filial, EXCLUDED.nome_municipio)
+                """
+            )
+        ).rowcount
+        n += conn.execute(
+            text(
+                "DELETE FROM public.dim_municipio_filial_exclusiva d WHERE NOT EXISTS ("
+                "SELECT 1 FROM public.municipios_filiais m WHERE m.codigo_ibge = d.codigo_ibge)"
+            )
+        ).rowcount
+    return n
 
 def get_engine():
     from db import get_engine as ge
@@ -70,7 +139,7 @@ def load_municipios_filiais_from_excel(xlsx_path: str) -> pd.DataFrame:
     out["uf"] = df[c_uf].astype(str).str.strip().str.upper() if c_uf else None
 
     if out["uf"] is not None and out["uf"].notna().any():
-        out = out[out["uf"].isin(["RS", "SC", "PR"]) | out["uf"].isna()].copy()
+        out = out[out["uf"].isin(ufs_ativas()) | out["uf"].isna()].copy()
 
     out["nome_normalizado"] = out["nome_municipio"].map(lambda x: normalize_name(str(x)))
     out.drop_duplicates(subset=["filial", "nome_municipio"], inplace=True)
@@ -95,83 +164,472 @@ def upsert_municipios_filiais(df: pd.DataFrame, engine=None):
                 row,
             )
 
-def fetch_municipios_ibge_rs_sc_pr() -> pd.DataFrame:
-    out = []
-    for uf_sigla, uf_id in UFS_SUL.items():
-        url = f"{LOCALIDADES_BASE}/estados/{uf_id}/municipios"
-        js = http_get_json(url)
-        for m in js:
-            out.append(
+def _uf_do_municipio(m: dict) -> dict:
+    """UF (sigla/id/região) de um item de /localidades/municipios; microrregião pode vir nula."""
+    for path in (("microrregiao", "mesorregiao", "UF"), ("regiao-imediata", "regiao-intermediaria", "UF")):
+        node = m
+        for k in path:
+            node = (node or {}).get(k)
+        if node:
+            return node
+    return {}
+
+def refresh_municipios_ibge(engine=None) -> dict:
+    """
+    Baixa (uma chamada) todos os municípios do Brasil e atualiza municipios_ibge,
+    registrando a versão (data da busca) em municipios_ibge_versoes.
+    """
+    engine = engine or get_engine()
+    js = http_get_json(f"{LOCALIDADES_BASE}/municipios", use_cache=False)
+    versao = datetime.date.today()
+    rows = []
+    for m in js:
+        uf = _uf_do_municipio(m)
+        if not uf.get("sigla"):
+            continue
+        rows.append({
+            "cod": int(m["id"]),
+            "nome": m["nome"],
+            "norm": normalize_name(m["nome"]),
+            "uf": uf["sigla"],
+            "uf_id": uf.get("id"),
+            "regiao": (uf.get("regiao") or {}).get("nome"),
+            "versao": versao,
+        })
+    if not rows:
+        raise RuntimeError("Resposta vazia de /localidades/municipios.")
+
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO public.municipios_ibge
+                    (codigo_ibge, nome, nome_normalizado, uf, uf_id, regiao, versao)
+                VALUES (:cod, :nome, :norm, :uf, :uf_id, :regiao, :versao)
+                ON CONFLICT (codigo_ibge) DO UPDATE SET
+                    nome = EXCLUDED.nome,
+                    nome_normalizado = EXCLUDED.nome_normalizado,
+                    uf = EXCLUDED.uf,
+                    uf_id = EXCLUDED.uf_id,
+                    regiao = EXCLUDED.regiao,
+                    versao = EXCLUDED.versao
+                """
+            ),
+            rows,
+        )
+        removidos = conn.execute(
+            text("DELETE FROM public.municipios_ibge WHERE versao < :v"), {"v": versao}
+        ).rowcount
+        ufs = len({r["uf"] for r in rows})
+        conn.execute(
+            text(
+                """
+                INSERT INTO public.municipios_ibge_versoes (versao, buscado_em, total, ufs, removidos)
+                VALUES (:v, NOW(), :t, :u, :r)
+                ON CONFLICT (versao) DO UPDATE SET
+                    buscado_em = NOW(), total = EXCLUDED.total, ufs = EXCLUDED.ufs,
+                    removidos = EXCLUDED.removidos
+                """
+            ),
+            {"v": versao, "t": len(rows), "u": ufs, "r": removidos},
+        )
+        # dados já coletados sem UF passam a tê-la
+        conn.execute(
+            text(
+                "UPDATE public.dados_sidra_brutos d SET uf = mi.uf "
+                "FROM public.municipios_ibge mi "
+                "WHERE d.uf IS NULL AND mi.codigo_ibge = d.cod_municipio"
+            )
+        )
+    return {"versao": versao.isoformat(), "municipios": len(rows), "ufs": ufs, "removidos": removidos}
+
+def load_municipios_ibge(engine=None, ufs: list[str] | None = None) -> pd.DataFrame:
+    """Municípios do IBGE a partir da tabela local (busca na API só se ela estiver vazia)."""
+    engine = engine or get_engine()
+    sql = "SELECT uf, codigo_ibge, nome AS nome_municipio, nome_normalizado FROM public.municipios_ibge"
+    params = {}
+    if ufs:
+        sql += " WHERE uf = ANY(:ufs)"
+        params["ufs"] = list(ufs)
+    with engine.begin() as conn:
+        vazia = conn.execute(text("SELECT NOT EXISTS (SELECT 1 FROM public.municipios_ibge)")).scalar_one()
+    if vazia:
+        refresh_municipios_ibge(engine)
+    with engine.begin() as conn:
+        return pd.read_sql(text(sql + " ORDER BY uf, codigo_ibge"), conn, params=params)
+
+def list_versoes_municipios_ibge(engine=None) -> list[dict]:
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT versao, buscado_em, total, ufs, removidos "
+                "FROM public.municipios_ibge_versoes ORDER BY versao DESC"
+            )
+        ).mappings().all()
+    return [dict(r) for r in rows]
+
+def _apply_matches(engine, matches) -> int:
+    """Grava (id, codigo_ibge, uf, ...) em municipios_filiais num único UPDATE set-based."""
+    if not matches:
+        return 0
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                UPDATE public.municipios_filiais m
+                SET codigo_ibge = u.cod, uf = u.uf
+                FROM unnest(CAST(:ids AS integer[]), CAST(:cods AS integer[]), CAST(:ufs AS varchar[]))
+                     AS u(id, cod, uf)
+                WHERE m.id = u.id
+                """
+            ),
+            {
+                "ids": [int(m[0]) for m in matches],
+                "cods": [int(m[1]) for m in matches],
+                "ufs": [m[2] for m in matches],
+            },
+        )
+    return len(matches)
+
+def _save_aliases(engine, aliases) -> int:
+    """
+    aliases: [(uf, nome_normalizado, codigo_ibge, uf_ibge, score, fonte[, versao_ibge])];
+    manual nunca é sobrescrito, e 'sem_match' (codigo_ibge None) só substitui outro 'sem_match'.
+    """
+    if not aliases:
+        return 0
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO public.municipios_alias
+                    (uf, nome_normalizado, codigo_ibge, uf_ibge, score, fonte, versao_ibge, atualizado_em)
+                VALUES (:uf, :nome, :cod, :uf_ibge, :score, :fonte, :versao, NOW())
+                ON CONFLICT (uf, nome_normalizado) DO UPDATE SET
+                    codigo_ibge = EXCLUDED.codigo_ibge,
+                    uf_ibge = EXCLUDED.uf_ibge,
+                    score = EXCLUDED.score,
+                    fonte = EXCLUDED.fonte,
+                    versao_ibge = EXCLUDED.versao_ibge,
+                    atualizado_em = NOW()
+                WHERE (public.municipios_alias.fonte <> 'manual' OR EXCLUDED.fonte = 'manual')
+                  AND (EXCLUDED.fonte <> 'sem_match' OR public.municipios_alias.fonte = 'sem_match')
+                """
+            ),
+            [
                 {
-                    "uf": uf_sigla,
-                    "codigo_ibge": int(m["id"]),
-                    "nome_municipio": m["nome"],
-                    "nome_normalizado": normalize_name(m["nome"]),
+                    "uf": a[0] or "", "nome": a[1], "cod": None if a[2] is None else int(a[2]),
+                    "uf_ibge": a[3], "score": a[4], "fonte": a[5], "versao": a[6] if len(a) > 6 else None,
                 }
+                for a in aliases
+            ],
+        )
+    return len(aliases)
+
+def _apply_aliases(engine) -> int:
+    """Resolve, com um único UPDATE ... FROM, todos os nomes já presentes em municipios_alias."""
+    with engine.begin() as conn:
+        res = conn.execute(
+            text(
+                """
+                UPDATE public.municipios_filiais m
+                SET codigo_ibge = a.codigo_ibge, uf = COALESCE(a.uf_ibge, m.uf)
+                FROM public.municipios_alias a
+                WHERE a.uf = COALESCE(m.uf, '')
+                  AND a.nome_normalizado = m.nome_normalizado
+                  AND a.codigo_ibge IS NOT NULL
+                  AND (m.codigo_ibge IS DISTINCT FROM a.codigo_ibge
+                       OR m.uf IS DISTINCT FROM COALESCE(a.uf_ibge, m.uf))
+                """
             )
-    return pd.DataFrame(out)
+        )
+    return res.rowcount
 
 def match_cods_ibge(engine=None, score_threshold: int = 88):
+    """
+    1) nomes já conhecidos (municipios_alias) resolvidos por join;
+    2) só nomes nunca vistos vão ao matcher (contra a tabela local municipios_ibge);
+    3) resultados viram aliases para as próximas execuções; os que não casam ficam
+       como 'sem_match' e só voltam ao matcher quando municipios_ibge ganha versão nova.
+    """
     engine = engine or get_engine()
-    df_ibge = fetch_municipios_ibge_rs_sc_pr()
+    n = _apply_aliases(engine)
+    try:
+        return n + _match_novos(engine, score_threshold)
+    finally:
+        refresh_dim_filial_exclusiva(engine)
+
+def _match_novos(engine, score_threshold: int) -> int:
+    """
+    Casa (e grava como alias) os nomes sem alias e os 'sem_match' testados contra
+    uma versão anterior de municipios_ibge.
+    """
     with engine.begin() as conn:
         rows = conn.execute(
             text(
-                "SELECT id, filial, nome_municipio, COALESCE(uf,''), nome_normalizado "
-                "FROM public.municipios_filiais"
+                "SELECT m.id, COALESCE(m.uf,''), m.nome_normalizado "
+                "FROM public.municipios_filiais m "
+                "LEFT JOIN public.municipios_alias a "
+                "  ON a.uf = COALESCE(m.uf,'') AND a.nome_normalizado = m.nome_normalizado "
+                "WHERE a.nome_normalizado IS NULL "
+                "   OR (a.fonte = 'sem_match' AND a.versao_ibge IS DISTINCT FROM "
+                "       (SELECT MAX(versao) FROM public.municipios_ibge))"
             )
         ).fetchall()
-
-    updates = []
-    for rid, filial, nome_municipio, uf, nome_norm in rows:
-        pool = df_ibge[df_ibge["uf"] == uf] if uf else df_ibge
-        if pool.empty:
-            continue
-        choices = pool["nome_normalizado"].tolist()
-        match = rf_process.extractOne(nome_norm, choices, scorer=fuzz.WRatio)
-        if match:
-            _, score, idx = match
-            if score >= score_threshold:
-                row = pool.iloc[idx]
-                updates.append((rid, int(row["codigo_ibge"]), row["uf"]))
-
-    if not updates:
+    if not rows:
         return 0
 
+    # linhas com UF casam dentro da própria UF; sem UF, só entre as UFs ativas
+    ufs = sorted({r[1] for r in rows if r[1]} | set(ufs_ativas()))
+    df_ibge = load_municipios_ibge(engine, ufs)
     with engine.begin() as conn:
-        for rid, cod, uf in updates:
-            conn.execute(
-                text("UPDATE public.municipios_filiais SET codigo_ibge=:c, uf=:u WHERE id=:r"),
-                {"c": cod, "u": uf, "r": rid},
-            )
-    return len(updates)
+        versao = conn.execute(text("SELECT MAX(versao) FROM public.municipios_ibge")).scalar()
+    matcher = MunicipioMatcher(df_ibge, score_threshold=score_threshold, ufs_sem_uf=ufs_ativas())
+    matches = matcher.match(rows)
+    chave = {r[0]: (r[1], r[2]) for r in rows}
+    aliases = []
+    for rid, cod, uf_ibge, score, fonte in matches:
+        uf, nome = chave[rid]
+        aliases.append((uf, nome, cod, uf_ibge, score, fonte))
+        if uf != uf_ibge:
+            aliases.append((uf_ibge, nome, cod, uf_ibge, score, fonte))
+    casados = {m[0] for m in matches}
+    sem_match = {chave[r[0]] for r in rows if r[0] not in casados}
+    aliases += [(uf, nome, None, None, None, "sem_match", versao) for uf, nome in sorted(sem_match)]
+    _save_aliases(engine, aliases)
+    return _apply_matches(engine, matches)
+
+def _expand_cell(v) -> list[str]:
+    """Células do lookup.xlsx podem vir como lista serializada ("['A', 'B']")."""
+    if v is None or (isinstance(v, float) and pd.isna(v)):
+        return []
+    s = str(v).strip()
+    if s.startswith("[") and s.endswith("]"):
+        try:
+            return [str(x) for x in ast.literal_eval(s)]
+        except (ValueError, SyntaxError):
+            pass
+    return [s] if s else []
+
+def import_aliases_manuais(df: pd.DataFrame, engine=None) -> int:
+    """
+    Correções manuais (ex.: lookup.xlsx revisado): colunas uf, nome_municipio e
+    codigo_ibge. Viram aliases 'manual', que têm prioridade sobre exato/fuzzy.
+    """
+    engine = engine or get_engine()
+    cols = {str(c).strip().lower(): c for c in df.columns}
+    c_mun = next((cols[c] for c in ("nome_municipio", "municipio", "município", "nome_preferido") if c in cols), None)
+    c_cod = cols.get("codigo_ibge")
+    c_uf = cols.get("uf")
+    if not (c_mun and c_cod):
+        raise ValueError("Correções precisam das colunas 'nome_municipio' e 'codigo_ibge'.")
+
+    aliases = []
+    for row in df.to_dict("records"):
+        cod = pd.to_numeric(row.get(c_cod), errors="coerce")
+        if pd.isna(cod):
+            continue
+        ufs = [u.upper() for u in _expand_cell(row.get(c_uf))] if c_uf else []
+        for nome in _expand_cell(row.get(c_mun)):
+            for uf in ufs or [""]:
+                aliases.append((uf, normalize_name(nome), int(cod), uf or None, 100.0, "manual"))
+    _save_aliases(engine, aliases)
+    _apply_aliases(engine)
+    refresh_dim_filial_exclusiva(engine)
+    return len(aliases)
 
 # ---------------- coleta SIDRA ----------------
 
-def _chunk(lst, n):
-    return [lst[i:i + n] for i in range(0, len(lst), n)]
+SIDRA_COLS = (
+    "tabela", "variavel", "ano", "cod_municipio", "nome_municipio", "uf",
+    "produto_codigo", "produto_nome", "unidade", "valor_str", "valor_num",
+)
+SIDRA_KEY = ("tabela", "variavel", "ano", "cod_municipio", "produto_codigo")
+
+def _sidra_batch_size() -> int:
+    return max(1, int(os.getenv("SIDRA_BATCH_SIZE", "5000")))
 
-def _upsert_sidra_rows(engine, recs):
-    if not recs:
+def _recs_to_csv(recs: pd.DataFrame) -> io.StringIO:
+    buf = io.StringIO()
+    recs[list(SIDRA_COLS)].to_csv(buf, header=False, index=False, na_rep=r"\N")
+    buf.seek(0)
+    return buf
+
+def _upsert_sidra_rows(engine, recs, checkpoints=None, execucao_id: int | None = None):
+    """
+    Grava um lote (lista de dicts ou DataFrame) em dados_sidra_brutos numa única
+    transação: COPY para uma staging temporária + um INSERT ... ON CONFLICT set-based.
+    Só escreve linhas novas ou cujo valor mudou (valor igual não gera tupla nova nem
+    WAL); cada escrita vai para sidra_changelog (antes -> depois, execução).
+    checkpoints: [(id, linhas, falhas)] de coleta_checkpoints marcados como
+    concluídos na mesma transação (só contam se os dados foram gravados).
+    Retorna o número de linhas inseridas/alteradas.
+    """
+    if len(recs) == 0 and not checkpoints:
         return 0
-    with engine.begin() as conn:
-        for r in recs:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO public.dados_sidra_brutos
-                        (tabela, variavel, ano, cod_municipio, nome_municipio, uf,
-                         produto_codigo, produto_nome, unidade, valor_str, valor_num, origem)
-                    VALUES
-                        (:tabela, :variavel, :ano, :cod_municipio, :nome_municipio, :uf,
-                         :produto_codigo, :produto_nome, :unidade, :valor_str, :valor_num, 'SIDRA')
-                    ON CONFLICT (tabela, variavel, ano, cod_municipio, produto_codigo)
-                    DO UPDATE SET valor_str = EXCLUDED.valor_str, valor_num = EXCLUDED.valor_num
-                    """
-                ),
-                r,
+    cols = ", ".join(SIDRA_COLS)
+    key = ", ".join(SIDRA_KEY)
+    # UF e nome vêm da referência local municipios_ibge quando a resposta não traz
+    fill = {
+        "uf": "COALESCE(s.uf, mi.uf)",
+        "nome_municipio": "COALESCE(NULLIF(s.nome_municipio, ''), mi.nome, '')",
+    }
+    sel = ", ".join(fill.get(c, f"s.{c}") for c in SIDRA_COLS)
+    skey = ", ".join(f"s.{c}" for c in SIDRA_KEY)
+    dkey = ", ".join(f"d.{c}" for c in SIDRA_KEY)
+    using = ", ".join(SIDRA_KEY)
+    if len(recs):
+        if not isinstance(recs, pd.DataFrame):
+            recs = pd.DataFrame(list(recs), columns=list(SIDRA_COLS))
+        # tabela particionada: cria antes do COPY as partições de anos (e tabelas) novos
+        ensure_particoes_sidra(engine, recs[["ano", "tabela"]].drop_duplicates().itertuples(index=False))
+    raw = engine.raw_connection()
+    n = 0
+    try:
+        cur = raw.cursor()
+        if checkpoints:
+            ids, linhas, falhas = (list(x) for x in zip(*checkpoints))
+            cur.execute(
+                """
+                UPDATE public.coleta_checkpoints c
+                SET status = 'concluida', linhas = u.linhas, falhas = u.falhas, concluido_em = NOW()
+                FROM unnest(%s::bigint[], %s::int[], %s::int[]) AS u(id, linhas, falhas)
+                WHERE c.id = u.id
+                """,
+                (ids, linhas, falhas),
+            )
+        if len(recs) == 0:
+            raw.commit()
+            return 0
+        cur.execute(
+            """
+            CREATE TEMP TABLE _stg_sidra (
+                tabela INTEGER, variavel INTEGER, ano INTEGER, cod_municipio INTEGER,
+                nome_municipio VARCHAR(160), uf CHAR(2), produto_codigo INTEGER,
+                produto_nome VARCHAR(200), unidade VARCHAR(64),
+                valor_str VARCHAR(64), valor_num DOUBLE PRECISION
+            ) ON COMMIT DROP
+            """
+        )
+        cur.copy_expert(
+            f"COPY _stg_sidra ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            _recs_to_csv(recs),
+        )
+        # DISTINCT ON: ON CONFLICT não aceita a mesma chave duas vezes no mesmo comando.
+        # `antes` lê o valor anterior no mesmo snapshot do INSERT; sem linha em `antes` -> nova
+        # (xmax não está disponível no RETURNING de tabela particionada).
+        cur.execute(
+            f"""
+            WITH antes AS (
+                SELECT {dkey}, d.valor_str, d.valor_num
+                FROM public.dados_sidra_brutos d
+                JOIN (SELECT DISTINCT {using} FROM _stg_sidra) k USING ({using})
+            ),
+            gravadas AS (
+                INSERT INTO public.dados_sidra_brutos AS d ({cols}, origem)
+                SELECT DISTINCT ON ({skey}) {sel}, 'SIDRA'
+                FROM _stg_sidra s
+                LEFT JOIN public.municipios_ibge mi ON mi.codigo_ibge = s.cod_municipio
+                ORDER BY {skey}
+                ON CONFLICT ({key})
+                DO UPDATE SET valor_str = EXCLUDED.valor_str, valor_num = EXCLUDED.valor_num,
+                              coleta_em = NOW()
+                WHERE (d.valor_str, d.valor_num) IS DISTINCT FROM (EXCLUDED.valor_str, EXCLUDED.valor_num)
+                RETURNING {dkey}, d.valor_str, d.valor_num
+            )
+            INSERT INTO public.sidra_changelog
+                ({using}, valor_str_ant, valor_num_ant, valor_str, valor_num, nova, execucao_id)
+            SELECT {", ".join(f"g.{c}" for c in SIDRA_KEY)}, a.valor_str, a.valor_num,
+                   g.valor_str, g.valor_num, a.tabela IS NULL, %s
+            FROM gravadas g
+            LEFT JOIN antes a USING ({using})
+            """,
+            (execucao_id,),
+        )
+        n = cur.rowcount
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+    return int(n)
+
+class SidraBulkWriter:
+    """
+    Acumula registros de dados_sidra_brutos (dicts ou DataFrames com SIDRA_COLS)
+    e grava em lotes de `batch_size` (env SIDRA_BATCH_SIZE, padrão 5000), medindo linhas/s.
+    `rows` = linhas inseridas/alteradas; `enviadas` = todas as recebidas (inclui as iguais).
+    """
+
+    def __init__(
+        self, engine, batch_size: int | None = None, label: str = "", verbose: bool = True,
+        execucao_id: int | None = None,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size or _sidra_batch_size()
+        self.execucao_id = execucao_id
+        self.label = label
+        self.verbose = verbose
+        self.buffer = []
+        self.buffered = 0
+        self.checkpoints = []
+        self.rows = 0
+        self.enviadas = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.enviadas / self.seconds if self.seconds else 0.0
+
+    def extend(self, recs):
+        if not isinstance(recs, pd.DataFrame):
+            recs = pd.DataFrame(list(recs), columns=list(SIDRA_COLS))
+        if recs.empty:
+            return
+        self.buffer.append(recs)
+        self.buffered += len(recs)
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def marcar(self, checkpoint_id: int, linhas: int, falhas: int = 0):
+        """Checkpoint concluído: gravado junto com o próximo lote (depois dos seus dados)."""
+        self.checkpoints.append((int(checkpoint_id), int(linhas), int(falhas)))
+
+    def flush(self) -> int:
+        if not self.buffer:
+            if self.checkpoints:
+                _upsert_sidra_rows(self.engine, [], self.checkpoints, self.execucao_id)
+                self.checkpoints = []
+            return 0
+        recs = pd.concat(self.buffer, ignore_index=True)
+        cks = self.checkpoints
+        self.buffer, self.buffered, self.checkpoints = [], 0, []
+        t0 = time.perf_counter()
+        n = _upsert_sidra_rows(self.engine, recs, cks, self.execucao_id)
+        dt = time.perf_counter() - t0
+        self.rows += n
+        self.enviadas += len(recs)
+        self.batches += 1
+        self.seconds += dt
+        if self.verbose:
+            rate = len(recs) / dt if dt else 0.0
+            print(
+                f"[{self.label}] lote {self.batches}: {len(recs)} linhas, {n} novas/alteradas "
+                f"em {dt:.2f}s ({rate:.0f} linhas/s)"
+            )
+        return n
+
+    def close(self) -> int:
+        self.flush()
+        if self.verbose and self.batches:
+            print(
+                f"[{self.label}] {self.enviadas} linhas em {self.batches} lotes, {self.rows} novas/alteradas "
+                f"({self.rows_per_s:.0f} linhas/s no banco)"
             )
-    return len(recs)
+        return self.rows
 
 def _pick_targets_in_class(meta_class, group_name: str):
     targets_norm = [normalize_name(t) for t in TARGETS[group_name]]
@@ -191,8 +649,373 @@ def _pick_targets_in_class(meta_class, group_name: str):
             sel[class_id] = keep
     return sel
 
-def collect_sidra_for_group(group_name: str, engine=None, verbose: bool = True) -> int:
-    engine = engine or get_engine()
+class ColetaCancelada(Exception):
+    """Coleta interrompida a pedido (ex.: POST /jobs/{id}/cancel)."""
+
+class ColetaProgresso:
+    """
+    Contadores de uma execução da coleta (thread-safe), lidos por /coleta/progresso
+    e pelo job dono dela; também carrega o pedido de cancelamento. Um objeto por
+    execução (jobs.py cria e registra), nunca compartilhado entre execuções.
+    """
+
+    def __init__(self, **extra):
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._data = {
+            "etapa": None,
+            "grupo": None,
+            "iniciado_em": time.time(),
+            "requisicoes_total": 0,
+            "requisicoes_ok": 0,
+            "requisicoes_falha": 0,
+            "linhas_lidas": 0,
+            "linhas_gravadas": 0,
+            **extra,
+        }
+
+    def set(self, **kw):
+        with self._lock:
+            self._data.update(kw)
+
+    def inc(self, **kw):
+        with self._lock:
+            for k, v in kw.items():
+                self._data[k] = self._data.get(k, 0) + v
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snap = dict(self._data)
+        snap["decorrido_s"] = round(time.time() - snap["iniciado_em"], 1)
+        return snap
+
+    def cancelar(self):
+        self._cancel.set()
+
+    def check_cancel(self):
+        if self._cancel.is_set():
+            raise ColetaCancelada("Coleta cancelada.")
+
+def _sidra_workers() -> int:
+    return max(1, int(os.getenv("SIDRA_WORKERS", "4")))
+
+def _sidra_fila(workers: int) -> int:
+    """Itens por fila entre os estágios da coleta (SIDRA_FILA; padrão 2*workers)."""
+    return max(1, int(os.getenv("SIDRA_FILA", str(2 * workers))))
+
+# raiz: id em coleta_checkpoints da requisição planejada (as metades herdam)
+Unidade = namedtuple(
+    "Unidade", "class_id bloco periodos municipios categorias url profundidade raiz", defaults=(None,)
+)
+
+def _sidra_tentativas_valores() -> int:
+    """Tentativas por URL /values: poucas, porque a falha é tratada dividindo a requisição."""
+    return max(1, int(os.getenv("SIDRA_TENTATIVAS_VALORES", "3")))
+
+def _fetch_one(u):
+    return http_get_json(u.url, tentativas=_sidra_tentativas_valores())
+
+def _fetch_units(units: deque, workers: int):
+    """
+    Busca as unidades da fila e gera (unidade, json, erro) conforme concluem.
+    A fila pode receber novas unidades enquanto é consumida (ex.: metades de uma
+    requisição que falhou). workers=1 mantém o modo sequencial; acima disso usa
+    um pool de threads com no máximo 2*workers requisições em voo.
+    """
+    if workers <= 1:
+        while units:
+            u = units.popleft()
+            try:
+                yield u, _fetch_one(u), None
+            except Exception as e:
+                yield u, None, e
+        return
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sidra") as ex:
+        while units and len(pending) < 2 * workers:
+            u = units.popleft()
+            pending[ex.submit(_fetch_one, u)] = u
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                u = pending.pop(fut)
+                err = fut.exception()
+                yield u, (None if err else fut.result()), err
+            while units and len(pending) < 2 * workers:
+                u = units.popleft()
+                pending[ex.submit(_fetch_one, u)] = u
+
+def _split_unit(u: Unidade, table_id: int, var_id: int) -> list[Unidade]:
+    """Divide a unidade ao meio na maior dimensão (municípios, categorias ou períodos)."""
+    dims = {"municipios": u.municipios, "categorias": u.categorias, "periodos": u.periodos}
+    nome, lst = max(dims.items(), key=lambda kv: len(kv[1]))
+    if len(lst) <= 1:
+        return []
+    meio = len(lst) // 2
+    out = []
+    for parte in (lst[:meio], lst[meio:]):
+        d = {**dims, nome: parte}
+        url = build_values_url(
+            table_id, var_id, "n6", d["municipios"], u.class_id, d["categorias"] or None,
+            periodo="|".join(d["periodos"]),
+        )
+        out.append(u._replace(url=url, profundidade=u.profundidade + 1, **{nome: parte}))
+    return out
+
+def _dead_letter(engine, grupo: str, table_id: int, var_id: int, u: Unidade, err: BaseException):
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO public.sidra_dead_letter
+                    (grupo, tabela, variavel, classificacao, periodos, municipios, categorias, url, erro)
+                VALUES (:g, :t, :v, :c, :p, :m, :k, :url, :erro)
+                ON CONFLICT (url) DO UPDATE SET
+                    erro = EXCLUDED.erro,
+                    tentativas = public.sidra_dead_letter.tentativas + 1,
+                    criado_em = NOW(),
+                    reprocessado_em = NULL
+                """
+            ),
+            {
+                "g": grupo, "t": table_id, "v": var_id, "c": u.class_id,
+                "p": "|".join(u.periodos),
+                "m": ",".join(str(x) for x in u.municipios),
+                "k": ",".join(str(x) for x in u.categorias),
+                "url": u.url, "erro": str(err)[:1000],
+            },
+        )
+
+def _executar_unidades(
+    grupo: str,
+    table_id: int,
+    var_id: int,
+    cats_por_classe: dict,
+    units: list[Unidade],
+    writer,
+    engine,
+    workers: int,
+    verbose: bool = True,
+    on_bloco_concluido=None,
+    progresso: ColetaProgresso | None = None,
+    falhas_anteriores: Counter | None = None,
+) -> dict:
+    """
+    Busca, interpreta e grava as unidades em pipeline (busca -> interpretação ->
+    gravação, com filas limitadas entre os estágios: Postgres lento segura as
+    requisições em vez de acumular respostas em memória). Falhas de requisição (4xx/5xx/timeout)
+    são divididas ao meio até SIDRA_SPLIT_MAX_PROFUNDIDADE; o que não der certo
+    (ou falha de conexão com o host fora) vai para sidra_dead_letter.
+    on_bloco_concluido(class_id, bloco, sem_falhas) é chamado quando todas as
+    unidades de um bloco (inclusive as divididas) terminam; falhas_anteriores
+    (retomada) conta as falhas de requisições do bloco concluídas antes.
+    """
+    progresso = progresso or ColetaProgresso()
+    max_prof = int(os.getenv("SIDRA_SPLIT_MAX_PROFUNDIDADE", "6"))
+    fila = deque(units)
+    pendentes = Counter((u.class_id, u.bloco) for u in units)
+    falhas = Counter(falhas_anteriores or {})
+    stats = Counter()
+    # checkpoints: requisição planejada fecha quando ela (ou todas as suas metades) termina
+    por_raiz = Counter(u.raiz for u in units if u.raiz is not None)
+    linhas_raiz, falhas_raiz = Counter(), Counter()
+
+    def _buscar():
+        # thread de busca: trata as falhas aqui (as metades voltam para a fila de requisições)
+        for u, js, err in _fetch_units(fila, workers):
+            progresso.check_cancel()
+            if err is None:
+                yield u, "ok", js
+                continue
+            progresso.inc(requisicoes_falha=1)
+            filhos = []
+            if u.profundidade < max_prof and not isinstance(err, requests.exceptions.ConnectionError):
+                filhos = _split_unit(u, table_id, var_id)
+            if filhos:
+                progresso.inc(requisicoes_total=len(filhos), requisicoes_divididas=1)
+                # o aviso passa pelas filas antes das metades, então o bloco não fecha antes da hora
+                yield u, "dividida", len(filhos)
+                fila.extend(filhos)
+            else:
+                progresso.inc(dead_letter=1)
+                if verbose:
+                    print(f"[{grupo}] Falha HTTP em {u.url}: {err} (enviada ao dead-letter)")
+                _dead_letter(engine, grupo, table_id, var_id, u, err)
+                yield u, "falha", err
+
+    def _interpretar(item):
+        u, tipo, payload = item
+        if tipo == "ok":
+            payload = _parse_values_rows(
+                payload, table_id, var_id, cats_por_classe.get(u.class_id, {}), set(u.municipios), set(u.categorias)
+            )
+        return u, tipo, payload
+
+    def _gravar(item):
+        u, tipo, payload = item
+        progresso.check_cancel()
+        key = (u.class_id, u.bloco)
+        if tipo == "ok":
+            writer.extend(payload)
+            stats["ok"] += 1
+            linhas_raiz[u.raiz] += len(payload)
+            progresso.inc(requisicoes_ok=1, linhas_lidas=len(payload))
+            progresso.set(linhas_gravadas_grupo=writer.rows)
+        elif tipo == "dividida":
+            stats["divididas"] += 1
+            pendentes[key] += payload
+            por_raiz[u.raiz] += payload
+        else:
+            stats["dead_letter"] += 1
+            falhas[key] += 1
+            falhas_raiz[u.raiz] += 1
+        if u.raiz is not None:
+            por_raiz[u.raiz] -= 1
+            if por_raiz[u.raiz] == 0:
+                writer.marcar(u.raiz, linhas_raiz.pop(u.raiz, 0), falhas_raiz.pop(u.raiz, 0))
+        pendentes[key] -= 1
+        if pendentes[key] == 0 and on_bloco_concluido:
+            on_bloco_concluido(u.class_id, u.bloco, not falhas[key])
+
+    pipe = Pipeline(
+        [("busca", _buscar), ("interpretacao", _interpretar), ("gravacao", _gravar)],
+        maxsize=_sidra_fila(workers),
+        on_metricas=lambda m: progresso.set(pipeline=m),
+    )
+    m = pipe.run()
+    if verbose:
+        e = m["estagios"]
+        print(
+            f"[{grupo}] pipeline: busca {e['busca']['itens_s']}/s, "
+            f"interpretação {e['interpretacao']['itens_s']}/s, gravação {e['gravacao']['itens_s']}/s "
+            f"(gargalo: {m['gargalo']})"
+        )
+    return dict(stats)
+
+def _parse_values_rows(js, table_id: int, var_id: int, cats: dict, mset: set, pset: set) -> pd.DataFrame:
+    """Resposta /values -> DataFrame com as colunas de dados_sidra_brutos (SIDRA_COLS)."""
+    df = parse_values_frame(js, mset, pset)
+    df["tabela"] = table_id
+    df["variavel"] = int(var_id)
+    df["uf"] = None
+    df["produto_nome"] = df["produto_codigo"].map(lambda c: cats.get(int(c), "")).astype("object")
+    return df[list(SIDRA_COLS)]
+
+MODOS_COLETA = ("ultimo", "incremental", "backfill")
+
+def _sidra_max_valores() -> int:
+    """Limite de valores (células) por requisição à API do SIDRA."""
+    return max(1, int(os.getenv("SIDRA_MAX_VALORES", "50000")))
+
+def _check_modo(modo: str, anos: tuple[int, int] | None):
+    if modo not in MODOS_COLETA:
+        raise ValueError(f"Modo de coleta inválido: {modo} (use {', '.join(MODOS_COLETA)})")
+    if modo == "backfill" and (not anos or anos[0] > anos[1]):
+        raise ValueError("Backfill requer intervalo de anos válido (ano_ini <= ano_fim).")
+
+def _cobertura(municipios, categorias) -> str:
+    """Impressão digital do conjunto municípios x categorias de uma marca d'água."""
+    raw = ",".join(map(str, sorted(municipios))) + "|" + ",".join(map(str, sorted(categorias)))
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+def _load_watermarks(engine, table_id: int, var_id: int, class_id: int) -> dict:
+    """{periodo: {modificacao, cobertura, municipios, categorias}} já gravados."""
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT periodo, modificacao, cobertura, municipios, categorias "
+                "FROM public.sidra_periodos_coletados "
+                "WHERE tabela=:t AND variavel=:v AND classificacao=:c"
+            ),
+            {"t": table_id, "v": var_id, "c": class_id},
+        ).mappings().all()
+    return {r["periodo"]: dict(r) for r in rows}
+
+def _save_watermarks(engine, table_id: int, var_id: int, class_id: int, marca: dict):
+    """
+    marca: {"periodos": {periodo: modificacao}, "municipios": [...], "categorias": [...]}.
+    Checkpoints anteriores à cobertura guardam só {periodo: modificacao} (cobertura nula).
+    """
+    periodos = marca["periodos"] if "periodos" in marca else marca
+    if not periodos:
+        return
+    munis, cats = marca.get("municipios"), marca.get("categorias")
+    cobertura = _cobertura(munis, cats) if munis is not None and cats is not None else None
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO public.sidra_periodos_coletados
+                    (tabela, variavel, classificacao, periodo, modificacao, municipios, categorias,
+                     cobertura, coletado_em)
+                VALUES (:t, :v, :c, :p, :m, :mu, :ca, :co, NOW())
+                ON CONFLICT (tabela, variavel, classificacao, periodo)
+                DO UPDATE SET modificacao = EXCLUDED.modificacao, municipios = EXCLUDED.municipios,
+                              categorias = EXCLUDED.categorias, cobertura = EXCLUDED.cobertura,
+                              coletado_em = NOW()
+                """
+            ),
+            [
+                {"t": table_id, "v": var_id, "c": class_id, "p": p, "m": m, "mu": munis, "ca": cats, "co": cobertura}
+                for p, m in periodos.items()
+            ],
+        )
+
+def _complementos(gravados: dict, ja: set, disponiveis: dict, muni_codes: list[int], cat_ids: list[int],
+                  modo: str, anos: tuple[int, int] | None = None) -> list[tuple]:
+    """
+    Períodos já gravados (e não replanejados em `ja`) cuja cobertura difere da atual:
+    [(periodos, municípios a buscar, categorias)]. Só municípios novos -> busca só eles;
+    categoria nova ou marca sem cobertura (gravada antes dela existir) -> o período inteiro.
+    """
+    if modo == "ultimo":
+        return []
+    atual = _cobertura(muni_codes, cat_ids)
+    por_faltantes = defaultdict(list)
+    for p, g in gravados.items():
+        if p in ja or p not in disponiveis or g["cobertura"] == atual:
+            continue
+        if modo == "backfill" and not (anos[0] <= int(p[:4]) <= anos[1]):
+            continue
+        if g["municipios"] is None or set(cat_ids) - set(g["categorias"] or []):
+            faltam = tuple(muni_codes)
+        else:
+            antes = set(g["municipios"])
+            faltam = tuple(m for m in muni_codes if m not in antes)
+        # só remoções: o que está gravado já cobre o conjunto atual
+        if faltam:
+            por_faltantes[faltam].append(p)
+    return [(sorted(ps), list(m), cat_ids) for m, ps in por_faltantes.items()]
+
+def _periodos_a_coletar(disponiveis: dict, gravados: dict, modo: str, anos: tuple[int, int] | None = None) -> list[str]:
+    """
+    disponiveis/gravados: {periodo: modificacao}.
+    - ultimo: só o período mais recente publicado
+    - incremental: períodos ausentes (a partir do primeiro já gravado) ou cuja
+      data de modificação no IBGE mudou; sem histórico, equivale a "ultimo"
+    - backfill: períodos dentro de `anos` (inclusive) ainda não gravados — rodar
+      de novo após uma interrupção retoma de onde parou
+    """
+    if not disponiveis:
+        return []
+    ordenados = sorted(disponiveis)
+    if modo == "backfill":
+        ano_ini, ano_fim = anos
+        return [p for p in ordenados if ano_ini <= int(p[:4]) <= ano_fim and p not in gravados]
+    if modo == "ultimo" or not gravados:
+        return ordenados[-1:]
+    inicio = min(gravados)
+    return [
+        p for p in ordenados
+        if (p not in gravados and p >= inicio) or (p in gravados and gravados[p] != disponiveis[p])
+    ]
+
+def _sidra_max_url() -> int:
+    return max(200, int(os.getenv("SIDRA_MAX_URL", "4000")))
+
+def _group_meta(group_name: str, verbose: bool = True):
+    """(tabela, variável, {classificação: {categoria: nome}}) do grupo; None se não há alvo."""
     table_id = int(TABLES[group_name]["table_id"])
     meta = get_agregado_metadados(table_id)
 
@@ -205,115 +1028,396 @@ def collect_sidra_for_group(group_name: str, engine=None, verbose: bool = True)
     if not var_id:
         if verbose:
             print(f"[{group_name}] Variável não encontrada — ignorando grupo.")
-        return 0
+        return None
 
     class_matches = _pick_targets_in_class(meta.get("classificacoes", []), group_name)
     if not class_matches:
         if verbose:
             print(f"[{group_name}] Nenhuma categoria alvo encontrada na tabela {table_id}.")
-        return 0
+        return None
+    return table_id, int(var_id), class_matches
+
+def _plan_group(group_name: str, engine, modo: str = "ultimo", anos: tuple[int, int] | None = None, verbose: bool = True):
+    """
+    Resolve variável, categorias, municípios e períodos do grupo e monta o plano
+    de requisições (sidra_client.plan_values_requests). Retorna None se não há o que coletar.
+    """
+    alvo = _group_meta(group_name, verbose)
+    if not alvo:
+        return None
+    table_id, var_id, class_matches = alvo
 
     with engine.begin() as conn:
         munis = conn.execute(
             text(
-                "SELECT DISTINCT codigo_ibge, nome_municipio, uf "
+                "SELECT DISTINCT codigo_ibge "
                 "FROM public.municipios_filiais "
                 "WHERE codigo_ibge IS NOT NULL "
-                "ORDER BY nome_municipio"
+                "ORDER BY codigo_ibge"
             )
         ).fetchall()
     if not munis:
         if verbose:
             print(f"[{group_name}] Nenhum município com código IBGE.")
-        return 0
+        return None
 
     muni_codes = [int(x[0]) for x in munis]
-    muni_chunks = _chunk(muni_codes, 30)
-    total = 0
 
+    try:
+        disponiveis = {str(p["id"]): p.get("modificacao") for p in get_agregado_periodos(table_id)}
+    except Exception as e:
+        if modo != "ultimo":
+            raise
+        if verbose:
+            print(f"[{group_name}] Períodos indisponíveis ({e}); usando 'last'.")
+        disponiveis = {}
+
+    # unidades ordenadas por bloco de períodos: cada bloco fecha (e grava sua marca
+    # d'água, com a cobertura municípios x categorias) assim que todas as suas
+    # requisições terminam — é o ponto de retomada
+    units = []
+    periodos_por_bloco = {}
     for class_id, cats in class_matches.items():
         cat_ids = list(cats.keys())
+        if disponiveis:
+            gravados = _load_watermarks(engine, table_id, int(var_id), class_id) if modo != "ultimo" else {}
+            periodos = _periodos_a_coletar(
+                disponiveis, {p: g["modificacao"] for p, g in gravados.items()}, modo, anos
+            )
+            pedidos = [(periodos, muni_codes, cat_ids)] if periodos else []
+            complementos = _complementos(gravados, set(periodos), disponiveis, muni_codes, cat_ids, modo, anos)
+            if complementos and verbose:
+                n = sum(len(ps) for ps, _, _ in complementos)
+                print(f"[{group_name}] classificação {class_id}: {n} períodos gravados com outra cobertura; buscando o que falta.")
+            pedidos += complementos
+            if not pedidos:
+                if verbose:
+                    print(f"[{group_name}] classificação {class_id}: nada novo no IBGE.")
+                continue
+        else:
+            pedidos = [(["last"], muni_codes, cat_ids)]
+        b0 = 0
+        for periodos, munis, cat_ids_pedido in pedidos:
+            plano = plan_values_requests(
+                table_id, int(var_id), class_id, cat_ids_pedido, munis, periodos,
+                max_valores=_sidra_max_valores(), max_url=_sidra_max_url(),
+            )
+            for b, bloco, mchunk, pchunk, url in plano:
+                if disponiveis:
+                    periodos_por_bloco[(class_id, b0 + b)] = {
+                        "periodos": {p: disponiveis[p] for p in bloco},
+                        "municipios": muni_codes,
+                        "categorias": cat_ids,
+                    }
+                units.append(Unidade(class_id, b0 + b, bloco, mchunk, pchunk, url, 0))
+            b0 += 1 + max((x[0] for x in plano), default=-1)
 
-        for mchunk in muni_chunks:
-            mset = set(mchunk)
-            for pchunk in _chunk(cat_ids, 8):
-                pset = set(pchunk)
-                url = build_values_url(table_id, var_id, "n6", mchunk, class_id, pchunk, periodo="last")
-                try:
-                    js = http_get_json(url)
-                except Exception as e:
-                    if verbose:
-                        print(f"[{group_name}] Falha HTTP em {url}: {e}")
-                    continue
-
-                if not isinstance(js, list) or len(js) <= 1:
-                    continue
-
-                header = js[0]
-                unidade = header.get("Unidade", "")
-
-                for row in js[1:]:
-                    try:
-                        cat_id = None
-                        for k, v in row.items():
-                            if k.endswith("C") and str(v).isdigit():
-                                v_int = int(v)
-                                if v_int in pset:
-                                    cat_id = v_int
-                                    break
-                        if not cat_id:
-                            continue
-
-                        cod_mun = None
-                        for k, v in row.items():
-                            if k.endswith("C") and str(v).isdigit():
-                                v_int = int(v)
-                                if v_int in mset:
-                                    cod_mun = v_int
-                                    break
-                        if not cod_mun:
-                            continue
-
-                        ano_val = None
-                        if "Ano" in row and str(row["Ano"]).strip():
-                            ano_val = int(str(row["Ano"])[:4])
-                        elif "Mês" in row and str(row["Mês"]).strip():
-                            ano_val = int(str(row["Mês"])[:4])
-                        else:
-                            for v in row.values():
-                                s = str(v)
-                                if len(s) >= 4 and s[:4].isdigit():
-                                    y = int(s[:4])
-                                    if 1900 <= y <= 2100:
-                                        ano_val = y
-                                        break
-                        if not ano_val:
-                            continue
-
-                        nome_mun = row.get("D3N") or row.get("Município") or ""
-
-                        val = row.get("V")
-                        val_num = try_float(val)
-
-                        rec = {
-                            "tabela": table_id,
-                            "variavel": int(var_id),
-                            "ano": int(ano_val),
-                            "cod_municipio": int(cod_mun),
-                            "nome_municipio": nome_mun,
-                            "uf": None,
-                            "produto_codigo": int(cat_id),
-                            "produto_nome": cats.get(cat_id, ""),
-                            "unidade": unidade,
-                            "valor_str": str(val) if val is not None else None,
-                            "valor_num": val_num,
-                        }
-                        total += _upsert_sidra_rows(engine, [rec])
-                    except Exception:
-                        continue
+    return {
+        "grupo": group_name,
+        "table_id": table_id,
+        "var_id": int(var_id),
+        "class_matches": class_matches,
+        "units": units,
+        "periodos_por_bloco": periodos_por_bloco,
+        "municipios": len(muni_codes),
+    }
+
+def plan_coleta(groups: list[str] | None = None, modo: str = "ultimo", anos: tuple[int, int] | None = None, engine=None) -> list[dict]:
+    """Estimativa da coleta (requisições planejadas por grupo) sem executá-la."""
+    _check_modo(modo, anos)
+    engine = engine or get_engine()
+    out = []
+    for grp in groups or list(TABLES):
+        if grp not in TABLES:
+            continue
+        plano = _plan_group(grp, engine, modo, anos, verbose=False)
+        units = plano["units"] if plano else []
+        out.append({
+            "grupo": grp,
+            "tabela": TABLES[grp]["table_id"],
+            "requisicoes": len(units),
+            "blocos_periodos": len(plano["periodos_por_bloco"]) if plano else 0,
+            "municipios": plano["municipios"] if plano else 0,
+        })
+    return out
+
+# ---------------- execuções e checkpoints ----------------
+
+def _nova_execucao(engine, modo: str, anos: tuple[int, int] | None, groups: list[str]) -> int:
+    with engine.begin() as conn:
+        return int(conn.execute(
+            text(
+                "INSERT INTO public.coleta_execucoes (modo, ano_ini, ano_fim, grupos) "
+                "VALUES (:m, :a0, :a1, :g) RETURNING id"
+            ),
+            {"m": modo, "a0": anos[0] if anos else None, "a1": anos[1] if anos else None, "g": ",".join(groups)},
+        ).scalar_one())
+
+def _execucao_pendente(engine) -> dict | None:
+    """Última execução que não terminou (processo morto, cancelada ou com grupos/unidades pendentes)."""
+    with engine.begin() as conn:
+        row = conn.execute(
+            text(
+                "SELECT id, modo, ano_ini, ano_fim, grupos FROM public.coleta_execucoes "
+                "WHERE status <> 'concluida' ORDER BY id DESC LIMIT 1"
+            )
+        ).mappings().first()
+    return dict(row) if row else None
+
+def _finalizar_execucao(engine, execucao_id: int, status: str | None = None) -> str:
+    """Fecha a execução; sem status explícito, 'concluida' só se não há checkpoint pendente."""
+    with engine.begin() as conn:
+        if status is None:
+            pend = conn.execute(
+                text(
+                    "SELECT COUNT(*) FROM public.coleta_checkpoints "
+                    "WHERE execucao_id = :e AND status = 'pendente'"
+                ),
+                {"e": execucao_id},
+            ).scalar_one()
+            status = "concluida" if not pend else "interrompida"
+        conn.execute(
+            text("UPDATE public.coleta_execucoes SET status = :s, finalizado_em = NOW() WHERE id = :e"),
+            {"s": status, "e": execucao_id},
+        )
+    return status
 
+def _registrar_unidades(engine, execucao_id: int, grupo: str, plano: dict) -> list[Unidade]:
+    """Grava uma linha pendente por requisição planejada; devolve as unidades com `raiz` = id."""
+    units = plano["units"]
+    if not units:
+        return []
+    marcas = plano["periodos_por_bloco"]
+    with engine.begin() as conn:
+        ids = dict(conn.execute(
+            text(
+                """
+                INSERT INTO public.coleta_checkpoints
+                    (execucao_id, grupo, tabela, variavel, classificacao, bloco,
+                     periodos, municipios, categorias, url, marca)
+                SELECT :e, :g, :t, :v, u.c, u.b, u.p, u.m, u.k, u.url, CAST(u.marca AS jsonb)
+                FROM unnest(
+                    CAST(:c AS int[]), CAST(:b AS int[]), CAST(:p AS text[]), CAST(:m AS text[]),
+                    CAST(:k AS text[]), CAST(:url AS text[]), CAST(:marca AS text[])
+                ) AS u(c, b, p, m, k, url, marca)
+                RETURNING url, id
+                """
+            ),
+            {
+                "e": execucao_id, "g": grupo, "t": plano["table_id"], "v": plano["var_id"],
+                "c": [u.class_id for u in units],
+                "b": [u.bloco for u in units],
+                "p": ["|".join(u.periodos) for u in units],
+                "m": [",".join(str(x) for x in u.municipios) for u in units],
+                "k": [",".join(str(x) for x in u.categorias) for u in units],
+                "url": [u.url for u in units],
+                "marca": [
+                    json.dumps(marcas[(u.class_id, u.bloco)]) if (u.class_id, u.bloco) in marcas else None
+                    for u in units
+                ],
+            },
+        ).all())
+    return [u._replace(raiz=int(ids[u.url])) for u in units]
+
+def _carregar_unidades(engine, execucao_id: int, grupo: str):
+    """
+    Checkpoints do grupo numa execução: (unidades pendentes, marcas por bloco,
+    falhas já registradas por bloco). None se o grupo ainda não foi planejado nessa execução.
+    """
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT id, classificacao, bloco, periodos, municipios, categorias, url, marca, status, falhas "
+                "FROM public.coleta_checkpoints WHERE execucao_id = :e AND grupo = :g ORDER BY id"
+            ),
+            {"e": execucao_id, "g": grupo},
+        ).mappings().all()
+    if not rows:
+        return None
+    units, marcas, falhas = [], {}, Counter()
+    for r in rows:
+        if r["marca"] is not None:
+            marcas[(r["classificacao"], r["bloco"])] = r["marca"]
+        if r["status"] != "pendente":
+            # requisições concluídas com partes no dead-letter: o bloco não pode ganhar marca d'água
+            if r["falhas"]:
+                falhas[(r["classificacao"], r["bloco"])] += int(r["falhas"])
+            continue
+        units.append(Unidade(
+            r["classificacao"], r["bloco"], r["periodos"].split("|"),
+            [int(x) for x in r["municipios"].split(",") if x],
+            [int(x) for x in r["categorias"].split(",") if x],
+            r["url"], 0, int(r["id"]),
+        ))
+    return units, marcas, falhas
+
+def list_execucoes(engine=None, limit: int = 20) -> list[dict]:
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                """
+                SELECT e.id, e.modo, e.ano_ini, e.ano_fim, e.grupos, e.status, e.iniciado_em, e.finalizado_em,
+                       COUNT(c.id) AS unidades,
+                       COUNT(c.id) FILTER (WHERE c.status = 'concluida') AS concluidas,
+                       COALESCE(SUM(c.linhas), 0) AS linhas
+                FROM public.coleta_execucoes e
+                LEFT JOIN public.coleta_checkpoints c ON c.execucao_id = e.id
+                GROUP BY e.id
+                ORDER BY e.id DESC
+                LIMIT :n
+                """
+            ),
+            {"n": int(limit)},
+        ).mappings().all()
+    return [dict(r) for r in rows]
+
+def collect_sidra_for_group(
+    group_name: str,
+    engine=None,
+    verbose: bool = True,
+    workers: int | None = None,
+    modo: str = "ultimo",
+    anos: tuple[int, int] | None = None,
+    execucao_id: int | None = None,
+    progresso: ColetaProgresso | None = None,
+) -> int:
+    """
+    Coleta um grupo. Com execucao_id, cada requisição planejada vira um checkpoint
+    (coleta_checkpoints); se o grupo já foi planejado nessa execução, só as
+    pendentes são buscadas (retomada).
+    """
+    _check_modo(modo, anos)
+    engine = engine or get_engine()
+    progresso = progresso or ColetaProgresso()
+    salvo = _carregar_unidades(engine, execucao_id, group_name) if execucao_id else None
+    if salvo is not None:
+        alvo = _group_meta(group_name, verbose)
+        if not alvo:
+            return 0
+        units, marcas, falhas_anteriores = salvo
+        # blocos já todos concluídos sem falhas: a marca pode não ter sido gravada (queda entre
+        # o último checkpoint e _save_watermarks) e on_bloco_concluido não dispara mais para eles
+        com_pendentes = {(u.class_id, u.bloco) for u in units}
+        for (class_id, b), marca in marcas.items():
+            if (class_id, b) not in com_pendentes and not falhas_anteriores[(class_id, b)]:
+                _save_watermarks(engine, alvo[0], alvo[1], class_id, marca)
+        plano = {
+            "table_id": alvo[0], "var_id": alvo[1], "class_matches": alvo[2], "units": units,
+            "periodos_por_bloco": marcas, "municipios": len({m for u in units for m in u.municipios}),
+        }
+        if verbose:
+            print(f"[{group_name}] retomando execução {execucao_id}: {len(units)} requisições pendentes")
+    else:
+        falhas_anteriores = None
+        plano = _plan_group(group_name, engine, modo, anos, verbose)
+        if not plano:
+            return 0
+        if execucao_id:
+            plano["units"] = _registrar_unidades(engine, execucao_id, group_name, plano)
+    table_id, var_id = plano["table_id"], plano["var_id"]
+    class_matches = plano["class_matches"]
+    units = plano["units"]
+    periodos_por_bloco = plano["periodos_por_bloco"]
+    if verbose:
+        print(
+            f"[{group_name}] plano: {len(units)} requisições "
+            f"({plano['municipios']} municípios, {len(periodos_por_bloco) or 1} blocos de períodos)"
+        )
+
+    workers = workers or _sidra_workers()
+    progresso.set(grupo=group_name)
+    progresso.inc(requisicoes_total=len(units))
+    writer = SidraBulkWriter(engine, label=group_name, verbose=verbose, execucao_id=execucao_id)
+
+    def _bloco_concluido(class_id, b, sem_falhas):
+        if sem_falhas and (class_id, b) in periodos_por_bloco:
+            # grava o que está em memória antes de marcar o bloco como concluído
+            writer.flush()
+            _save_watermarks(engine, table_id, var_id, class_id, periodos_por_bloco[(class_id, b)])
+
+    try:
+        _executar_unidades(
+            group_name, table_id, var_id, class_matches, units, writer, engine, workers,
+            verbose=verbose, on_bloco_concluido=_bloco_concluido, progresso=progresso,
+            falhas_anteriores=falhas_anteriores,
+        )
+    finally:
+        # mesmo se cancelada, o que já foi lido é gravado
+        total = writer.close()
+        progresso.inc(linhas_gravadas=total)
     return total
 
+def list_dead_letters(engine=None, pendentes: bool = True) -> list[dict]:
+    engine = engine or get_engine()
+    sql = (
+        "SELECT id, grupo, tabela, variavel, classificacao, periodos, municipios, categorias, "
+        "url, erro, tentativas, criado_em, reprocessado_em FROM public.sidra_dead_letter "
+    )
+    if pendentes:
+        sql += "WHERE reprocessado_em IS NULL "
+    with engine.begin() as conn:
+        rows = conn.execute(text(sql + "ORDER BY id")).mappings().all()
+    return [dict(r) for r in rows]
+
+def replay_dead_letters(
+    engine=None, grupo: str | None = None, verbose: bool = True, workers: int | None = None,
+    progresso: ColetaProgresso | None = None,
+) -> dict:
+    """Reexecuta as sub-requisições pendentes do dead-letter (com a mesma estratégia de divisão)."""
+    engine = engine or get_engine()
+    progresso = progresso or ColetaProgresso()
+    progresso.set(etapa="dead_letter")
+    itens = [d for d in list_dead_letters(engine) if not grupo or d["grupo"] == grupo]
+    workers = workers or _sidra_workers()
+    out = {"reprocessadas": 0, "linhas": 0, "ainda_pendentes": 0}
+    por_alvo = defaultdict(list)
+    for d in itens:
+        por_alvo[(d["grupo"], d["tabela"], d["variavel"])].append(d)
+
+    for (grp, table_id, var_id), lst in por_alvo.items():
+        meta = get_agregado_metadados(table_id)
+        cats_por_classe = {
+            int(cl["id"]): {int(c["id"]): c.get("nome") or "" for c in cl.get("categorias", [])}
+            for cl in meta.get("classificacoes", [])
+        }
+        units = [
+            Unidade(
+                d["classificacao"], d["id"], d["periodos"].split("|"),
+                [int(x) for x in d["municipios"].split(",") if x],
+                [int(x) for x in d["categorias"].split(",") if x],
+                d["url"], 0,
+            )
+            for d in lst
+        ]
+        with engine.begin() as conn:
+            inicio = conn.execute(text("SELECT clock_timestamp()")).scalar_one()
+        concluidas = []
+
+        def _concluida(class_id, dl_id, sem_falhas):
+            concluidas.append(dl_id)
+
+        writer = SidraBulkWriter(engine, label=f"{grp}/dead-letter", verbose=verbose)
+        _executar_unidades(
+            grp, table_id, var_id, cats_por_classe, units, writer, engine, workers,
+            verbose=verbose, on_bloco_concluido=_concluida, progresso=progresso,
+        )
+        out["linhas"] += writer.close()
+        # o que falhou de novo teve criado_em renovado (mesma URL) ou virou novas
+        # entradas (metades); o restante está resolvido
+        if concluidas:
+            with engine.begin() as conn:
+                res = conn.execute(
+                    text(
+                        "UPDATE public.sidra_dead_letter SET reprocessado_em = NOW() "
+                        "WHERE id = ANY(:ids) AND criado_em < :inicio"
+                    ),
+                    {"ids": concluidas, "inicio": inicio},
+                )
+            out["reprocessadas"] += res.rowcount
+    out["ainda_pendentes"] = len(list_dead_letters(engine))
+    return out
+
 # ---------------- exportações e auditoria ----------------
 
 def get_last_year(engine=None):
@@ -322,50 +1426,131 @@ def get_last_year(engine=None):
         y = conn.execute(text("SELECT MAX(ano) FROM public.dados_sidra_brutos")).scalar_one()
     return int(y) if y else None
 
-def export_excel_por_filial(dest_path: str, engine=None):
+def _iter_linhas_relatorio(conn, ano: int, produtos: list[str], filiais: list[str] | None = None):
+    """
+    Gera (filial, [codigo_ibge, nome_municipio, uf, valor_produto_1, ...]) já
+    pivotado, lendo o join filial x dados com cursor no servidor, município a município.
+    """
+    idx = {p: i for i, p in enumerate(produtos)}
+    filtro = "AND filial = ANY(:filiais) " if filiais else ""
+    params = {"ano": int(ano)}
+    if filiais:
+        params["filiais"] = list(filiais)
+    result = conn.execution_options(stream_results=True, yield_per=5000).execute(
+        text(
+            "SELECT f.filial, f.codigo_ibge, f.nome_municipio, f.uf, d.produto_nome, d.valor_num "
+            "FROM (SELECT DISTINCT filial, codigo_ibge, nome_municipio, uf "
+            "      FROM public.municipios_filiais "
+            f"      WHERE codigo_ibge IS NOT NULL {filtro}) f "
+            "LEFT JOIN public.dados_sidra_brutos d "
+            "  ON d.cod_municipio = f.codigo_ibge AND d.ano = :ano "
+            "ORDER BY f.filial, f.nome_municipio, f.codigo_ibge, f.uf"
+        ),
+        params,
+    )
+    atual, linha = None, None
+    for filial, cod, nome, uf, produto, valor in result:
+        chave = (filial, cod, nome, uf)
+        if chave != atual:
+            if linha is not None:
+                yield atual[0], linha
+            atual, linha = chave, [cod, nome, uf] + [None] * len(produtos)
+        if produto in idx and linha[3 + idx[produto]] is None:
+            linha[3 + idx[produto]] = valor
+    if linha is not None:
+        yield atual[0], linha
+
+def export_excel_por_filial(dest_path: str, engine=None, ano: int | None = None, filiais: list[str] | None = None):
+    """
+    Planilha com uma aba por filial (linhas = municípios, colunas = produtos do ano).
+    Escrita em streaming (openpyxl write-only): a memória não cresce com o volume.
+    """
+    from openpyxl import Workbook
+
     engine = engine or get_engine()
-    with engine.begin() as conn:
-        ano = conn.execute(text("SELECT MAX(ano) FROM public.dados_sidra_brutos")).scalar_one()
+    with engine.connect() as conn:
+        if ano is None:
+            ano = conn.execute(text("SELECT MAX(ano) FROM public.dados_sidra_brutos")).scalar_one()
         if not ano:
             raise RuntimeError("Sem dados para exportar. Rode a coleta.")
-        munis = pd.read_sql(
-            text(
-                "SELECT filial, nome_municipio, uf, codigo_ibge "
-                "FROM public.municipios_filiais "
-                "WHERE codigo_ibge IS NOT NULL "
-                "ORDER BY filial, nome_municipio"
-            ),
-            conn,
-        )
-        dados = pd.read_sql(
-            text(
-                "SELECT ano, cod_municipio, nome_municipio, uf, produto_codigo, produto_nome, valor_num "
-                "FROM public.dados_sidra_brutos "
-                "WHERE ano = :ano"
-            ),
-            conn,
-            params={"ano": int(ano)},
-        )
+        produtos = [
+            r[0] for r in conn.execute(
+                text(
+                    "SELECT DISTINCT produto_nome FROM public.dados_sidra_brutos "
+                    "WHERE ano = :ano AND produto_nome IS NOT NULL ORDER BY produto_nome"
+                ),
+                {"ano": int(ano)},
+            )
+        ]
+        header = ["codigo_ibge", "nome_municipio", "uf"] + produtos
+
+        wb = Workbook(write_only=True)
+        ws, filial_atual = None, object()
+        for filial, linha in _iter_linhas_relatorio(conn, int(ano), produtos, filiais):
+            if filial != filial_atual:
+                ws = wb.create_sheet(title=str(filial)[:31])
+                ws.append(header)
+                filial_atual = filial
+            ws.append(linha)
+        if ws is None:
+            raise RuntimeError("Nenhuma filial com municípios casados para exportar.")
+        wb.save(dest_path)
+
+    return int(ano)
 
-    pivot = dados.pivot_table(
-        index=["cod_municipio", "nome_municipio", "uf"],
-        columns="produto_nome",
-        values="valor_num",
-        aggfunc="first",
-    ).reset_index()
-
-    with pd.ExcelWriter(dest_path, engine="openpyxl") as writer:
-        for filial, g in munis.groupby("filial"):
-            munis_da_filial = g[["codigo_ibge", "nome_municipio", "uf"]].drop_duplicates()
-            merged = munis_da_filial.merge(
-                pivot,
-                left_on=["codigo_ibge", "nome_municipio", "uf"],
-                right_on=["cod_municipio", "nome_municipio", "uf"],
-                how="left",
-            ).drop(columns=["cod_municipio"])
-            merged.sort_values(by=["nome_municipio"], inplace=True)
-            merged.to_excel(writer, sheet_name=str(filial)[:31], index=False)
+def list_filiais(engine=None) -> list[str]:
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT DISTINCT filial FROM public.municipios_filiais "
+                "WHERE codigo_ibge IS NOT NULL ORDER BY filial"
+            )
+        ).fetchall()
+    return [r[0] for r in rows]
 
+def filial_slug(filial: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", normalize_name(str(filial))).strip("_") or "filial"
+
+def _export_filial_worker(filial: str, ano: int, dest: str) -> str:
+    """Roda num processo do pool: uma planilha só com a filial informada."""
+    export_excel_por_filial(dest, get_engine(), ano=ano, filiais=[filial])
+    return dest
+
+def _nomes_relatorio(filiais: list[str], ano: int) -> list[str]:
+    """Nome do xlsx de cada filial; slugs repetidos (só caixa/acento/pontuação) ganham _2, _3..."""
+    usados, nomes = set(), []
+    for filial in filiais:
+        slug, i = filial_slug(filial), 1
+        nome = f"relatorio_{slug}_{ano}.xlsx"
+        while nome in usados:
+            i += 1
+            nome = f"relatorio_{slug}_{i}_{ano}.xlsx"
+        usados.add(nome)
+        nomes.append(nome)
+    return nomes
+
+def export_filiais_zip(dest_zip: str, engine=None, filiais: list[str] | None = None, workers: int | None = None) -> int:
+    """
+    Um xlsx por filial (mesma lógica de export_excel_por_filial), gerados em
+    paralelo num pool de processos (REPORT_WORKERS) e empacotados num ZIP.
+    """
+    engine = engine or get_engine()
+    ano = get_last_year(engine)
+    if not ano:
+        raise RuntimeError("Sem dados para exportar. Rode a coleta.")
+    filiais = filiais or list_filiais(engine)
+    workers = workers or max(1, int(os.getenv("REPORT_WORKERS", str(min(4, os.cpu_count() or 1)))))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # spawn: a API tem threads (jobs, pipeline, monitor) e locks que um fork copiaria
+        # no meio do uso; cada processo novo cria o próprio engine
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            destinos = [os.path.join(tmp, n) for n in _nomes_relatorio(filiais, ano)]
+            paths = list(ex.map(_export_filial_worker, filiais, [ano] * len(filiais), destinos))
+        with zipfile.ZipFile(dest_zip, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for p in paths:
+                zf.write(p, arcname=os.path.basename(p))
     return int(ano)
 
 def list_produtos(engine=None, ano: int | None = None):
@@ -380,6 +1565,243 @@ def list_produtos(engine=None, ano: int | None = None):
         ).fetchall()
     return [r[0] for r in rows]
 
+# ---------------- consulta do fato (streaming) ----------------
+
+DADOS_COLUNAS = [
+    "filial", "uf", "cod_municipio", "nome_municipio", "ano", "grupo",
+    "produto_codigo", "produto_nome", "unidade", "valor_num", "dado_id",
+]
+DADOS_LOTE = 5000
+
+def parse_chave_dados(apos: str) -> tuple[int, int, str]:
+    """'ano,dado_id,filial' (tirado da última linha recebida) -> chave do keyset."""
+    try:
+        ano, dado_id, filial = apos.split(",", 2)
+        return int(ano), int(dado_id), filial
+    except ValueError:
+        raise ValueError("apos deve ser 'ano,dado_id,filial' da última linha recebida.")
+
+def consulta_dados(
+    ano_ini: int | None = None,
+    ano_fim: int | None = None,
+    filiais: list[str] | None = None,
+    grupos: list[str] | None = None,
+    produtos: list[str] | None = None,
+    ufs: list[str] | None = None,
+    exclusiva: bool = False,
+    apos: tuple[int, int, str] | None = None,
+    limite: int | None = None,
+) -> tuple[str, dict]:
+    """
+    (SQL, parâmetros) das linhas do fato, com os mesmos joins de vw_fato_filial_produto_anual
+    (ou vw_fato_filial_exclusiva se exclusiva=True), uma linha por (dado, filial). Ordem
+    (ano, dado_id, filial), chave única: `apos` continua depois dela pelo índice (ano, id), sem OFFSET.
+    """
+    conds, params = [], {}
+    if ano_ini is not None:
+        conds.append("d.ano >= :ano_ini")
+        params["ano_ini"] = int(ano_ini)
+    if ano_fim is not None:
+        conds.append("d.ano <= :ano_fim")
+        params["ano_fim"] = int(ano_fim)
+    if grupos:
+        desconhecidos = sorted(set(grupos) - set(TABLES))
+        if desconhecidos:
+            raise ValueError(f"Grupo desconhecido: {', '.join(desconhecidos)}")
+        # filtra pela tabela (coluna de d): aproveita índices e partições por tabela
+        conds.append("d.tabela = ANY(:tabelas)")
+        params["tabelas"] = [int(TABLES[g]["table_id"]) for g in grupos]
+    if filiais:
+        conds.append("f.filial = ANY(:filiais)")
+        params["filiais"] = list(filiais)
+    if produtos:
+        conds.append("d.produto_nome = ANY(:produtos)")
+        params["produtos"] = list(produtos)
+    if ufs:
+        conds.append("COALESCE(d.uf, mi.uf) = ANY(:ufs)")
+        params["ufs"] = [u.upper() for u in ufs]
+    if apos:
+        # a 1ª condição (só colunas de d) é a que desce pelo índice; a 2ª desempata pela filial
+        conds.append("(d.ano, d.id) >= (:k_ano, :k_id)")
+        conds.append("(d.ano, d.id, f.filial) > (:k_ano, :k_id, :k_filial)")
+        params.update(k_ano=int(apos[0]), k_id=int(apos[1]), k_filial=apos[2])
+    # (filial, codigo_ibge) único nas duas fontes: senão a chave (ano, dado_id, filial) se repete
+    # (dois nomes da planilha casados no mesmo município) e a paginação pula/duplica linhas
+    fonte = "public.dim_municipio_filial_exclusiva" if exclusiva else """(
+            SELECT DISTINCT ON (filial, codigo_ibge) filial, codigo_ibge, nome_municipio
+            FROM public.municipios_filiais
+            WHERE codigo_ibge IS NOT NULL
+            ORDER BY filial, codigo_ibge, id
+        )"""
+    sql = f"""
+        SELECT f.filial, COALESCE(d.uf, mi.uf), d.cod_municipio,
+               COALESCE(d.nome_municipio, f.nome_municipio), d.ano, COALESCE(g.grupo, 'desconhecido'),
+               d.produto_codigo, d.produto_nome, d.unidade, d.valor_num, d.id
+        FROM public.dados_sidra_brutos d
+        JOIN {fonte} f ON f.codigo_ibge = d.cod_municipio
+        LEFT JOIN public.municipios_ibge mi ON mi.codigo_ibge = d.cod_municipio
+        LEFT JOIN public.dim_grupo_sidra g ON g.tabela = d.tabela
+        {"WHERE " + " AND ".join(conds) if conds else ""}
+        ORDER BY d.ano, d.id, f.filial
+    """
+    if limite:
+        sql += " LIMIT :limite"
+        params["limite"] = int(limite)
+    return sql, params
+
+def iter_dados(consulta: tuple[str, dict], engine=None):
+    """Linhas (tuplas na ordem de DADOS_COLUNAS) lidas com cursor no servidor: memória constante."""
+    sql, params = consulta
+    engine = engine or get_engine()
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=DADOS_LOTE).execute(text(sql), params)
+        for row in result:
+            yield tuple(row)
+
+def iter_dados_texto(consulta: tuple[str, dict], formato: str = "ndjson", engine=None):
+    """Mesmas linhas em NDJSON ou CSV (com cabeçalho), em blocos de texto de até DADOS_LOTE linhas."""
+    if formato not in ("ndjson", "csv"):
+        raise ValueError("formato deve ser ndjson ou csv.")
+    buf = io.StringIO()
+    if formato == "csv":
+        w = csv.writer(buf, lineterminator="\n")
+        w.writerow(DADOS_COLUNAS)
+        escreve = w.writerow
+    else:
+        def escreve(row):
+            buf.write(json.dumps(dict(zip(DADOS_COLUNAS, row)), ensure_ascii=False, default=str))
+            buf.write("\n")
+    n = 0
+    for row in iter_dados(consulta, engine):
+        escreve(row)
+        n += 1
+        if n % DADOS_LOTE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+# ---------------- exportação colunar (Parquet / Arrow) ----------------
+
+def _dados_schema(sem: tuple = ()):
+    import pyarrow as pa
+    tipos = {
+        "filial": pa.string(), "uf": pa.string(), "cod_municipio": pa.int32(),
+        "nome_municipio": pa.string(), "ano": pa.int32(), "grupo": pa.string(),
+        "produto_codigo": pa.int32(), "produto_nome": pa.string(), "unidade": pa.string(),
+        "valor_num": pa.float64(), "dado_id": pa.int64(),
+    }
+    return pa.schema([(c, tipos[c]) for c in DADOS_COLUNAS if c not in sem])
+
+def _lote_arrow(schema, linhas: list[tuple]):
+    """Linhas de iter_dados -> RecordBatch tipado (só as colunas do schema)."""
+    import pyarrow as pa
+    cols = list(zip(*linhas))
+    return pa.record_batch(
+        [pa.array(cols[DADOS_COLUNAS.index(f.name)], type=f.type) for f in schema], schema=schema
+    )
+
+def iter_dados_arrow(consulta: tuple[str, dict], engine=None):
+    """Mesmas linhas de iter_dados como Arrow IPC stream (bytes), um record batch a cada DADOS_LOTE linhas."""
+    import pyarrow as pa
+    schema = _dados_schema()
+    buf = io.BytesIO()
+    with pa.ipc.new_stream(buf, schema) as w:
+        linhas = []
+        for row in iter_dados(consulta, engine):
+            linhas.append(row)
+            if len(linhas) >= DADOS_LOTE:
+                w.write_batch(_lote_arrow(schema, linhas))
+                linhas = []
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if linhas:
+            w.write_batch(_lote_arrow(schema, linhas))
+    yield buf.getvalue()
+
+def export_parquet(
+    dest_dir: str,
+    engine=None,
+    formato: str = "parquet",
+    ano_ini: int | None = None,
+    ano_fim: int | None = None,
+    grupos: list[str] | None = None,
+    exclusiva: bool = False,
+) -> dict:
+    """
+    Grava o fato de consulta_dados (dados_sidra_brutos x municipios_filiais) como dataset
+    particionado estilo Hive: dest_dir/ano=2023/grupo=vegetal/parte-0.parquet (ou .arrow,
+    Arrow IPC em arquivo). Lê com cursor no servidor; cada DADOS_LOTE linhas de uma partição
+    viram um row group (record batch). ano/grupo ficam só no caminho.
+    Retorna {"arquivos": [...], "linhas": n}.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if formato not in ("parquet", "arrow"):
+        raise ValueError("formato deve ser parquet ou arrow.")
+    dest = Path(dest_dir)
+    if dest.exists() and any(dest.iterdir()):
+        raise FileExistsError(f"Destino não está vazio: {dest}")
+    schema = _dados_schema(sem=("ano", "grupo"))
+    i_ano, i_grupo = DADOS_COLUNAS.index("ano"), DADOS_COLUNAS.index("grupo")
+    consulta = consulta_dados(ano_ini=ano_ini, ano_fim=ano_fim, grupos=grupos, exclusiva=exclusiva)
+
+    writers, buffers = {}, defaultdict(list)
+    arquivos, total = [], 0
+
+    def gravar(chave):
+        linhas = buffers.pop(chave, None)
+        if not linhas:
+            return
+        w = writers.get(chave)
+        if w is None:
+            d = dest / f"ano={chave[0]}" / f"grupo={chave[1]}"
+            d.mkdir(parents=True, exist_ok=True)
+            path = d / f"parte-0.{formato}"
+            arquivos.append(path.relative_to(dest).as_posix())
+            if formato == "parquet":
+                w = pq.ParquetWriter(str(path), schema, compression="zstd")
+            else:
+                w = pa.ipc.new_file(str(path), schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+            writers[chave] = w
+        w.write_batch(_lote_arrow(schema, linhas))
+
+    def fechar(chaves):
+        for chave in chaves:
+            gravar(chave)
+            w = writers.pop(chave, None)
+            if w is not None:
+                w.close()
+
+    try:
+        # linhas chegam em ordem de ano: ao mudar de ano, os arquivos do anterior são fechados
+        ano_atual = None
+        for row in iter_dados(consulta, engine):
+            if row[i_ano] != ano_atual:
+                fechar(list(writers) + list(buffers))
+                ano_atual = row[i_ano]
+            chave = (row[i_ano], row[i_grupo])
+            buffers[chave].append(row)
+            total += 1
+            if len(buffers[chave]) >= DADOS_LOTE:
+                gravar(chave)
+        fechar(list(writers) + list(buffers))
+    finally:
+        for w in writers.values():
+            w.close()
+    return {"arquivos": arquivos, "linhas": total}
+
+def export_parquet_zip(dest_zip: str, engine=None, **filtros) -> int:
+    """export_parquet num diretório temporário, empacotado num ZIP (sem recomprimir). Retorna linhas."""
+    with tempfile.TemporaryDirectory() as tmp:
+        out = export_parquet(os.path.join(tmp, "fato"), engine, **filtros)
+        with zipfile.ZipFile(dest_zip, "w", compression=zipfile.ZIP_STORED) as zf:
+            for arq in out["arquivos"]:
+                zf.write(os.path.join(tmp, "fato", arq), arcname=arq)
+    return out["linhas"]
+
 def _df_municipios_filiais(engine):
     with engine.begin() as conn:
         df = pd.read_sql(
@@ -388,27 +1810,42 @@ def _df_municipios_filiais(engine):
         )
     return df
 
-def get_codigos_duplicados(engine=None):
+_DUPLICADOS_SQL = """
+    SELECT codigo_ibge
+    FROM public.municipios_filiais
+    WHERE codigo_ibge IS NOT NULL
+    GROUP BY codigo_ibge
+    HAVING COUNT(*) > 1
+"""
+
+def get_codigos_duplicados(engine=None, limit: int | None = None, offset: int = 0) -> dict:
+    """
+    Códigos IBGE presentes em mais de uma linha de municipios_filiais (GROUP BY/HAVING no
+    banco), da maior para a menor ocorrência. {"total": n, "items": [...]} paginado por limit/offset.
+    """
     engine = engine or get_engine()
-    df = _df_municipios_filiais(engine)
-    df["codigo_ibge"] = pd.to_numeric(df["codigo_ibge"], errors="coerce").astype("Int64")
-    df_dup = df.dropna(subset=["codigo_ibge"]).groupby("codigo_ibge").agg({
-        "filial": lambda s: sorted(set(v for v in s if pd.notna(v))),
-        "nome_municipio": lambda s: sorted(set(v for v in s if pd.notna(v))),
-        "uf": lambda s: sorted(set(v for v in s if pd.notna(v))),
-        "codigo_ibge": "size",
-    }).rename(columns={"codigo_ibge": "ocorrencias"}).reset_index()
-    df_dup = df_dup[df_dup["ocorrencias"] > 1].sort_values(by="ocorrencias", ascending=False)
-    items = []
-    for _, row in df_dup.iterrows():
-        items.append({
-            "codigo_ibge": int(row["codigo_ibge"]),
-            "filiais": row["filial"],
-            "nomes": row["nome_municipio"],
-            "ufs": row["uf"],
-            "ocorrencias": int(row["ocorrencias"]),
-        })
-    return items
+    with engine.begin() as conn:
+        total = conn.execute(text(f"SELECT COUNT(*) FROM ({_DUPLICADOS_SQL}) x")).scalar_one()
+        rows = conn.execute(
+            text(
+                """
+                SELECT codigo_ibge,
+                       array_agg(DISTINCT filial::text ORDER BY filial::text) AS filiais,
+                       array_agg(DISTINCT nome_municipio::text ORDER BY nome_municipio::text) AS nomes,
+                       COALESCE(array_agg(DISTINCT uf::text ORDER BY uf::text)
+                                FILTER (WHERE uf IS NOT NULL), '{}') AS ufs,
+                       COUNT(*) AS ocorrencias
+                FROM public.municipios_filiais
+                WHERE codigo_ibge IS NOT NULL
+                GROUP BY codigo_ibge
+                HAVING COUNT(*) > 1
+                ORDER BY ocorrencias DESC, codigo_ibge
+                LIMIT :n OFFSET :o
+                """
+            ),
+            {"n": limit, "o": int(offset)},
+        ).mappings().all()
+    return {"total": int(total), "items": [dict(r) for r in rows]}
 
 def build_lookup_files(out_dir: str):
     """
@@ -479,35 +1916,156 @@ def build_lookup_files(out_dir: str):
         "qtd_codigos": int(len(lookup)),
     }
 
-def get_status(engine=None):
+# /status em cache no processo: vale enquanto o carimbo de versão dos dados (contadores de
+# escrita em pg_stat das tabelas lidas) não mudar, por no máximo STATUS_CACHE_TTL_S segundos.
+# pg_stat chega com ~1 s de atraso: uma gravação aparece no /status na chamada seguinte a isso.
+_STATUS_CACHE: dict = {}
+_STATUS_LOCK = threading.Lock()
+
+def _status_versao(conn) -> tuple:
+    # n_live_tup pega TRUNCATE; relid muda se a tabela for trocada (ex.: /db/particionar)
+    return tuple(
+        conn.execute(
+            text(
+                "SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0), COALESCE(SUM(n_live_tup), 0), "
+                "       COALESCE(SUM(relid::bigint), 0), "
+                "       (SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()) "
+                "FROM pg_stat_user_tables "
+                "WHERE schemaname = 'public' "
+                "  AND (relname = 'municipios_filiais' OR relname LIKE 'dados\\_sidra\\_brutos%')"
+            )
+        ).one()
+    )
+
+def get_status(engine=None, usar_cache: bool = True):
+    """
+    Contagens de municípios, duplicados, último ano e linhas por grupo nesse ano, numa
+    única consulta. Com usar_cache, repete o último resultado enquanto os dados não mudarem.
+    """
     engine = engine or get_engine()
+    ttl = float(os.getenv("STATUS_CACHE_TTL_S", "300"))
     with engine.begin() as conn:
-        total_munis = conn.execute(text("SELECT COUNT(*) FROM public.municipios_filiais")).scalar_one()
-        com_codigo = conn.execute(text("SELECT COUNT(*) FROM public.municipios_filiais WHERE codigo_ibge IS NOT NULL")).scalar_one()
-        ano = conn.execute(text("SELECT MAX(ano) FROM public.dados_sidra_brutos")).scalar_one()
-        by_table = []
-        if ano:
-            for k, v in TABLES.items():
-                cnt = conn.execute(
-                    text("SELECT COUNT(*) FROM public.dados_sidra_brutos WHERE tabela=:t AND ano=:y"),
-                    {"t": int(v["table_id"]), "y": int(ano)},
-                ).scalar_one()
-                by_table.append({"grupo": k, "tabela": v["table_id"], "linhas_ano": int(cnt)})
-    dups = get_codigos_duplicados(engine)
-    return {
+        versao = _status_versao(conn)
+        with _STATUS_LOCK:
+            c = dict(_STATUS_CACHE)
+        if usar_cache and c.get("versao") == versao and time.monotonic() - c["em"] < ttl:
+            return c["valor"]
+        total_munis, com_codigo, dups, ano, por_tabela = conn.execute(
+            text(
+                f"""
+                WITH a AS (SELECT MAX(ano) AS ano FROM public.dados_sidra_brutos)
+                SELECT
+                  (SELECT COUNT(*) FROM public.municipios_filiais),
+                  (SELECT COUNT(codigo_ibge) FROM public.municipios_filiais),
+                  (SELECT COUNT(*) FROM ({_DUPLICADOS_SQL}) x),
+                  a.ano,
+                  (SELECT json_object_agg(tabela, n) FROM (
+                      SELECT d.tabela, COUNT(*) AS n FROM public.dados_sidra_brutos d
+                      WHERE d.ano = a.ano AND d.tabela = ANY(:tabelas)
+                      GROUP BY d.tabela) t)
+                FROM a
+                """
+            ),
+            {"tabelas": [int(v["table_id"]) for v in TABLES.values()]},
+        ).one()
+    por_tabela = por_tabela or {}
+    valor = {
         "municipios_total": int(total_munis),
         "municipios_com_codigo": int(com_codigo),
         "municipios_sem_codigo": int(total_munis - com_codigo),
-        "duplicados_entre_filiais": len(dups),
+        "duplicados_entre_filiais": int(dups),
         "ultimo_ano": int(ano) if ano else None,
-        "linhas_por_grupo_no_ano": by_table,
+        "linhas_por_grupo_no_ano": [
+            {"grupo": k, "tabela": v["table_id"], "linhas_ano": int(por_tabela.get(str(v["table_id"]), 0))}
+            for k, v in TABLES.items()
+        ] if ano else [],
     }
+    with _STATUS_LOCK:
+        _STATUS_CACHE.update(versao=versao, em=time.monotonic(), valor=valor)
+    return valor
 
 # ---------------- orquestração ----------------
 
-def bootstrap_all(data_dir: str, groups: list[str] | None = None):
+def run_coleta(
+    groups: list[str] | None = None,
+    modo: str = "ultimo",
+    anos: tuple[int, int] | None = None,
+    engine=None,
+    retomar: bool = False,
+    progresso: ColetaProgresso | None = None,
+) -> int:
+    """
+    Coleta SIDRA dos grupos (sem reler a planilha nem recasar municípios), registrada
+    em coleta_execucoes. retomar=True continua a última execução não concluída
+    (com os grupos/modo/anos dela), pulando as requisições já gravadas.
+    """
+    _check_modo(modo, anos)
+    engine = engine or get_engine()
+    progresso = progresso or ColetaProgresso()
+    groups_to_run = groups or ["vegetal", "rebanho", "aquicultura"]
+    anterior = _execucao_pendente(engine) if retomar else None
+    if anterior:
+        execucao_id = int(anterior["id"])
+        modo = anterior["modo"]
+        anos = (anterior["ano_ini"], anterior["ano_fim"]) if anterior["ano_ini"] else None
+        groups_to_run = anterior["grupos"].split(",")
+        with engine.begin() as conn:
+            conn.execute(
+                text("UPDATE public.coleta_execucoes SET status = 'executando', finalizado_em = NULL WHERE id = :e"),
+                {"e": execucao_id},
+            )
+        print(f"[SIDRA] retomando execução {execucao_id} (modo={modo}, grupos={','.join(groups_to_run)})")
+    else:
+        execucao_id = _nova_execucao(engine, modo, anos, groups_to_run)
+    progresso.set(etapa="coleta", grupos=groups_to_run, execucao_id=execucao_id)
+    total = 0
+    incompleta = False
+    try:
+        for grp in groups_to_run:
+            progresso.check_cancel()
+            if grp not in TABLES:
+                print(f"[WARN] Grupo desconhecido: {grp} — ignorando")
+                continue
+            try:
+                up = collect_sidra_for_group(
+                    grp, engine, verbose=True, modo=modo, anos=anos, execucao_id=execucao_id, progresso=progresso,
+                )
+                print(f"[SIDRA] grupo={grp} upserts={up}")
+                total += up
+            except ColetaCancelada:
+                raise
+            except Exception as e:
+                incompleta = True
+                print(f"[WARN] Falha ao coletar grupo {grp}: {e} (seguindo)")
+            progresso.inc(grupos_concluidos=1)
+    except ColetaCancelada:
+        _finalizar_execucao(engine, execucao_id, "cancelada")
+        raise
+    except BaseException:
+        _finalizar_execucao(engine, execucao_id, "interrompida")
+        raise
+    status = _finalizar_execucao(engine, execucao_id, "interrompida" if incompleta else None)
+    print(f"[SIDRA] execução {execucao_id}: {status}")
+    try:
+        agg = refresh_fato_agregado(engine)
+        print(f"[agregado] {agg['modo']}: {agg['chaves_alteradas']} chaves alteradas, {agg['chaves_removidas']} removidas")
+    except Exception as e:
+        print(f"[WARN] Falha ao atualizar fato_agregado_anual: {e}")
+    return total
+
+def bootstrap_all(
+    data_dir: str,
+    groups: list[str] | None = None,
+    modo: str = "ultimo",
+    anos: tuple[int, int] | None = None,
+    retomar: bool = False,
+    progresso: ColetaProgresso | None = None,
+):
+    _check_modo(modo, anos)
     engine = get_engine()
     ensure_all(engine)
+    progresso = progresso or ColetaProgresso()
+    progresso.set(etapa="planilha")
 
     # arquivo de entrada
     candidates = [
@@ -520,50 +2078,161 @@ def bootstrap_all(data_dir: str, groups: list[str] | None = None):
 
     df = load_municipios_filiais_from_excel(muni_xlsx)
     upsert_municipios_filiais(df, engine)
+    correcoes = os.path.join(data_dir, "codigo_municipio_correcoes.xlsx")
+    if os.path.exists(correcoes):
+        n_man = import_aliases_manuais(pd.read_excel(correcoes), engine)
+        print(f"[IBGE códigos] Correções manuais: {n_man} aliases")
+    progresso.check_cancel()
+    progresso.set(etapa="matching")
     n = match_cods_ibge(engine)
+    progresso.set(municipios_casados=n)
     print(f"[IBGE códigos] Atualizados: {n} municípios")
 
     # grupos (parametrizável)
-    groups_to_run = groups or ["vegetal", "rebanho", "aquicultura"]
-    total = 0
-    for grp in groups_to_run:
-        if grp not in TABLES:
-            print(f"[WARN] Grupo desconhecido: {grp} — ignorando")
-            continue
-        try:
-            up = collect_sidra_for_group(grp, engine, verbose=True)
-            print(f"[SIDRA] grupo={grp} upserts={up}")
-            total += up
-        except Exception as e:
-            print(f"[WARN] Falha ao coletar grupo {grp}: {e} (seguindo)")
-    return total
-# --- [REFRESH MATERIALIZED VIEWS] -------------------------------------------
-from db import get_engine
+    return run_coleta(groups, modo, anos, engine, retomar=retomar, progresso=progresso)
 
-def refresh_materialized_views(concurrently: bool = False) -> list[str]:
-    """
-    Atualiza as materialized views usadas no BI.
-    Se concurrently=True, tenta usar REFRESH CONCURRENTLY (requer índice único).
-    Retorna a lista de MVs atualizadas.
-    """
-    mv_names = ["public.mv_fato_ultimo_ano"]
-    clause = "CONCURRENTLY " if concurrently else ""
-    stmt_tpl = f"REFRESH MATERIALIZED VIEW {clause}{{mv}};"
+# ---------------- agregado anual e materialized views ----------------
 
-    eng = get_engine()
-    with eng.begin() as conn:
-        for mv in mv_names:
-            conn.exec_driver_sql(stmt_tpl.format(mv=mv))
-    return mv_names
+_AGG_KEY = ("filial", "uf", "grupo", "produto_nome", "unidade", "ano")
 
-# --- [REFRESH MATERIALIZED VIEWS] -------------------------------------------
+def _filiais_hash(conn) -> str:
+    return conn.execute(
+        text(
+            "SELECT md5(COALESCE(string_agg(filial || '|' || COALESCE(codigo_ibge::text, ''), ',' "
+            "ORDER BY filial, codigo_ibge), '')) FROM public.municipios_filiais"
+        )
+    ).scalar_one()
 
-from db import get_engine
+def refresh_fato_agregado(engine=None, completo: bool = False) -> dict:
+    """
+    Atualiza fato_agregado_anual (soma por filial/uf/grupo/produto/unidade/ano, todos os anos)
+    só nas chaves tocadas pelo sidra_changelog desde a última atualização. Recalcula
+    tudo se completo=True, na primeira vez ou se municipios_filiais mudou.
+    Só grava chaves cujo valor mudou; retorna as chaves alteradas/removidas. Depois
+    poda o changelog consumido mais antigo que SIDRA_CHANGELOG_RETENCAO_DIAS.
+    """
+    engine = engine or get_engine()
+    key = ", ".join(_AGG_KEY)
+    base = """
+        SELECT f.filial, COALESCE(d.uf, mi.uf, '') AS uf, COALESCE(g.grupo, 'desconhecido') AS grupo,
+               COALESCE(d.produto_nome, '') AS produto_nome, COALESCE(d.unidade, '') AS unidade,
+               d.ano, d.valor_num, d.cod_municipio
+        FROM public.municipios_filiais f
+        JOIN public.dados_sidra_brutos d ON d.cod_municipio = f.codigo_ibge
+        LEFT JOIN public.municipios_ibge mi ON mi.codigo_ibge = d.cod_municipio
+        LEFT JOIN public.dim_grupo_sidra g ON g.tabela = d.tabela
+    """
+    with engine.begin() as conn:
+        # uma atualização por vez (coleta e endpoint podem disparar juntos)
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('fato_agregado_anual'))"))
+        estado = conn.execute(
+            text("SELECT changelog_id, filiais_hash FROM public.fato_agregado_estado WHERE id = 1")
+        ).first()
+        ate = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM public.sidra_changelog")).scalar_one()
+        fhash = _filiais_hash(conn)
+        completo = completo or estado is None or estado[1] != fhash
+        de = 0 if completo else int(estado[0])
+
+        if completo:
+            conn.execute(text(f"CREATE TEMP TABLE _agg_novos ON COMMIT DROP AS SELECT {key}, "
+                              f"SUM(valor_num) AS valor, COUNT(DISTINCT cod_municipio) AS municipios "
+                              f"FROM ({base}) b GROUP BY {key}"))
+        else:
+            # chaves tocadas pelo changelog -> recalcula só elas
+            conn.execute(
+                text(
+                    f"""
+                    CREATE TEMP TABLE _agg_chaves ON COMMIT DROP AS
+                    SELECT DISTINCT {key} FROM ({base}
+                        JOIN public.sidra_changelog c
+                          ON c.tabela = d.tabela AND c.variavel = d.variavel AND c.ano = d.ano
+                         AND c.cod_municipio = d.cod_municipio AND c.produto_codigo IS NOT DISTINCT FROM d.produto_codigo
+                        WHERE c.id > :de AND c.id <= :ate) b
+                    """
+                ),
+                {"de": de, "ate": ate},
+            )
+            conn.execute(text(
+                f"""
+                CREATE TEMP TABLE _agg_novos ON COMMIT DROP AS
+                SELECT {", ".join(f"b.{c}" for c in _AGG_KEY)},
+                       SUM(b.valor_num) AS valor, COUNT(DISTINCT b.cod_municipio) AS municipios
+                FROM ({base}
+                    WHERE d.ano IN (SELECT DISTINCT ano FROM _agg_chaves)
+                      AND f.filial IN (SELECT DISTINCT filial FROM _agg_chaves)) b
+                JOIN _agg_chaves k USING ({key})
+                GROUP BY {", ".join(f"b.{c}" for c in _AGG_KEY)}
+                """
+            ))
+
+        alteradas = conn.execute(
+            text(
+                f"""
+                INSERT INTO public.fato_agregado_anual AS a ({key}, valor, municipios)
+                SELECT {key}, valor, municipios FROM _agg_novos
+                ON CONFLICT ({key}) DO UPDATE SET
+                    valor = EXCLUDED.valor, municipios = EXCLUDED.municipios, atualizado_em = NOW()
+                WHERE (a.valor, a.municipios) IS DISTINCT FROM (EXCLUDED.valor, EXCLUDED.municipios)
+                RETURNING {key}, valor
+                """
+            )
+        ).mappings().all()
+        # chave sem linhas de origem (ex.: município saiu da filial) some do agregado. Só no
+        # completo: a gravação nunca apaga fato nem muda colunas da chave, então no incremental
+        # nenhuma chave perde linhas (mudança de filiais já força o completo)
+        removidas = []
+        if completo:
+            removidas = conn.execute(
+                text(
+                    f"""
+                    DELETE FROM public.fato_agregado_anual a
+                    WHERE NOT EXISTS (SELECT 1 FROM _agg_novos n WHERE ({", ".join(f"n.{c}" for c in _AGG_KEY)})
+                                      = ({", ".join(f"a.{c}" for c in _AGG_KEY)}))
+                    RETURNING {key}
+                    """
+                )
+            ).mappings().all()
+        conn.execute(
+            text(
+                """
+                INSERT INTO public.fato_agregado_estado (id, changelog_id, filiais_hash, atualizado_em)
+                VALUES (1, :ate, :h, NOW())
+                ON CONFLICT (id) DO UPDATE SET
+                    changelog_id = EXCLUDED.changelog_id, filiais_hash = EXCLUDED.filiais_hash,
+                    atualizado_em = NOW()
+                """
+            ),
+            {"ate": ate, "h": fhash},
+        )
+        # changelog já consumido pelo agregado: guarda só os últimos SIDRA_CHANGELOG_RETENCAO_DIAS
+        # (auditoria); negativo = nunca apaga
+        retencao = int(os.getenv("SIDRA_CHANGELOG_RETENCAO_DIAS", "30"))
+        podadas = 0
+        if retencao >= 0:
+            podadas = conn.execute(
+                text(
+                    "DELETE FROM public.sidra_changelog WHERE id <= :ate "
+                    "AND alterado_em < NOW() - make_interval(days => :dias)"
+                ),
+                {"ate": ate, "dias": retencao},
+            ).rowcount
+    limite = int(os.getenv("AGREGADO_MAX_CHAVES_RESPOSTA", "500"))
+    return {
+        "modo": "completo" if completo else "incremental",
+        "changelog_de": de,
+        "changelog_ate": int(ate),
+        "chaves_alteradas": len(alteradas),
+        "chaves_removidas": len(removidas),
+        "changelog_podado": int(podadas),
+        "alteradas": [dict(r) for r in alteradas[:limite]],
+        "removidas": [dict(r) for r in removidas[:limite]],
+    }
 
 def refresh_materialized_views(concurrently: bool = False) -> list[str]:
     """
     Atualiza as materialized views usadas no BI.
-    Se concurrently=True, tenta usar REFRESH CONCURRENTLY (requer índice único).
+    Se concurrently=True, usa REFRESH CONCURRENTLY (índice único criado em db_views.sql),
+    sem bloquear leituras.
     Retorna a lista de MVs atualizadas.
     """
     mv_names = ["public.mv_fato_ultimo_ano"]
@@ -1,7 +1,9 @@
 import os
+import datetime
+import itertools
 from typing import Optional
-from fastapi import FastAPI, HTTPException, Body, Query
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Body, Query, Request
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from logic import refresh_materialized_views
 
 app = FastAPI(title="AFUBRA IBGE/SIDRA Automation", version="1.1.0")
@@ -11,10 +13,67 @@ def L():
     import importlib
     return importlib.import_module("logic")
 
+def _anos(ano_ini: Optional[int], ano_fim: Optional[int]):
+    if ano_ini is None:
+        return None
+    return (ano_ini, ano_fim or datetime.date.today().year)
+
+def _enqueue(tipo: str, params: dict):
+    import jobs
+    try:
+        job_id = jobs.enqueue(tipo, params)
+    except jobs.JobDuplicado as jd:
+        raise HTTPException(status_code=409, detail=str(jd))
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return JSONResponse({"ok": True, "job_id": job_id, "status_url": f"/jobs/{job_id}"}, status_code=202)
+
+def _executar(tipo: str, params: dict):
+    """Roda o job na própria requisição: mesma trava de /jobs (409 se já há coleta ativa)."""
+    import jobs
+    try:
+        return jobs.executar(tipo, params)
+    except jobs.JobDuplicado as jd:
+        raise HTTPException(status_code=409, detail=str(jd))
+    except L().ColetaCancelada as ce:
+        raise HTTPException(status_code=409, detail=str(ce))
+    except FileNotFoundError as fe:
+        raise HTTPException(status_code=404, detail=str(fe))
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+@app.get("/metrics")
+def metrics():
+    try:
+        import db
+        return {"db_pool": db.get_pool_metrics()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/cache")
+def cache_stats():
+    try:
+        import http_cache
+        return http_cache.stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/cache/purge")
+def cache_purge(padrao: Optional[str] = Query(None, description="Apaga só URLs que contêm este trecho")):
+    try:
+        import http_cache
+        return {"ok": True, "removidos": http_cache.purge(padrao)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/init")
 def init():
     try:
@@ -28,47 +87,162 @@ def init():
 def bootstrap(
     req: dict | None = Body(None),
     groups: Optional[str] = Query(None, description="Ex.: vegetal,rebanho (aquicultura opcional)"),
+    modo: str = Query("ultimo", description="ultimo | incremental | backfill"),
+    ano_ini: Optional[int] = Query(None, description="Backfill: primeiro ano"),
+    ano_fim: Optional[int] = Query(None, description="Backfill: último ano (padrão: ano atual)"),
+    retomar: bool = Query(False, description="Continua a última execução interrompida, pulando o que já foi gravado"),
+    background: bool = Query(False, description="Roda como job e responde 202 (ver /jobs/{id})"),
 ):
     data_dir = (req or {}).get("data_dir") or os.getenv("DATA_DIR") or "/data"
     groups_list = [g.strip() for g in groups.split(",")] if groups else None
-    try:
-        logic = L()
-        up = logic.bootstrap_all(data_dir, groups=groups_list)
-        return {"ok": True, "upserts": up}
-    except FileNotFoundError as fe:
-        raise HTTPException(status_code=404, detail=str(fe))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    params = {
+        "data_dir": data_dir, "groups": groups_list, "modo": modo,
+        "anos": _anos(ano_ini, ano_fim), "retomar": retomar,
+    }
+    if background:
+        return _enqueue("bootstrap", params)
+    return {"ok": True, "upserts": _executar("bootstrap", params)}
 
 @app.get("/bootstrap")
 def bootstrap_get(
     data_dir: Optional[str] = Query(None),
     groups: Optional[str] = Query(None, description="Ex.: vegetal,rebanho (aquicultura opcional)"),
+    modo: str = Query("ultimo", description="ultimo | incremental | backfill"),
+    ano_ini: Optional[int] = Query(None, description="Backfill: primeiro ano"),
+    ano_fim: Optional[int] = Query(None, description="Backfill: último ano (padrão: ano atual)"),
+    retomar: bool = Query(False, description="Continua a última execução interrompida, pulando o que já foi gravado"),
+    background: bool = Query(False, description="Roda como job e responde 202 (ver /jobs/{id})"),
 ):
     data_dir = data_dir or os.getenv("DATA_DIR") or "/data"
+    groups_list = [g.strip() for g in groups.split(",")] if groups else None
+    params = {
+        "data_dir": data_dir, "groups": groups_list, "modo": modo,
+        "anos": _anos(ano_ini, ano_fim), "retomar": retomar,
+    }
+    if background:
+        return _enqueue("bootstrap", params)
+    return {"ok": True, "upserts": _executar("bootstrap", params)}
+
+@app.get("/coleta/plano")
+def coleta_plano(
+    groups: Optional[str] = Query(None, description="Ex.: vegetal,rebanho"),
+    modo: str = Query("ultimo", description="ultimo | incremental | backfill"),
+    ano_ini: Optional[int] = Query(None),
+    ano_fim: Optional[int] = Query(None),
+):
     groups_list = [g.strip() for g in groups.split(",")] if groups else None
     try:
         logic = L()
-        up = logic.bootstrap_all(data_dir, groups=groups_list)
-        return {"ok": True, "upserts": up}
-    except FileNotFoundError as fe:
-        raise HTTPException(status_code=404, detail=str(fe))
+        grupos = logic.plan_coleta(groups_list, modo=modo, anos=_anos(ano_ini, ano_fim))
+        return {"requisicoes_total": sum(g["requisicoes"] for g in grupos), "grupos": grupos}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/coleta/execucoes")
+def coleta_execucoes(limit: int = Query(20, ge=1, le=200)):
+    try:
+        logic = L()
+        return {"items": logic.list_execucoes(logic.get_engine(), limit=limit)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/coleta/dead-letter")
+def coleta_dead_letter(pendentes: bool = Query(True)):
+    try:
+        logic = L()
+        return {"items": logic.list_dead_letters(logic.get_engine(), pendentes=pendentes)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/coleta/dead-letter/replay")
+def coleta_dead_letter_replay(
+    grupo: Optional[str] = Query(None),
+    background: bool = Query(False, description="Roda como job e responde 202 (ver /jobs/{id})"),
+):
+    if background:
+        return _enqueue("dead_letter", {"grupo": grupo})
+    return {"ok": True, **_executar("dead_letter", {"grupo": grupo})}
+
+@app.get("/coleta/progresso")
+def coleta_progresso():
+    try:
+        import jobs
+        return jobs.progresso_coleta()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/jobs/bootstrap", status_code=202)
+def jobs_bootstrap(
+    req: dict | None = Body(None),
+    groups: Optional[str] = Query(None, description="Ex.: vegetal,rebanho"),
+    modo: str = Query("ultimo", description="ultimo | incremental | backfill"),
+    ano_ini: Optional[int] = Query(None),
+    ano_fim: Optional[int] = Query(None),
+    retomar: bool = Query(False, description="Continua a última execução interrompida"),
+):
+    data_dir = (req or {}).get("data_dir") or os.getenv("DATA_DIR") or "/data"
+    groups_list = [g.strip() for g in groups.split(",")] if groups else None
+    return _enqueue("bootstrap", {
+        "data_dir": data_dir, "groups": groups_list, "modo": modo,
+        "anos": _anos(ano_ini, ano_fim), "retomar": retomar,
+    })
+
+@app.post("/jobs/coleta", status_code=202)
+def jobs_coleta(
+    groups: Optional[str] = Query(None, description="Ex.: vegetal,rebanho"),
+    modo: str = Query("ultimo", description="ultimo | incremental | backfill"),
+    ano_ini: Optional[int] = Query(None),
+    ano_fim: Optional[int] = Query(None),
+    retomar: bool = Query(False, description="Continua a última execução interrompida"),
+):
+    groups_list = [g.strip() for g in groups.split(",")] if groups else None
+    return _enqueue("coleta", {"groups": groups_list, "modo": modo, "anos": _anos(ano_ini, ano_fim), "retomar": retomar})
+
+@app.get("/jobs")
+def jobs_list(limit: int = Query(20, ge=1, le=200)):
+    try:
+        import jobs
+        return {"items": jobs.list_jobs(limit)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+def jobs_get(job_id: int):
+    try:
+        import jobs
+        job = jobs.get_job(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} não encontrado.")
+    return job
+
+@app.post("/jobs/{job_id}/cancel")
+def jobs_cancel(job_id: int):
+    try:
+        import jobs
+        ok = jobs.cancel_job(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not ok:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} não encontrado ou já finalizado.")
+    return {"ok": True, "job_id": job_id, "cancelamento": "solicitado"}
+
 @app.get("/status")
-def status():
+def status(fresco: bool = Query(False, description="Ignora o cache e recalcula")):
     try:
         logic = L()
-        return logic.get_status(logic.get_engine())
+        return logic.get_status(logic.get_engine(), usar_cache=not fresco)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/auditoria/duplicados")
-def auditoria_duplicados():
+def auditoria_duplicados(limit: int = Query(100, ge=1, le=5000), offset: int = Query(0, ge=0)):
     try:
         logic = L()
-        return {"items": logic.get_codigos_duplicados(logic.get_engine())}
+        return {**logic.get_codigos_duplicados(logic.get_engine(), limit=limit, offset=offset), "limit": limit, "offset": offset}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -85,6 +259,34 @@ def auditoria_lookup_xlsx():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/auditoria/correcoes")
+def auditoria_correcoes(itens: list[dict] = Body(..., description='[{"uf": "RS", "nome_municipio": "...", "codigo_ibge": 4300000}]')):
+    try:
+        logic = L()
+        import pandas as pd
+        n = logic.import_aliases_manuais(pd.DataFrame(itens), logic.get_engine())
+        return {"ok": True, "aliases": n}
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/ibge/municipios/refresh")
+def ibge_municipios_refresh():
+    try:
+        logic = L()
+        return {"ok": True, **logic.refresh_municipios_ibge(logic.get_engine())}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/ibge/municipios/versoes")
+def ibge_municipios_versoes():
+    try:
+        logic = L()
+        return {"items": logic.list_versoes_municipios_ibge(logic.get_engine())}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/produtos")
 def produtos(ano: Optional[int] = Query(None)):
     try:
@@ -93,35 +295,194 @@ def produtos(ano: Optional[int] = Query(None)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+DADOS_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+@app.get("/dados")
+def dados(
+    ano_ini: Optional[int] = Query(None),
+    ano_fim: Optional[int] = Query(None),
+    filial: Optional[list[str]] = Query(None, description="Repetível: ?filial=A&filial=B"),
+    grupo: Optional[str] = Query(None, description="Ex.: vegetal,rebanho"),
+    produto: Optional[list[str]] = Query(None, description="Repetível: ?produto=Fumo (em folha)&produto=..."),
+    uf: Optional[str] = Query(None, description="Ex.: RS,SC"),
+    exclusiva: bool = Query(False, description="Cada município numa só filial (sem dupla contagem)"),
+    formato: str = Query("ndjson", description="ndjson | csv | arrow (Arrow IPC stream)"),
+    apos: Optional[str] = Query(None, description="Próxima página: 'ano,dado_id,filial' da última linha recebida"),
+    limite: Optional[int] = Query(None, ge=1, description="Máximo de linhas (padrão: todas)"),
+):
+    """
+    Linhas do fato (filial x município x produto x ano) em streaming, ordenadas por
+    (ano, dado_id, filial). Sem `limite` devolve tudo; com `limite`, pagine passando
+    em `apos` a chave da última linha recebida.
+    """
+    try:
+        logic = L()
+        consulta = logic.consulta_dados(
+            ano_ini=ano_ini,
+            ano_fim=ano_fim,
+            filiais=filial,
+            grupos=[g.strip() for g in grupo.split(",")] if grupo else None,
+            produtos=produto,
+            ufs=[u.strip() for u in uf.split(",")] if uf else None,
+            exclusiva=exclusiva,
+            apos=logic.parse_chave_dados(apos) if apos else None,
+            limite=limite,
+        )
+        if formato == "arrow":
+            it = logic.iter_dados_arrow(consulta, logic.get_engine())
+        else:
+            it = logic.iter_dados_texto(consulta, formato, logic.get_engine())
+        # primeiro bloco já aqui: erro de filtro/consulta vira 400/500 e não resposta cortada
+        primeiro = next(it)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(itertools.chain([primeiro], it), media_type=DADOS_MEDIA_TYPES[formato])
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def _cached_xlsx(
+    request: Request,
+    nome: str,
+    build,
+    filename_tpl: str,
+    extra: str = "",
+    ext: str = ".xlsx",
+    media_type: str = XLSX_MEDIA_TYPE,
+):
+    import report_cache
+    logic = L()
+    path, etag, ano = report_cache.get_or_build(logic.get_engine(), nome, build, extra, ext=ext)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, max-age=0, must-revalidate"}
+    if report_cache.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(
+        str(path),
+        media_type=media_type,
+        filename=filename_tpl.format(ano=ano),
+        headers=headers,
+    )
+
 @app.get("/relatorio/x.xlsx")
-def relatorio_xlsx():
+def relatorio_xlsx(request: Request):
     try:
         logic = L()
-        tmp_path = "/app/_relatorio_filiais.xlsx"
-        ano = logic.export_excel_por_filial(tmp_path, logic.get_engine())
-        filename = f"relatorio_filiais_{ano}.xlsx"
-        return FileResponse(
-            tmp_path,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            filename=filename,
+        return _cached_xlsx(
+            request,
+            "relatorio_filiais",
+            lambda dest: logic.export_excel_por_filial(dest, logic.get_engine()),
+            "relatorio_filiais_{ano}.xlsx",
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/relatorio/filiais.zip")
+def relatorio_filiais_zip(request: Request):
+    try:
+        logic = L()
+        return _cached_xlsx(
+            request,
+            "relatorio_filiais_zip",
+            lambda dest: logic.export_filiais_zip(dest, logic.get_engine()),
+            "relatorios_por_filial_{ano}.zip",
+            ext=".zip",
+            media_type="application/zip",
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/relatorio/fato_parquet.zip")
+def relatorio_fato_parquet_zip(
+    request: Request,
+    formato: str = Query("parquet", description="parquet | arrow (Arrow IPC em arquivo)"),
+    ano_ini: Optional[int] = Query(None),
+    ano_fim: Optional[int] = Query(None),
+    grupo: Optional[str] = Query(None, description="Ex.: vegetal,rebanho"),
+    exclusiva: bool = Query(False, description="Cada município numa só filial (sem dupla contagem)"),
+):
+    """Fato tipado e comprimido, particionado ano=/grupo= (dataset Hive), num ZIP."""
+    grupos = [g.strip() for g in grupo.split(",")] if grupo else None
+    if formato not in ("parquet", "arrow"):
+        raise HTTPException(status_code=400, detail="formato deve ser parquet ou arrow.")
+    try:
+        logic = L()
+        filtros = {"formato": formato, "ano_ini": ano_ini, "ano_fim": ano_fim, "grupos": grupos, "exclusiva": exclusiva}
+        return _cached_xlsx(
+            request,
+            f"fato_{formato}",
+            lambda dest: logic.export_parquet_zip(dest, logic.get_engine(), **filtros),
+            f"fato_{formato}_{{ano}}.zip",
+            extra=repr(sorted(filtros.items())),
+            ext=".zip",
+            media_type="application/zip",
         )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/relatorio/{filial}.xlsx")
+def relatorio_filial_xlsx(filial: str, request: Request):
+    try:
+        logic = L()
+        if filial not in logic.list_filiais(logic.get_engine()):
+            raise HTTPException(status_code=404, detail=f"Filial não encontrada: {filial}")
+        slug = logic.filial_slug(filial)
+        return _cached_xlsx(
+            request,
+            f"relatorio_filial_{slug}",
+            lambda dest: logic.export_excel_por_filial(dest, logic.get_engine(), filiais=[filial]),
+            f"relatorio_{slug}_{{ano}}.xlsx",
+            extra=filial,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 from fastapi import HTTPException
 
 @app.post("/db/refresh-mv")
-def api_refresh_mv(concurrently: bool = False):
+def api_refresh_mv(
+    concurrently: bool = False,
+    completo: bool = Query(False, description="Recalcula o agregado inteiro em vez de só o que mudou"),
+    mv: bool = Query(True, description="Também atualiza mv_fato_ultimo_ano"),
+):
     """
-    Atualiza as MVs (por padrão sem bloquear leitura).
-    Use ?concurrently=true para tentar REFRESH CONCURRENTLY (requer índice único).
+    Atualiza fato_agregado_anual (incremental, pelas linhas alteradas desde a última vez)
+    e as MVs. Use ?concurrently=true para REFRESH CONCURRENTLY (sem bloquear leitura).
     """
     try:
-        mv_list = refresh_materialized_views(concurrently=concurrently)
-        return {"ok": True, "refreshed": mv_list, "concurrently": concurrently}
+        logic = L()
+        agg = logic.refresh_fato_agregado(completo=completo)
+        mv_list = refresh_materialized_views(concurrently=concurrently) if mv else []
+        return {"ok": True, "refreshed": mv_list, "concurrently": concurrently, "agregado": agg}
     except Exception as e:
         # devolve erro legível no JSON
         raise HTTPException(status_code=500, detail=f"Falha ao atualizar MV: {e}")
 
+@app.post("/db/particionar")
+def api_particionar(sub_tabela: bool = Query(False, description="Sub-particiona cada ano por tabela SIDRA")):
+    """Converte dados_sidra_brutos em tabela particionada por ano (bloqueia a tabela durante a cópia)."""
+    try:
+        import db
+        return db.migrar_dados_sidra_particionada(db.get_engine(), sub_tabela=sub_tabela)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Falha ao particionar: {e}")
+
+@app.get("/db/particoes")
+def api_particoes():
+    try:
+        import db
+        return {"items": db.list_particoes_sidra(db.get_engine())}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/")
 def root():
     return HTMLResponse("""
@@ -130,14 +491,33 @@ def root():
       <h2>AFUBRA IBGE/SIDRA — API</h2>
       <ul>
         <li>GET <code>/health</code></li>
+        <li>GET <code>/metrics</code> — pool de conexões do banco (checkouts, esperas)</li>
+        <li>GET <code>/cache</code> / POST <code>/cache/purge?padrao=metadados</code> — cache local das APIs do IBGE</li>
         <li>POST <code>/init</code></li>
-        <li>POST <code>/bootstrap</code> — body opcional: {"data_dir": "/data"}; query opcional: <code>?groups=vegetal,rebanho</code></li>
+        <li>POST <code>/bootstrap</code> — body opcional: {"data_dir": "/data"}; query opcional: <code>?groups=vegetal,rebanho&modo=incremental</code></li>
         <li>GET <code>/bootstrap?data_dir=/data&groups=vegetal,rebanho</code></li>
-        <li>GET <code>/status</code> — contagens, ano mais recente, linhas por grupo</li>
-        <li>GET <code>/auditoria/duplicados</code> — códigos IBGE presentes em mais de uma filial</li>
+        <li>POST <code>/bootstrap?modo=backfill&ano_ini=2000&ano_fim=2023</code> — histórico por intervalo de anos (retomável)</li>
+        <li>POST <code>/jobs/bootstrap</code> / <code>/jobs/coleta</code> — roda em segundo plano (202 + id); também <code>/bootstrap?background=true</code></li>
+        <li>GET <code>/jobs</code> / <code>/jobs/{id}</code> — estado e progresso; POST <code>/jobs/{id}/cancel</code> — cancela</li>
+        <li>GET <code>/coleta/plano?modo=backfill&ano_ini=2000</code> — quantas requisições a coleta fará (sem executar)</li>
+        <li>POST <code>/bootstrap?retomar=true</code> — continua a última coleta interrompida (pula requisições já gravadas)</li>
+        <li>GET <code>/coleta/execucoes</code> — execuções da coleta e checkpoints concluídos/planejados</li>
+        <li>GET <code>/coleta/progresso</code> — contadores da coleta em andamento, vazão/fila por estágio e estado do disjuntor</li>
+        <li>GET <code>/coleta/dead-letter</code> / POST <code>/coleta/dead-letter/replay</code> — requisições que falharam (<code>?background=true</code> como job)</li>
+        <li>GET <code>/status</code> — contagens, ano mais recente, linhas por grupo (em cache até os dados mudarem; <code>?fresco=true</code> recalcula)</li>
+        <li>GET <code>/auditoria/duplicados?limit=100&offset=0</code> — códigos IBGE presentes em mais de uma filial</li>
         <li>GET <code>/auditoria/lookup.xlsx</code> — arquivo para conferência/substituição</li>
+        <li>POST <code>/auditoria/correcoes</code> — correções manuais nome→código (prioridade sobre o casamento automático)</li>
+        <li>POST <code>/ibge/municipios/refresh</code> — atualiza a tabela local de municípios do IBGE (todas as UFs)</li>
+        <li>GET <code>/ibge/municipios/versoes</code> — histórico das atualizações dessa tabela</li>
         <li>GET <code>/produtos</code> — lista de produtos no último ano</li>
-        <li>GET <code>/relatorio/x.xlsx</code> — planilha final (abas por filial)</li>
+        <li>GET <code>/dados?ano_ini=2020&grupo=vegetal&uf=RS&formato=csv</code> — fato em streaming (NDJSON/CSV); <code>&limite=50000&apos=ano,dado_id,filial</code> pagina por chave; <code>formato=arrow</code> = Arrow IPC stream</li>
+        <li>GET <code>/relatorio/fato_parquet.zip?ano_ini=2015&grupo=vegetal</code> — fato em Parquet (ou <code>formato=arrow</code>) particionado por ano/grupo</li>
+        <li>GET <code>/relatorio/x.xlsx</code> — planilha final (abas por filial); gerada só quando os dados mudam, com ETag</li>
+        <li>GET <code>/relatorio/{filial}.xlsx</code> — planilha de uma filial só</li>
+        <li>GET <code>/relatorio/filiais.zip</code> — um xlsx por filial, gerados em paralelo</li>
+        <li>POST <code>/db/refresh-mv?concurrently=true</code> — atualiza o agregado anual (só o que mudou) e a MV; lista as chaves alteradas</li>
+        <li>POST <code>/db/particionar?sub_tabela=false</code> — migra dados_sidra_brutos para partições por ano; GET <code>/db/particoes</code> — lista</li>
       </ul>
     </body></html>
     """)
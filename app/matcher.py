@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process as rf_process
+
+class MunicipioMatcher:
+    """
+    Casa nomes normalizados de municípios com os códigos do IBGE.
+    - índice por UF montado uma vez (nomes + códigos)
+    - caminho rápido: igualdade exata via dicionário
+    - restante: um rapidfuzz.process.cdist por UF, em lotes, com `workers`
+      threads nativas (MATCH_WORKERS; -1 = todos os núcleos)
+    """
+
+    def __init__(
+        self,
+        df_ibge: pd.DataFrame,
+        score_threshold: int = 88,
+        workers: int | None = None,
+        ufs_sem_uf: list[str] | None = None,
+    ):
+        self.score_threshold = score_threshold
+        self.workers = workers if workers is not None else int(os.getenv("MATCH_WORKERS", "1"))
+        self.batch = int(os.getenv("MATCH_BATCH", "2000"))
+        self.por_uf = {}
+        self.exato = {}
+        for uf, g in df_ibge.groupby("uf", sort=False):
+            nomes = g["nome_normalizado"].tolist()
+            codigos = g["codigo_ibge"].astype(int).to_numpy()
+            self.por_uf[uf] = (nomes, codigos, [uf] * len(nomes))
+            for nome, cod in zip(nomes, codigos):
+                self.exato.setdefault((uf, nome), int(cod))
+        # pool sem UF (linhas da planilha sem estado): municípios de `ufs_sem_uf` (ou todos)
+        pool = df_ibge[df_ibge["uf"].isin(ufs_sem_uf)] if ufs_sem_uf else df_ibge
+        self.todos = (
+            pool["nome_normalizado"].tolist(),
+            pool["codigo_ibge"].astype(int).to_numpy(),
+            pool["uf"].tolist(),
+        )
+        for nome, cod, uf in zip(*self.todos):
+            self.exato.setdefault(("", nome), (int(cod), uf))
+
+    def match(self, rows) -> list[tuple[int, int, str, float, str]]:
+        """
+        rows: iterável de (id, uf, nome_normalizado); uf "" = qualquer UF.
+        Retorna [(id, codigo_ibge, uf, score, fonte)] só para os casados,
+        com fonte "exato" ou "fuzzy".
+        """
+        out = []
+        pendentes = {}
+        for rid, uf, nome in rows:
+            uf = uf or ""
+            nome = nome or ""
+            hit = self.exato.get((uf, nome))
+            if hit is not None:
+                cod, uf_hit = hit if uf == "" else (hit, uf)
+                out.append((rid, cod, uf_hit, 100.0, "exato"))
+            elif uf == "" or uf in self.por_uf:
+                pendentes.setdefault(uf, []).append((rid, nome))
+
+        for uf, itens in pendentes.items():
+            nomes, codigos, ufs = self.todos if uf == "" else self.por_uf[uf]
+            if not nomes:
+                continue
+            for i in range(0, len(itens), self.batch):
+                lote = itens[i:i + self.batch]
+                # scores em float (padrão): arredondar para inteiro aceitaria 87.5 com limiar 88
+                # e criaria empates falsos no argmax
+                scores = rf_process.cdist(
+                    [n for _, n in lote], nomes, scorer=fuzz.WRatio, workers=self.workers,
+                )
+                best = scores.argmax(axis=1)
+                best_score = scores[np.arange(len(lote)), best]
+                for (rid, _), j, sc in zip(lote, best, best_score):
+                    if sc >= self.score_threshold:
+                        out.append((rid, int(codigos[j]), ufs[j], float(sc), "fuzzy"))
+        return out
@@ -0,0 +1,185 @@
+"""
+Pipeline em estágios ligados por filas limitadas (produtor/consumidor).
+
+    fonte (thread) -> fila -> etapa (thread) -> fila -> ... -> destino (thread chamadora)
+
+Cada fila tem no máximo `maxsize` itens: quando o destino (ex.: gravação no
+Postgres) fica lento, as filas enchem e os estágios anteriores param no put(),
+o que segura a fonte (ex.: novas requisições HTTP) em vez de crescer a memória.
+
+Métricas por estágio (metricas()): itens, itens/s, tempo ocupado, tempo
+esperando entrada (estágio ocioso) e esperando saída (contrapressão), e a
+profundidade atual/máxima da fila de saída. O estágio mais ocupado é o gargalo.
+"""
+import queue
+import threading
+import time
+
+_FIM = object()
+_POLL_S = 0.2
+
+class _Estagio:
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.itens = 0
+        self.ocupado_s = 0.0
+        self.espera_entrada_s = 0.0
+        self.espera_saida_s = 0.0
+        self.saida: queue.Queue | None = None
+        self.fila_max = 0
+
+    def metricas(self, decorrido: float) -> dict:
+        d = {
+            "itens": self.itens,
+            "itens_s": round(self.itens / decorrido, 2) if decorrido > 0 else 0.0,
+            "ocupado_s": round(self.ocupado_s, 2),
+            "ocupado_pct": round(100 * self.ocupado_s / decorrido, 1) if decorrido > 0 else 0.0,
+            "espera_entrada_s": round(self.espera_entrada_s, 2),
+            "espera_saida_s": round(self.espera_saida_s, 2),
+        }
+        if self.saida is not None:
+            d["fila"] = self.saida.qsize()
+            d["fila_max"] = self.fila_max
+        return d
+
+class Pipeline:
+    """
+    estagios: [(nome, fonte), (nome, fn), ..., (nome, destino)]
+      - fonte(): iterável de itens (roda numa thread própria)
+      - fn(item): devolve o item transformado (uma thread por etapa)
+      - destino(item): consome o item, na thread que chamou run()
+    Exceção em qualquer estágio para os demais e é relançada por run().
+    """
+
+    def __init__(self, estagios: list, maxsize: int = 8, on_metricas=None, intervalo_s: float = 1.0):
+        if len(estagios) < 2:
+            raise ValueError("Pipeline precisa de ao menos fonte e destino.")
+        self.estagios = estagios
+        self.maxsize = max(1, int(maxsize))
+        self.on_metricas = on_metricas
+        self.intervalo_s = intervalo_s
+        self._stats = [_Estagio(nome) for nome, _ in estagios]
+        self._stop = threading.Event()
+        self._erros: list[BaseException] = []
+        self._inicio = time.perf_counter()
+
+    def metricas(self) -> dict:
+        decorrido = time.perf_counter() - self._inicio
+        estagios = {s.nome: s.metricas(decorrido) for s in self._stats}
+        gargalo = max(self._stats, key=lambda s: s.ocupado_s).nome
+        return {"estagios": estagios, "gargalo": gargalo, "maxsize_fila": self.maxsize}
+
+    def _put(self, st: _Estagio, item) -> bool:
+        t0 = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    st.saida.put(item, timeout=_POLL_S)
+                    st.fila_max = max(st.fila_max, st.saida.qsize())
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            st.espera_saida_s += time.perf_counter() - t0
+
+    def _get(self, st: _Estagio, entrada: queue.Queue):
+        t0 = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    return entrada.get(timeout=_POLL_S)
+                except queue.Empty:
+                    continue
+            return _FIM
+        finally:
+            st.espera_entrada_s += time.perf_counter() - t0
+
+    def _falhou(self, e: BaseException):
+        self._erros.append(e)
+        self._stop.set()
+
+    def _run_fonte(self, st: _Estagio, fonte):
+        it = iter(fonte())
+        try:
+            while not self._stop.is_set():
+                t0 = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    st.ocupado_s += time.perf_counter() - t0
+                st.itens += 1
+                if not self._put(st, item):
+                    break
+            self._put(st, _FIM)
+        except BaseException as e:
+            self._falhou(e)
+        finally:
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    def _run_etapa(self, st: _Estagio, fn, entrada: queue.Queue):
+        try:
+            while True:
+                item = self._get(st, entrada)
+                if item is _FIM:
+                    self._put(st, _FIM)
+                    return
+                t0 = time.perf_counter()
+                out = fn(item)
+                st.ocupado_s += time.perf_counter() - t0
+                st.itens += 1
+                if not self._put(st, out):
+                    return
+        except BaseException as e:
+            self._falhou(e)
+
+    def run(self) -> dict:
+        (_, fonte), *meio, (_, destino) = self.estagios
+        for st in self._stats[:-1]:
+            st.saida = queue.Queue(self.maxsize)
+        threads = [
+            threading.Thread(
+                target=self._run_fonte, args=(self._stats[0], fonte),
+                daemon=True, name=f"pipeline-{self._stats[0].nome}",
+            )
+        ]
+        for i, (_, fn) in enumerate(meio, start=1):
+            threads.append(
+                threading.Thread(
+                    target=self._run_etapa, args=(self._stats[i], fn, self._stats[i - 1].saida),
+                    daemon=True, name=f"pipeline-{self._stats[i].nome}",
+                )
+            )
+        for t in threads:
+            t.start()
+
+        st = self._stats[-1]
+        entrada = self._stats[-2].saida
+        ultimo = time.perf_counter()
+        try:
+            while True:
+                item = self._get(st, entrada)
+                if item is _FIM:
+                    break
+                t0 = time.perf_counter()
+                destino(item)
+                st.ocupado_s += time.perf_counter() - t0
+                st.itens += 1
+                if self.on_metricas and t0 - ultimo >= self.intervalo_s:
+                    ultimo = t0
+                    self.on_metricas(self.metricas())
+        except BaseException as e:
+            self._falhou(e)
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join()
+            if self.on_metricas:
+                self.on_metricas(self.metricas())
+        if self._erros:
+            raise self._erros[0]
+        return self.metricas()
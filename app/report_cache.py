@@ -0,0 +1,92 @@
+"""
+Cache de relatórios gerados (xlsx/zip), versionados pelos dados de origem.
+
+versão = hash(MAX(coleta_em) de dados_sidra_brutos, último ano, checksum de
+municipios_filiais). Cada versão vira um arquivo próprio (nunca sobrescrito
+durante um download) e o hash é usado como ETag. Mantém só os REPORT_CACHE_KEEP
+arquivos mais recentes de cada relatório.
+"""
+import os
+import re
+import hashlib
+import threading
+from pathlib import Path
+
+from sqlalchemy import text
+
+_LOCKS: dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+def cache_dir() -> Path:
+    return Path(os.getenv("REPORT_CACHE_DIR", "/app/_relatorios"))
+
+def data_version(engine) -> tuple[str, int | None]:
+    """(versão dos dados, último ano) numa única consulta."""
+    with engine.begin() as conn:
+        coleta, ano, munis = conn.execute(
+            text(
+                """
+                SELECT
+                  (SELECT MAX(coleta_em) FROM public.dados_sidra_brutos),
+                  (SELECT MAX(ano) FROM public.dados_sidra_brutos),
+                  (SELECT md5(string_agg(
+                      filial || '|' || nome_municipio || '|' || COALESCE(uf, '') || '|' ||
+                      COALESCE(codigo_ibge::text, ''), ',' ORDER BY id))
+                   FROM public.municipios_filiais)
+                """
+            )
+        ).one()
+    raw = f"{coleta}|{ano}|{munis}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16], (int(ano) if ano else None)
+
+def _lock_for(key: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(key, threading.Lock())
+
+def _prune(prefix: str, ext: str) -> None:
+    keep = max(1, int(os.getenv("REPORT_CACHE_KEEP", "5")))
+    # só {prefix}_{ano}_{etag}{ext}: o slug de outra filial pode começar com o mesmo prefixo (a / a_2)
+    padrao = re.compile(rf"{re.escape(prefix)}_\d+_[0-9a-f]{{20}}{re.escape(ext)}")
+    files = sorted(
+        (f for f in cache_dir().glob(f"{prefix}_*{ext}") if padrao.fullmatch(f.name)),
+        key=lambda f: f.stat().st_mtime,
+        reverse=True,
+    )
+    for f in files[keep:]:
+        try:
+            f.unlink()
+        except OSError:
+            pass
+
+def get_or_build(engine, nome: str, build, extra: str = "", ext: str = ".xlsx") -> tuple[Path, str, int | None]:
+    """
+    Devolve (arquivo, etag, ano) do relatório `nome` na versão atual dos dados,
+    chamando build(dest_path) só se essa versão ainda não foi gerada.
+    `extra` entra na chave (ex.: filtros do relatório).
+    """
+    versao, ano = data_version(engine)
+    if not ano:
+        raise RuntimeError("Sem dados para exportar. Rode a coleta.")
+    etag = hashlib.sha1(f"{nome}|{extra}|{versao}".encode("utf-8")).hexdigest()[:20]
+    d = cache_dir()
+    d.mkdir(parents=True, exist_ok=True)
+    path = d / f"{nome}_{ano}_{etag}{ext}"
+    if path.exists():
+        return path, etag, ano
+    with _lock_for(etag):
+        if not path.exists():
+            tmp = d / f".{path.name}.{threading.get_ident()}.tmp"
+            try:
+                build(str(tmp))
+                os.replace(tmp, path)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+            _prune(nome, ext)
+    return path, etag, ano
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/").strip('"') for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
@@ -0,0 +1,35 @@
+import os
+import shutil
+import argparse
+from app.logic import export_parquet
+from app.db import get_engine
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Exporta o fato (SIDRA x filiais) em Parquet/Arrow particionado por ano/grupo.")
+    ap.add_argument("--dest", default=os.path.join(os.getenv("DATA_DIR", "./data"), "fato_parquet"))
+    ap.add_argument("--formato", choices=["parquet", "arrow"], default="parquet")
+    ap.add_argument("--ano-ini", type=int)
+    ap.add_argument("--ano-fim", type=int)
+    ap.add_argument("--grupos", help="Ex.: vegetal,rebanho")
+    ap.add_argument("--exclusiva", action="store_true", help="Cada município numa só filial (sem dupla contagem)")
+    ap.add_argument("--substituir", action="store_true", help="Apaga uma exportação anterior em --dest")
+    args = ap.parse_args()
+
+    # só apaga o destino se ele contém apenas partições ano=... (exportação anterior)
+    if args.substituir and os.path.isdir(args.dest):
+        if all(n.startswith("ano=") for n in os.listdir(args.dest)):
+            shutil.rmtree(args.dest)
+        else:
+            raise SystemExit(f"[EXPORT] {args.dest} não parece uma exportação anterior; não apagado.")
+
+    print(f"[EXPORT] destino={args.dest} formato={args.formato}")
+    out = export_parquet(
+        args.dest,
+        get_engine(),
+        formato=args.formato,
+        ano_ini=args.ano_ini,
+        ano_fim=args.ano_fim,
+        grupos=[g.strip() for g in args.grupos.split(",")] if args.grupos else None,
+        exclusiva=args.exclusiva,
+    )
+    print(f"[EXPORT] {out['linhas']} linhas em {len(out['arquivos'])} arquivos")
@@ -1,11 +1,13 @@
 import os
-from app.logic import bootstrap_all, export_excel_por_filial
+from app.jobs import executar
+from app.logic import export_excel_por_filial
 from app.db import get_engine
 
 if __name__ == "__main__":
     data_dir = os.getenv("DATA_DIR", "./data")
     print(f"[RUN] DATA_DIR={data_dir}")
-    up = bootstrap_all(data_dir)
+    # como job (mesma trava da API): não roda junto com outra coleta
+    up = executar("bootstrap", {"data_dir": data_dir})
     print(f"[RUN] upserts={up}")
     engine = get_engine()
     out = os.path.join(data_dir, "relatorio_filiais.xlsx")
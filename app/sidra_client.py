@@ -1,5 +1,9 @@
+import math
 from urllib.parse import quote
-from utils import http_get_json
+
+import pandas as pd
+
+from utils import http_get_json, normalize_name, try_float_series
 
 BASE = "https://servicodados.ibge.gov.br/api/v3"
 
@@ -8,6 +12,12 @@ def get_agregado_metadados(agregado_id: int):
     url = f"{BASE}/agregados/{agregado_id}/metadados"
     return http_get_json(url)
 
+def get_agregado_periodos(agregado_id: int) -> list[dict]:
+    """Períodos disponíveis do agregado: [{"id": "2022", "literals": [...], "modificacao": "..."}]."""
+    url = f"{BASE}/agregados/{agregado_id}/periodos"
+    js = http_get_json(url)
+    return sorted(js or [], key=lambda p: str(p.get("id")))
+
 def find_variavel_id(meta: dict, like: str | None):
     """Procura variável cujo nome contém o texto informado (case-insensitive)."""
     if not meta or not like:
@@ -50,3 +60,158 @@ def build_values_url(
     # serializa preservando [] e vírgulas
     qs = "&".join(f"{k}={quote(v, safe='[] ,')}" for k, v in params)
     return f"{base}?{qs}"
+
+def _split_even(lst: list, max_size: int) -> list[list]:
+    """Divide em ceil(n/max_size) pedaços de tamanhos quase iguais (30+30+5 vira 22+22+21)."""
+    if not lst:
+        return []
+    k = math.ceil(len(lst) / max_size)
+    base, extra = divmod(len(lst), k)
+    out, i = [], 0
+    for j in range(k):
+        n = base + (1 if j < extra else 0)
+        out.append(lst[i:i + n])
+        i += n
+    return out
+
+def plan_values_requests(
+    agregado_id: int,
+    variavel_id: int,
+    class_id: int | None,
+    cat_ids: list[int],
+    codigos_localidade: list[int],
+    periodos: list[str],
+    max_valores: int = 50000,
+    max_url: int = 4000,
+    localidade_nivel: str = "n6",
+) -> list[tuple[int, list[str], list[int], list[int], str]]:
+    """
+    Empacota localidades x categorias x períodos no menor número de URLs que
+    respeitam o limite de valores por requisição e o tamanho máximo da URL.
+    Retorna [(bloco, periodos, localidades, categorias, url)], ordenado por bloco
+    de períodos (cada bloco fecha antes do seguinte começar).
+    """
+    M, C, P = len(codigos_localidade), max(1, len(cat_ids)), len(periodos)
+    if not M or not P:
+        return []
+    per_loc = max(len(str(x)) for x in codigos_localidade) + 1
+    cats_longas = sorted(cat_ids, key=lambda x: -len(str(x)))
+    pers_longos = sorted(periodos, key=lambda x: -len(str(x)))
+
+    best = None
+    for cc in range(1, C + 1):
+        for pb in range(1, P + 1):
+            cells = cc * pb
+            if cells > max_valores:
+                break
+            fixed = len(build_values_url(
+                agregado_id, variavel_id, localidade_nivel, [], class_id,
+                cats_longas[:cc] or None, periodo="|".join(pers_longos[:pb]),
+            ))
+            mb = min(M, max_valores // cells, (max_url - fixed) // per_loc)
+            if mb < 1:
+                continue
+            n = math.ceil(C / cc) * math.ceil(P / pb) * math.ceil(M / mb)
+            key = (n, -(cc * pb * mb))
+            if best is None or key < best[0]:
+                best = (key, cc, pb, mb)
+    if best is None:
+        raise ValueError(
+            f"Nenhuma divisão cabe nos limites (max_valores={max_valores}, max_url={max_url})."
+        )
+
+    _, cc, pb, mb = best
+    cat_chunks = _split_even(list(cat_ids), cc) or [[]]
+    out = []
+    for b, bloco in enumerate(_split_even(list(periodos), pb)):
+        for mchunk in _split_even(list(codigos_localidade), mb):
+            for pchunk in cat_chunks:
+                url = build_values_url(
+                    agregado_id, variavel_id, localidade_nivel, mchunk, class_id,
+                    pchunk or None, periodo="|".join(bloco),
+                )
+                out.append((b, bloco, mchunk, pchunk, url))
+    return out
+
+VALUES_COLS = ["cod_municipio", "nome_municipio", "produto_codigo", "ano", "unidade", "valor_str", "valor_num"]
+
+def _values_roles(header: dict) -> dict:
+    """Papel de cada coluna D{n}C a partir do cabeçalho (js[0]) da resposta /values."""
+    roles = {}
+    for k, nome in header.items():
+        if not (k.startswith("D") and k.endswith("C")):
+            continue
+        n = normalize_name(str(nome))
+        if n.startswith("municipio"):
+            roles.setdefault("municipio", k)
+        elif n.startswith(("ano", "mes", "trimestre", "periodo")):
+            roles.setdefault("periodo", k)
+        elif n.startswith("variavel"):
+            roles.setdefault("variavel", k)
+        else:
+            roles.setdefault("categorias", []).append(k)
+    return roles
+
+def parse_values_frame(js, municipios: set[int], categorias: set[int]) -> pd.DataFrame:
+    """
+    Converte a resposta /values (lista: cabeçalho + linhas) em colunas, num passe só.
+    Os papéis das colunas (município, período, categoria) saem do cabeçalho; quando
+    o cabeçalho não identifica, usa a coluna cujos códigos batem com os pedidos.
+    Mantém só linhas de municípios/categorias pedidos e com ano válido.
+    """
+    if not isinstance(js, list) or len(js) <= 1:
+        return pd.DataFrame(columns=VALUES_COLS)
+
+    header = js[0]
+    df = pd.DataFrame.from_records(js[1:])
+    roles = _values_roles(header)
+    code_cols = [c for c in df.columns if c.startswith("D") and c.endswith("C")]
+    codes = {c: pd.to_numeric(df[c], errors="coerce") for c in code_cols}
+
+    def _best(cands, alvo):
+        cands = [c for c in cands if c in codes]
+        if not cands:
+            return None
+        c = max(cands, key=lambda c: int(codes[c].isin(alvo).sum()))
+        return c if codes[c].isin(alvo).any() else None
+
+    c_mun = roles.get("municipio") if roles.get("municipio") in codes else _best(code_cols, municipios)
+    c_cat = _best([c for c in roles.get("categorias", []) if c != c_mun], categorias) or _best(
+        [c for c in code_cols if c != c_mun], categorias
+    )
+    if not c_mun or not c_cat:
+        return pd.DataFrame(columns=VALUES_COLS)
+
+    c_per = roles.get("periodo")
+    if c_per in df.columns:
+        ano = pd.to_numeric(df[c_per].astype(str).str[:4], errors="coerce")
+    elif "Ano" in df.columns:
+        ano = pd.to_numeric(df["Ano"].astype(str).str[:4], errors="coerce")
+    elif "Mês" in df.columns:
+        ano = pd.to_numeric(df["Mês"].astype(str).str[:4], errors="coerce")
+    else:
+        ano = pd.Series(float("nan"), index=df.index)
+    ano = ano.where(ano.between(1900, 2100))
+
+    c_nome = c_mun[:-1] + "N"
+    nome = df[c_nome] if c_nome in df.columns else df.get("Município", pd.Series("", index=df.index))
+    if "MN" in df.columns:
+        unidade = df["MN"]
+    else:
+        unidade = pd.Series(header.get("Unidade", ""), index=df.index)
+    valor = df["V"] if "V" in df.columns else pd.Series(None, index=df.index, dtype="object")
+
+    out = pd.DataFrame({
+        "cod_municipio": codes[c_mun],
+        "nome_municipio": nome.fillna("").astype(str),
+        "produto_codigo": codes[c_cat],
+        "ano": ano,
+        "unidade": unidade,
+        "valor_str": valor.where(valor.isna(), valor.astype(str)),
+        "valor_num": try_float_series(valor),
+    })
+    mask = out["cod_municipio"].isin(municipios) & out["produto_codigo"].isin(categorias) & out["ano"].notna()
+    out = out[mask].reset_index(drop=True)
+    for c in ("cod_municipio", "produto_codigo", "ano"):
+        out[c] = out[c].astype("Int64")
+    return out
@@ -1,10 +1,15 @@
 import os
 import ssl
+import time
+import threading
 import requests
 from typing import Any, Dict, Optional
-from tenacity import retry, wait_exponential, stop_after_attempt
+from urllib.parse import urlsplit
+from tenacity import Retrying, wait_exponential, stop_after_attempt, retry_if_exception
 from unidecode import unidecode
 
+import http_cache
+
 HEADERS = {"User-Agent": "AFUBRA-IBGE/1.0 (+automation sidra)"}
 
 # --- Adapter TLS tolerante a servidores legados ---
@@ -24,8 +29,121 @@ class TLSAdapter(requests.adapters.HTTPAdapter):
         kwargs["ssl_context"] = ctx
         return super().init_poolmanager(*args, **kwargs)
 
+# Pool de conexões limitado: workers concorrentes esperam por uma conexão livre
+# em vez de abrir sockets extras contra o IBGE.
+HTTP_POOL_MAXSIZE = int(os.getenv("IBGE_HTTP_POOL_MAXSIZE", "8"))
+
 _SESSION = requests.Session()
-_SESSION.mount("https://", TLSAdapter())
+_SESSION.mount("https://", TLSAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=True))
+_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=True))
+
+class TokenBucket:
+    """Limite de requisições/s compartilhado entre threads (rate <= 0 desabilita)."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+RATE_LIMITER = TokenBucket(float(os.getenv("IBGE_MAX_RPS", "5")))
+
+class CircuitBreaker:
+    """
+    Disjuntor por host: após `threshold` falhas de conexão seguidas, abre por
+    `cooldown` segundos e todas as threads esperam em vez de gastar retentativas.
+    Depois do cooldown deixa passar uma requisição de teste (meio-aberto).
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.falhas = 0
+        self.aberturas = 0
+        self.aberto_ate = 0.0
+        self._testando = False
+        self._cond = threading.Condition()
+
+    @property
+    def estado(self) -> str:
+        if self.falhas < self.threshold:
+            return "fechado"
+        return "aberto" if time.monotonic() < self.aberto_ate else "meio-aberto"
+
+    def wait_closed(self) -> None:
+        with self._cond:
+            while True:
+                if self.falhas < self.threshold:
+                    return
+                restante = self.aberto_ate - time.monotonic()
+                if restante <= 0 and not self._testando:
+                    self._testando = True  # esta thread faz o teste
+                    return
+                self._cond.wait(timeout=max(restante, 0.5))
+
+    def record_success(self) -> None:
+        with self._cond:
+            self.falhas = 0
+            self._testando = False
+            self._cond.notify_all()
+
+    def record_failure(self) -> None:
+        with self._cond:
+            self.falhas += 1
+            self._testando = False
+            if self.falhas >= self.threshold:
+                self.aberto_ate = time.monotonic() + self.cooldown
+                self.aberturas += 1
+            self._cond.notify_all()
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+
+def get_breaker(url: str) -> CircuitBreaker:
+    host = urlsplit(url).hostname or ""
+    with _BREAKERS_LOCK:
+        if host not in _BREAKERS:
+            _BREAKERS[host] = CircuitBreaker(
+                int(os.getenv("IBGE_CIRCUIT_FALHAS", "5")),
+                float(os.getenv("IBGE_CIRCUIT_PAUSA_S", "60")),
+            )
+        return _BREAKERS[host]
+
+def breakers_status() -> dict:
+    with _BREAKERS_LOCK:
+        return {
+            h: {"estado": b.estado, "falhas_seguidas": b.falhas, "aberturas": b.aberturas}
+            for h, b in _BREAKERS.items()
+        }
+
+def is_host_down_error(e: BaseException) -> bool:
+    """Falha de conexão/servidor (conta para o disjuntor) x erro da própria requisição (4xx)."""
+    if isinstance(e, requests.exceptions.HTTPError):
+        code = e.response.status_code if e.response is not None else 0
+        return code >= 500 or code == 429
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def is_request_error(e: BaseException) -> bool:
+    """Erro da própria requisição (4xx exceto 429): repetir não adianta."""
+    if isinstance(e, requests.exceptions.HTTPError):
+        code = e.response.status_code if e.response is not None else 0
+        return 400 <= code < 500 and code != 429
+    return False
 
 def normalize_name(name: str) -> str:
     if not name:
@@ -47,13 +165,70 @@ def try_float(x: str):
     except Exception:
         return None
 
+def try_float_series(s):
+    """Versão vetorizada de try_float para uma pandas.Series (NaN onde não converte)."""
+    import pandas as pd
+    st = s.astype("string").str.strip()
+    st = st.mask(st.isin(["...", "-", "", "X", "x"]))
+    st = st.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    return pd.to_numeric(st, errors="coerce").astype("float64")
+
 def _maybe_http_fallback(url: str) -> Optional[str]:
     if url.startswith("https://"):
         return "http://" + url[len("https://"):]
     return None
 
-@retry(wait=wait_exponential(multiplier=1, min=1, max=20), stop=stop_after_attempt(6))
-def http_get_json(url: str, params: Optional[Dict[str, Any]] = None) -> Any:
+def http_get_json(
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True,
+    tentativas: Optional[int] = None,
+) -> Any:
+    """
+    GET JSON passando pelo cache em disco (http_cache): metadados e localidades
+    são servidos localmente enquanto válidos; use_cache=False força a rede.
+    tentativas: máximo de tentativas (padrão IBGE_HTTP_TENTATIVAS=6).
+    """
+    if use_cache:
+        hit, value = http_cache.get(url, params)
+        if hit:
+            return value
+    value = _http_get_json_remote(url, params, tentativas)
+    if use_cache:
+        try:
+            http_cache.put(url, params, value)
+        except OSError:
+            pass  # cache é opcional: falha de disco não derruba a coleta
+    return value
+
+def _http_get_json_remote(url: str, params: Optional[Dict[str, Any]] = None, tentativas: Optional[int] = None) -> Any:
+    """
+    Retentativas com espera exponencial, respeitando o disjuntor do host. Tudo é repetido
+    (inclusive corpo truncado ou JSON inválido) menos 4xx != 429, que sobe na hora (em
+    /values, vai direto para a divisão da requisição). O disjuntor só conta falhas do host.
+    """
+    tentativas = tentativas or int(os.getenv("IBGE_HTTP_TENTATIVAS", "6"))
+    breaker = get_breaker(url)
+    for attempt in Retrying(
+        wait=wait_exponential(multiplier=1, min=1, max=20),
+        stop=stop_after_attempt(tentativas),
+        retry=retry_if_exception(lambda e: not is_request_error(e)),
+        reraise=True,
+    ):
+        with attempt:
+            breaker.wait_closed()
+            try:
+                value = _get_once(url, params)
+            except Exception as e:
+                if is_host_down_error(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()  # host respondeu
+                raise
+            breaker.record_success()
+            return value
+
+def _get_once(url: str, params: Optional[Dict[str, Any]] = None) -> Any:
     """
     GET com tolerância a TLS em OpenSSL 3 e fallback para HTTP.
     Controles por ambiente:
@@ -64,6 +239,7 @@ def http_get_json(url: str, params: Optional[Dict[str, Any]] = None) -> Any:
     verify = os.getenv("IBGE_SSL_NO_VERIFY", "0") != "1"
 
     def _do_get(u: str, vfy: bool):
+        RATE_LIMITER.acquire()
         r = _SESSION.get(u, headers=HEADERS, params=params, timeout=60, verify=vfy)
         r.raise_for_status()
         return r.json()
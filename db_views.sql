@@ -22,6 +22,22 @@ CREATE INDEX IF NOT EXISTS idx_sidra_produto_nome
 CREATE INDEX IF NOT EXISTS idx_sidra_cod_municipio
   ON public.dados_sidra_brutos (cod_municipio);
 
+-- Dimensões mantidas pelo app (ensure_schema / casamento IBGE):
+--   dim_grupo_sidra                 tabela SIDRA -> grupo (no lugar de CASE por linha)
+--   dim_municipio_filial_exclusiva  município -> filial exclusiva (no lugar de ROW_NUMBER)
+-- Semeadas aqui (só o que falta) para as views não saírem vazias/'desconhecido'
+-- antes do primeiro /init ou bootstrap. Manter em linha com TABLES (logic.py).
+INSERT INTO public.dim_grupo_sidra (tabela, grupo)
+VALUES (1612, 'vegetal'), (3939, 'rebanho'), (3946, 'aquicultura')
+ON CONFLICT (tabela) DO NOTHING;
+
+INSERT INTO public.dim_municipio_filial_exclusiva (codigo_ibge, filial, nome_municipio)
+SELECT DISTINCT ON (codigo_ibge) codigo_ibge, filial, nome_municipio
+FROM public.municipios_filiais
+WHERE codigo_ibge IS NOT NULL
+ORDER BY codigo_ibge, filial
+ON CONFLICT (codigo_ibge) DO NOTHING;
+
 -- =========================
 -- VIEW: Fato "com duplicidade" (uso dentro da filial)
 --   Observação: se filtrar múltiplas filiais juntas, pode haver double-count.
@@ -29,23 +45,22 @@ CREATE INDEX IF NOT EXISTS idx_sidra_cod_municipio
 CREATE OR REPLACE VIEW public.vw_fato_filial_produto_anual AS
 SELECT
   f.filial,
-  d.uf,
+  COALESCE(d.uf, mi.uf) AS uf,
   d.cod_municipio,
   COALESCE(d.nome_municipio, f.nome_municipio) AS nome_municipio,
   d.ano,
-  CASE d.tabela
-    WHEN 1612 THEN 'vegetal'
-    WHEN 3939 THEN 'rebanho'
-    WHEN 3946 THEN 'aquicultura'
-    ELSE 'desconhecido'
-  END AS grupo,
+  COALESCE(g.grupo, 'desconhecido')::text AS grupo,
   d.produto_codigo,
   d.produto_nome,
   d.unidade,
   d.valor_num
 FROM public.dados_sidra_brutos d
 JOIN public.municipios_filiais f
-  ON f.codigo_ibge = d.cod_municipio;
+  ON f.codigo_ibge = d.cod_municipio
+LEFT JOIN public.municipios_ibge mi
+  ON mi.codigo_ibge = d.cod_municipio
+LEFT JOIN public.dim_grupo_sidra g
+  ON g.tabela = d.tabela;
 
 COMMENT ON VIEW public.vw_fato_filial_produto_anual IS
 'Fato por filial/município/produto/ano. Útil para análises por uma filial.
@@ -56,44 +71,29 @@ Se agrupar múltiplas filiais, municípios compartilhados podem gerar dupla cont
 
 -- =========================
 -- VIEW: Fato "exclusivo" (sem double-count entre filiais)
---   Regra de desempate: primeira filial por ordem alfabética para cada município.
+--   Regra de desempate: primeira filial por ordem alfabética para cada município,
+--   já resolvida em dim_municipio_filial_exclusiva.
 --   Útil para comparativos entre filiais.
 -- =========================
 CREATE OR REPLACE VIEW public.vw_fato_filial_exclusiva AS
-WITH base AS (
-  SELECT
-    codigo_ibge,
-    filial,
-    ROW_NUMBER() OVER (PARTITION BY codigo_ibge ORDER BY filial ASC) AS rn
-  FROM public.municipios_filiais
-),
-exclusiva AS (
-  SELECT codigo_ibge, filial
-  FROM base
-  WHERE rn = 1
-)
 SELECT
   e.filial,
-  d.uf,
+  COALESCE(d.uf, mi.uf) AS uf,
   d.cod_municipio,
-  COALESCE(d.nome_municipio, mf.nome_municipio) AS nome_municipio,
+  COALESCE(d.nome_municipio, e.nome_municipio) AS nome_municipio,
   d.ano,
-  CASE d.tabela
-    WHEN 1612 THEN 'vegetal'
-    WHEN 3939 THEN 'rebanho'
-    WHEN 3946 THEN 'aquicultura'
-    ELSE 'desconhecido'
-  END AS grupo,
+  COALESCE(g.grupo, 'desconhecido')::text AS grupo,
   d.produto_codigo,
   d.produto_nome,
   d.unidade,
   d.valor_num
 FROM public.dados_sidra_brutos d
-JOIN exclusiva e
+JOIN public.dim_municipio_filial_exclusiva e
   ON e.codigo_ibge = d.cod_municipio
-LEFT JOIN public.municipios_filiais mf
-  ON mf.codigo_ibge = d.cod_municipio
- AND mf.filial = e.filial;
+LEFT JOIN public.municipios_ibge mi
+  ON mi.codigo_ibge = d.cod_municipio
+LEFT JOIN public.dim_grupo_sidra g
+  ON g.tabela = d.tabela;
 
 COMMENT ON VIEW public.vw_fato_filial_exclusiva IS
 'Fato por filial com cada município atribuído a UMA filial (sem duplicidade).
@@ -105,17 +105,24 @@ Regra: primeira filial em ordem alfabética para o município.';
 --   - Atualize após nova coleta com: REFRESH MATERIALIZED VIEW public.mv_fato_ultimo_ano;
 -- =========================
 
+-- Versões antigas (CASE por linha) são recriadas para usar dim_grupo_sidra
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM pg_matviews
+    WHERE schemaname = 'public' AND matviewname = 'mv_fato_ultimo_ano'
+      AND definition NOT LIKE '%dim_grupo_sidra%'
+  ) THEN
+    DROP MATERIALIZED VIEW public.mv_fato_ultimo_ano;
+  END IF;
+END $$;
+
 -- Descobrir último ano (subselect interno)
 CREATE MATERIALIZED VIEW IF NOT EXISTS public.mv_fato_ultimo_ano AS
 SELECT
   f.filial,
-  d.uf,
-  CASE d.tabela
-    WHEN 1612 THEN 'vegetal'
-    WHEN 3939 THEN 'rebanho'
-    WHEN 3946 THEN 'aquicultura'
-    ELSE 'desconhecido'
-  END AS grupo,
+  COALESCE(d.uf, mi.uf) AS uf,
+  COALESCE(g.grupo, 'desconhecido')::text AS grupo,
   d.produto_nome,
   d.unidade,
   d.ano,
@@ -123,8 +130,16 @@ SELECT
 FROM public.dados_sidra_brutos d
 JOIN public.municipios_filiais f
   ON f.codigo_ibge = d.cod_municipio
+LEFT JOIN public.municipios_ibge mi
+  ON mi.codigo_ibge = d.cod_municipio
+LEFT JOIN public.dim_grupo_sidra g
+  ON g.tabela = d.tabela
 WHERE d.ano = (SELECT MAX(ano) FROM public.dados_sidra_brutos)
-GROUP BY f.filial, d.uf, grupo, d.produto_nome, d.unidade, d.ano;
+GROUP BY f.filial, COALESCE(d.uf, mi.uf), grupo, d.produto_nome, d.unidade, d.ano;
+
+-- Índice único: permite REFRESH MATERIALIZED VIEW CONCURRENTLY (sem bloquear leitores)
+CREATE UNIQUE INDEX IF NOT EXISTS uq_mv_ultimo_ano_chave
+  ON public.mv_fato_ultimo_ano (filial, uf, grupo, produto_nome, unidade, ano);
 
 -- Índices para navegação da MV
 CREATE INDEX IF NOT EXISTS idx_mv_ultimo_ano_filial
@@ -140,6 +155,19 @@ COMMENT ON MATERIALIZED VIEW public.mv_fato_ultimo_ano IS
 'Agregado por filial/grupo/produto no último ano para acelerar dashboards. 
 Atualize após nova coleta: REFRESH MATERIALIZED VIEW public.mv_fato_ultimo_ano;';
 
+-- =========================
+-- VIEW: Último ano a partir do agregado incremental (sem REFRESH)
+--   public.fato_agregado_anual (criada pelo app) guarda todos os anos e é atualizada
+--   ao fim de cada coleta / POST /db/refresh-mv só nas chaves que mudaram.
+-- =========================
+CREATE OR REPLACE VIEW public.vw_fato_agregado_ultimo_ano AS
+SELECT filial, NULLIF(uf, '') AS uf, grupo, produto_nome, NULLIF(unidade, '') AS unidade, ano, valor
+FROM public.fato_agregado_anual
+WHERE ano = (SELECT MAX(ano) FROM public.fato_agregado_anual);
+
+COMMENT ON VIEW public.vw_fato_agregado_ultimo_ano IS
+'Mesmo conteúdo de mv_fato_ultimo_ano, lido do agregado incremental: sempre atual, sem REFRESH.';
+
 -- =========================
 -- VIEW utilitária: Produtos do último ano (para filtros)
 -- =========================
@@ -152,27 +180,6 @@ ORDER BY produto_nome;
 COMMENT ON VIEW public.vw_produtos_ultimo_ano IS
 'Lista de produtos disponíveis no último ano. Útil para filtros no BI.';
 
-# --- [REFRESH MATERIALIZED VIEWS] -------------------------------------------
-
-from db import get_engine
-
-def refresh_materialized_views(concurrently: bool = False) -> list[str]:
-    """
-    Atualiza as materialized views usadas no BI.
-    Se concurrently=True, usa REFRESH CONCURRENTLY (requer índice único na MV).
-    Retorna a lista de MVs atualizadas.
-    """
-    mv_names = ["public.mv_fato_ultimo_ano"]
-    clause = "CONCURRENTLY " if concurrently else ""
-    stmt_tpl = f"REFRESH MATERIALIZED VIEW {clause}{{mv}};"
-
-    eng = get_engine()
-    with eng.begin() as conn:
-        for mv in mv_names:
-            conn.exec_driver_sql(stmt_tpl.format(mv=mv))
-    return mv_names
-
-
 -- =========================
 -- FIM
 -- =========================